@@ -10,15 +10,59 @@ OPENAI_BASE = os.getenv("OPENAI_BASE", "https://api.openai.com/v1")
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")  # rapide et bon pour tool-calling
 DEFAULT_BASE_URL = os.getenv("COPILOTPC_BASE_URL", "http://127.0.0.1:8730")
 DEFAULT_TOKEN = os.getenv("COPILOTPC_TOKEN", "")
+HTTP_TIMEOUT = float(os.getenv("COPILOTPC_HTTP_TIMEOUT", "30"))
+LLM_TIMEOUT = float(os.getenv("COPILOTPC_LLM_TIMEOUT", "120"))
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("COPILOTPC_HTTP_MAX_CONNECTIONS", "10")),
+    max_keepalive_connections=int(os.getenv("COPILOTPC_HTTP_MAX_KEEPALIVE", "5")),
+)
 
 class LLMPlanner:
     """
     Transforme une demande NL -> suite d'appels d'outils CopilotPC.
     Utilise OpenAI Responses API + Tool Calling.
+    Un seul client httpx (keep-alive) sert tous les tours et tous les outils ;
+    fermer avec `await planner.aclose()` ou `async with LLMPlanner() as planner`.
     """
-    def __init__(self, base_url: str = DEFAULT_BASE_URL, token: str = DEFAULT_TOKEN):
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, token: str = DEFAULT_TOKEN,
+                 client: httpx.AsyncClient | None = None):
         self.base = base_url.rstrip("/")
         self.token = token
+        self._client = client
+        self._owns_client = client is None
+        self.stats = {"requests": 0, "connections": 0, "tls_handshakes": 0}
+
+    async def _count_request(self, request):
+        self.stats["requests"] += 1
+
+        async def _trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                self.stats["connections"] += 1
+            elif event == "connection.start_tls.complete":
+                self.stats["tls_handshakes"] += 1
+
+        request.extensions["trace"] = _trace
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=HTTP_TIMEOUT,
+                limits=HTTP_LIMITS,
+                event_hooks={"request": [self._count_request]},
+            )
+            self._owns_client = True
+        return self._client
+
+    async def aclose(self):
+        if self._owns_client and self._client is not None:
+            await self._client.aclose()
+        self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
 
     # ---- Outils que l'IA peut appeler ----
     def tool_schema(self):
@@ -43,6 +87,18 @@ class LLMPlanner:
                     "parameters":{"type":"object","properties":{"title":{"type":"string"}},"required":["title"]}
                 }
             },
+            {
+                "type":"function",
+                "function":{
+                    "name":"wait_window",
+                    "description":"Attendre qu'une fenêtre dont le titre contient 'title' apparaisse (au lieu d'une pause fixe).",
+                    "parameters":{
+                        "type":"object",
+                        "properties":{"title":{"type":"string"},"timeout":{"type":"number","minimum":0,"maximum":30}},
+                        "required":["title"]
+                    }
+                }
+            },
             {
                 "type":"function",
                 "function":{
@@ -90,39 +146,43 @@ class LLMPlanner:
         params = params or {}
         if self.token:
             params["token"] = self.token
-        async with httpx.AsyncClient(timeout=30) as cli:
-            r = await cli.get(f"{self.base}{path}", params=params)
-            r.raise_for_status()
-            return r.json()
-
-    @staticmethod
-    def _needs_clipboard(text: str) -> bool:
-        multiline = ("\n" in text) or ("\r" in text)
-        too_long = len(text) > 300
-        has_non_ascii = any(ord(c) > 127 for c in text)
-        return multiline or too_long or has_non_ascii
+        r = await self._http().get(f"{self.base}{path}", params=params)
+        r.raise_for_status()
+        return r.json()
+
+    async def _post_text(self, path, text, params=None):
+        """Text sent as the request body (no URL length limit, not logged with the URL)."""
+        params = dict(params or {})
+        if self.token:
+            params["token"] = self.token
+        r = await self._http().post(f"{self.base}{path}", params=params, content=text.encode("utf-8"),
+                                    headers={"Content-Type": "text/plain; charset=utf-8"})
+        r.raise_for_status()
+        return r.json()
 
     async def tool_dispatch(self, name, args):
         if name == "run_app":
             return await self._call_local("/app/run", {"name": args["name"]})
         if name == "focus_window":
             return await self._call_local("/window/activate", {"title": args["title"]})
+        if name == "wait_window":
+            params = {"title": args["title"]}
+            if args.get("timeout") is not None:
+                params["timeout"] = max(0.0, min(30.0, float(args["timeout"])))
+            return await self._call_local("/window/wait", params)
         if name == "open_url":
             return await self._call_local("/browser/open", {"url": args["url"]})
         if name == "type_text":
             txt = args.get("text")
             if not isinstance(txt, str) or not txt.strip():
                 return {"ok": False, "status": 400, "error": "missing_text_argument"}
-            if self._needs_clipboard(txt):
-                return await self.tool_dispatch("paste_text", {"text": txt})
-            return await self._call_local("/os/keyboard/type", {"text": txt})
+            # le serveur choisit frappe directe, par blocs ou collage (TextInjector)
+            return await self._post_text("/os/keyboard/type", txt)
         if name == "paste_text":
             txt = args.get("text")
             if not isinstance(txt, str) or not txt.strip():
                 return {"ok": False, "status": 400, "error": "missing_text_argument"}
-            clip = await self._call_local("/os/clipboard/set", {"text": txt})
-            paste = await self._call_local("/os/keyboard/paste")
-            return {"ok": True, "clipboard": clip, "paste": paste}
+            return await self._post_text("/os/keyboard/type", txt, {"strategy": "clipboard"})
         if name == "hotkey":
             return await self._call_local("/os/keyboard/hotkey", {"keys": args["keys"]})
         if name == "screenshot":
@@ -161,10 +221,10 @@ class LLMPlanner:
                 "temperature": 0.2,
             }
             # Responses API
-            async with httpx.AsyncClient(timeout=120) as cli:
-                resp = await cli.post(f"{OPENAI_BASE}/responses", headers=headers, json=payload)
-                resp.raise_for_status()
-                data = resp.json()
+            resp = await self._http().post(f"{OPENAI_BASE}/responses", headers=headers, json=payload,
+                                           timeout=LLM_TIMEOUT)
+            resp.raise_for_status()
+            data = resp.json()
 
             # La forme exacte dépend des mises à jour du SDK; on lit "output" / "choices"
             # Structure courante: data['output'] -> list d'items; sinon data['choices'][0]['message']
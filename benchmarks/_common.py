@@ -0,0 +1,39 @@
+"""Shared helpers for the benchmark scripts: load `server` against the test stubs."""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def install_stubs():
+    """Register the pyautogui / pyperclip / mss / pywinauto stubs from tests/conftest.py."""
+    spec = importlib.util.spec_from_file_location("_copilotpc_stubs", ROOT / "tests" / "conftest.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_server(config_text=None):
+    stubs = install_stubs()
+    tmp = Path(tempfile.mkdtemp(prefix="copilotpc-bench-"))
+    config = tmp / "config.toml"
+    config.write_text(config_text or stubs.DEFAULT_CONFIG, encoding="utf-8")
+    os.environ["COPILOTPC_CONFIG"] = str(config)
+    os.environ.setdefault("COPILOTPC_TOKEN", "secret")
+    sys.path.insert(0, str(ROOT))
+    import server
+    return server
+
+
+def timeit(fn, repeat=5):
+    """Best wall time in milliseconds over `repeat` runs, and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, (time.perf_counter() - t0) * 1000)
+    return best, result
@@ -0,0 +1,62 @@
+"""Mouse input latency: one HTTP request per move vs the /ws/control channel.
+
+    python benchmarks/bench_control.py
+
+moveTo is wrapped with the costs of a real desktop session: the move
+duration, pyautogui.PAUSE after each call that keeps its pause and a small
+SendInput cost. Reports milliseconds per event for GET /os/mouse/move,
+for acked WebSocket moves sent one by one, and for a burst of moves sent
+in one message where the superseded ones are coalesced.
+"""
+import sys
+import time
+
+from fastapi.testclient import TestClient
+
+from _common import load_server
+
+PAUSE_SEC = 0.1       # pyautogui.PAUSE default
+INPUT_SEC = 0.0002    # SendInput for one move
+EVENTS = 50
+
+
+def simulate_desktop():
+    pyautogui = sys.modules["pyautogui"]
+    move = pyautogui.moveTo
+
+    def slow_move(x, y, duration=0.0, _pause=True):
+        time.sleep(duration + INPUT_SEC + (PAUSE_SEC if _pause else 0))
+        move(x, y, duration=duration, _pause=_pause)
+
+    pyautogui.moveTo = slow_move
+
+
+def main():
+    server = load_server()
+    simulate_desktop()
+    client = TestClient(server.app)
+    token = server.TOKEN
+
+    n = 5   # each HTTP move pays duration + PAUSE
+    t0 = time.perf_counter()
+    for i in range(n):
+        client.get("/os/mouse/move", params={"token": token, "x": i, "y": i})
+    print(f"HTTP GET /os/mouse/move          {(time.perf_counter() - t0) * 1000 / n:8.2f} ms/event")
+
+    with client.websocket_connect(f"/ws/control?token={token}") as ws:
+        t0 = time.perf_counter()
+        for i in range(EVENTS):
+            ws.send_json({"seq": i, "op": "move", "x": i, "y": i})
+            ws.receive_json()
+        print(f"/ws/control, one move per ack    {(time.perf_counter() - t0) * 1000 / EVENTS:8.2f} ms/event")
+
+        t0 = time.perf_counter()
+        ws.send_json([{"seq": i, "op": "move_rel", "dx": 1, "dy": 1} for i in range(EVENTS)])
+        acks = [ws.receive_json() for _ in range(EVENTS)]
+        coalesced = sum(1 for a in acks if a.get("coalesced"))
+        print(f"/ws/control, burst of {EVENTS} moves   {(time.perf_counter() - t0) * 1000 / EVENTS:8.2f} ms/event "
+              f"({coalesced} coalesced)")
+
+
+if __name__ == "__main__":
+    main()
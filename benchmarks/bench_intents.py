@@ -0,0 +1,61 @@
+"""Intent matching and the plan cache.
+
+    python benchmarks/bench_intents.py
+
+Measures clause matching on long multi-clause scripted commands (the bulk
+path of /agent/command), the full interpret_command call, and the plan cache
+(repeated texts, and repeated phrasings with new quoted payloads).
+"""
+import random
+import time
+
+from _common import load_server
+
+CLAUSES = [
+    'tape "{w}"', "écrit {w} {w} {w}", "appuie sur entrée", "tab", "capture", "ouvre notepad",
+    "focus Bloc-notes", "va sur example.com", "saisis {w}@mail.com", "onglet suivant",
+]
+WORDS = ["bonjour", "facture", "rapport", "client", "mardi", "lorem", "ipsum", "dolor"]
+
+
+def make_command(rng, n):
+    return " et ".join(rng.choice(CLAUSES).format(w=rng.choice(WORDS)) for _ in range(n))
+
+
+def bench(fn, items, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main():
+    server = load_server()
+    rng = random.Random(42)
+    for n_clauses in (1, 10, 50):
+        commands = [make_command(rng, n_clauses) for _ in range(200)]
+        clauses = [c.strip() for cmd in commands for c in server._CLAUSE_SPLIT.split(cmd) if c.strip()]
+        match = bench(server.match_intent, clauses)
+        full = bench(server.interpret_command, commands)
+        print(f"{n_clauses:>3} clauses/cmd  {len(clauses):>6} clauses  match_intent {match:8.2f} ms  "
+              f"interpret_command {full:8.2f} ms")
+    long_payload = ["tape " + " ".join(rng.choice(WORDS) for _ in range(400)) for _ in range(200)]
+    match = bench(server.match_intent, long_payload)
+    print(f"long 'tape' payloads ({len(long_payload)})          match_intent {match:8.2f} ms")
+
+    phrasings = [make_command(rng, rng.randint(1, 4)) for _ in range(20)]
+    repeated = [rng.choice(phrasings) for _ in range(2000)]
+    payloads = [p.replace('"', '"' + str(i), 1) for i, p in enumerate(repeated)]
+    for label, texts in (("repeated commands", repeated), ("new quoted payloads", payloads)):
+        server.PLAN_CACHE.invalidate()
+        raw = bench(server.interpret_command, texts)
+        cached = bench(server.PLAN_CACHE.get_plan, texts)
+        print(f"plan cache, {label:<20} ({len(texts)})  interpret {raw:8.2f} ms  "
+              f"cached {cached:8.2f} ms  (x{raw / cached:4.1f})  {server.PLAN_CACHE.stats()['hit_ratio']:.0%} hits")
+
+
+if __name__ == "__main__":
+    main()
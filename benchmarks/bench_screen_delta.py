@@ -0,0 +1,66 @@
+"""Full-frame vs delta screenshots on synthetic 1080p frames.
+
+    python benchmarks/bench_screen_delta.py
+
+Each scenario captures a base frame, then a frame where a small region
+changed (typing in a text field, a toast, a cursor blink); it reports the
+payload bytes and milliseconds of a full capture against the delta mode.
+"""
+import time
+
+import numpy as np
+
+from _common import load_server, timeit
+
+W, H = 1920, 1080
+
+
+class _Frame:
+    def __init__(self, arr):
+        self.size = (arr.shape[1], arr.shape[0])
+        self.rgb = arr.tobytes()
+
+
+def _base():
+    rng = np.random.default_rng(0)
+    frame = np.full((H, W, 3), 240, dtype=np.uint8)
+    frame[:40] = (32, 32, 48)  # title bar
+    for y in range(80, H - 80, 24):  # lines of "text"
+        frame[y:y + 12, 100:100 + rng.integers(200, 1600)] = 20
+    return frame
+
+
+def _scenarios(base):
+    typed = base.copy()
+    typed[500:512, 400:640] = 10
+    toast = base.copy()
+    toast[H - 160:H - 40, W - 420:W - 20] = (60, 120, 200)
+    cursor = base.copy()
+    cursor[300:318, 900:902] = 0
+    return {"typing": typed, "toast": toast, "cursor": cursor}
+
+
+def main():
+    server = load_server()
+    base = _base()
+    print(f"{'scenario':<10} {'fmt':<5} {'full bytes':>11} {'full ms':>8} {'delta bytes':>12} {'delta ms':>9} {'rects':>6}")
+    for name, frame in _scenarios(base).items():
+        for fmt in ("png", "jpeg"):
+            server._grab = lambda monitor=0, region=None, f=frame: _Frame(f)
+            full_ms, full = timeit(lambda: server.capture(fmt=fmt))
+
+            def delta():
+                server._grab = lambda monitor=0, region=None: _Frame(base)
+                server.FRAME_SESSIONS.drop("bench")
+                server.capture_delta("bench", fmt=fmt)
+                server._grab = lambda monitor=0, region=None: _Frame(frame)
+                t0 = time.perf_counter()
+                res = server.capture_delta("bench", fmt=fmt)
+                return (time.perf_counter() - t0) * 1000, res
+
+            delta_ms, res = min((delta() for _ in range(5)), key=lambda r: r[0])
+            print(f"{name:<10} {fmt:<5} {full['bytes']:>11} {full_ms:>8.1f} {res['bytes']:>12} {delta_ms:>9.1f} {len(res['rects']):>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Server cold start: `import server` and time to first request.
+
+    python benchmarks/bench_startup.py
+
+Every measurement runs in a fresh interpreter. The conftest stubs stand in
+for pyautogui / pywinauto / mss / pyperclip and are given the import cost of
+the real packages on a Windows desktop (IMPORT_SEC); PIL, numpy and httpx are
+the real ones. Three setups are compared:
+
+  eager  the desktop modules imported before `server`, as it used to do
+  lazy   loaded on first use ([startup] warm_imports = false)
+  warm   lazy, plus the background warm-up started by the startup hook
+
+Reported: import time, then the first /status, /os/mouse/move and
+/screen/screenshot requests (startup hooks included in the first one).
+Last line: what a fresh isolated instance costs in-process, create_app()
+against reloading the module as the test suite does.
+"""
+import importlib
+import importlib.abc
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from _common import ROOT, install_stubs, load_server, timeit
+
+IMPORT_SEC = {"pyautogui": 0.25, "pywinauto": 0.6, "mss": 0.02, "pyperclip": 0.01}
+RUNS = 3
+
+
+class _SlowStub(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    def __init__(self, name, module, cost):
+        self.name, self.module, self.cost = name, module, cost
+
+    def find_spec(self, fullname, path=None, target=None):
+        return importlib.util.spec_from_loader(fullname, self) if fullname == self.name else None
+
+    def create_module(self, spec):
+        time.sleep(self.cost)
+        return self.module
+
+    def exec_module(self, module):
+        pass
+
+
+def child(mode):
+    stubs = install_stubs()
+    for name, cost in IMPORT_SEC.items():
+        sys.meta_path.insert(0, _SlowStub(name, sys.modules.pop(name), cost))
+    config = Path(tempfile.mkdtemp(prefix="copilotpc-bench-")) / "config.toml"
+    warm = "true" if mode == "warm" else "false"
+    config.write_text(stubs.DEFAULT_CONFIG + f"\n[startup]\nwarm_imports = {warm}\n", encoding="utf-8")
+    os.environ["COPILOTPC_CONFIG"] = str(config)
+    os.environ.setdefault("COPILOTPC_TOKEN", "secret")
+    sys.path.insert(0, str(ROOT))
+
+    out = {}
+    t0 = time.perf_counter()
+    if mode == "eager":
+        for name in IMPORT_SEC:
+            __import__(name)
+    import server
+    out["import"] = time.perf_counter() - t0
+
+    from fastapi.testclient import TestClient
+    params = {"token": server.TOKEN}
+    t0 = time.perf_counter()
+    with TestClient(server.app) as client:
+        client.get("/status", params=params)
+        out["/status"] = time.perf_counter() - t0
+        time.sleep(0.5)   # someone reading the first response
+        for path, extra in (("/os/mouse/move", {"x": 1, "y": 1}), ("/screen/screenshot", {})):
+            t0 = time.perf_counter()
+            client.get(path, params={**params, **extra})
+            out[path] = time.perf_counter() - t0
+    print(json.dumps({k: round(v * 1000, 1) for k, v in out.items()}))
+
+
+def main():
+    print(f"simulated import costs: {IMPORT_SEC}")
+    for mode in ("eager", "lazy", "warm"):
+        runs = []
+        for _ in range(RUNS):
+            proc = subprocess.run([sys.executable, __file__, mode], capture_output=True, text=True, cwd=ROOT)
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        best = {k: min(r[k] for r in runs) for k in runs[0]}
+        print(f"{mode:>5}  " + "  ".join(f"{k} {v:7.1f} ms" for k, v in best.items()))
+
+    server = load_server()
+    cfg = {"security": {"token": "bench"}, "run": {"allowlist": {"notepad": "notepad.exe"}}}
+    factory_ms, _ = timeit(lambda: server.create_app(cfg), repeat=20)
+    reload_ms, _ = timeit(lambda: importlib.reload(server), repeat=5)
+    print(f"new instance: create_app {factory_ms:.2f} ms, importlib.reload(server) {reload_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        child(sys.argv[1])
+    else:
+        main()
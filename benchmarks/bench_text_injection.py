@@ -0,0 +1,62 @@
+"""Text injection strategies: direct typing, chunked typing, clipboard paste.
+
+    python benchmarks/bench_text_injection.py
+
+The conftest stubs are wrapped with the costs of a real desktop session:
+a per-key latency for typewrite, pyautogui.PAUSE after each call that keeps
+its pause, and a fixed cost for clipboard access and ctrl+v. Reports
+milliseconds and characters per second per strategy and text length, and
+which strategy TextInjector picks on its own.
+"""
+import sys
+import time
+
+from _common import load_server, timeit
+
+KEY_SEC = 0.002        # one key down/up through SendInput
+PAUSE_SEC = 0.1        # pyautogui.PAUSE default
+CLIPBOARD_SEC = 0.005  # OpenClipboard / SetClipboardData round trip
+PASTE_SEC = 0.02       # ctrl+v handled by the target window
+
+
+def simulate_desktop():
+    pyautogui, pyperclip = sys.modules["pyautogui"], sys.modules["pyperclip"]
+    typewrite, hotkey, copy, paste = pyautogui.typewrite, pyautogui.hotkey, pyperclip.copy, pyperclip.paste
+
+    def slow_typewrite(text, interval=0.0, _pause=True):
+        time.sleep(len(text) * (KEY_SEC + interval) + (PAUSE_SEC if _pause else 0))
+        typewrite(text, interval=interval, _pause=_pause)
+
+    def slow_hotkey(*keys):
+        time.sleep(PASTE_SEC + PAUSE_SEC)
+        hotkey(*keys)
+
+    def slow_copy(text):
+        time.sleep(CLIPBOARD_SEC)
+        copy(text)
+
+    def slow_paste():
+        time.sleep(CLIPBOARD_SEC)
+        return paste()
+
+    pyautogui.typewrite, pyautogui.hotkey = slow_typewrite, slow_hotkey
+    pyperclip.copy, pyperclip.paste = slow_copy, slow_paste
+
+
+def main():
+    server = load_server()
+    simulate_desktop()
+    inj = server.TEXT_INJECTOR
+    print(f"direct <= {inj.direct_max} chars, chunked <= {inj.chunk_max} chars ({inj.chunk_size}/chunk), "
+          f"clipboard beyond; restore_delay {inj.restore_delay}s")
+    for length in (10, 60, 200, 1000):
+        text = ("lorem ipsum " * (length // 12 + 1))[:length]
+        cells = []
+        for strategy in server.TEXT_STRATEGIES:
+            ms, _ = timeit(lambda: inj.inject(text, strategy), repeat=1)
+            cells.append(f"{strategy} {ms:8.1f} ms ({length / ms * 1000:8.0f} cps)")
+        print(f"{length:>5} chars  " + "  ".join(cells) + f"  -> auto: {inj.choose(text)}")
+
+
+if __name__ == "__main__":
+    main()
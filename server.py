@@ -1,23 +1,97 @@
+import json
 import logging
 import os
 import re
 import subprocess
 import shutil
 import asyncio
+import base64
+import bisect
+import contextvars
+import hashlib
+import functools
+import importlib
+import importlib.util
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Iterable, List, Literal, Optional, Tuple
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Literal, Mapping, NamedTuple, Optional, Tuple
 
 import tomllib
 from dotenv import load_dotenv
-from fastapi import Body, FastAPI, HTTPException, Query, Request
-from fastapi.responses import FileResponse, HTMLResponse
-import uvicorn
+from fastapi import Body, FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
-import pyautogui
-import mss
-from pywinauto import Desktop
-import pyperclip
+# ================== Lazy imports ==================
+# name -> ms spent importing it (None until first use)
+LAZY_IMPORTS: Dict[str, Optional[float]] = {}
+
+
+class _LazyImport:
+    """Stand-in for a heavy module (or one attribute of it), imported on first use.
+
+    Once loaded, the module global named `alias` is rebound to the real object,
+    so later calls pay nothing; attribute reads and writes before that
+    (monkeypatching in tests included) go to the real module.
+    """
+
+    def __init__(self, module: str, attr: Optional[str] = None, alias: Optional[str] = None):
+        object.__setattr__(self, "_module", module)
+        object.__setattr__(self, "_attr", attr)
+        object.__setattr__(self, "_alias", alias or attr or module)
+        object.__setattr__(self, "_obj", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+        LAZY_IMPORTS.setdefault(module, None)
+
+    def _load(self):
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    t0 = time.perf_counter()
+                    mod = importlib.import_module(self._module)
+                    if LAZY_IMPORTS.get(self._module) is None:
+                        LAZY_IMPORTS[self._module] = round((time.perf_counter() - t0) * 1000, 3)
+                    obj = getattr(mod, self._attr) if self._attr else mod
+                    object.__setattr__(self, "_obj", obj)
+                    if globals().get(self._alias) is self:
+                        globals()[self._alias] = obj
+        return self._obj
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+def _available(module: str) -> bool:
+    try:
+        return importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        return module in sys.modules
+
+
+pyautogui = _LazyImport("pyautogui")
+mss = _LazyImport("mss")
+Desktop = _LazyImport("pywinauto", "Desktop")
+pyperclip = _LazyImport("pyperclip")
+HAVE_PIL = _available("PIL")
+Image = _LazyImport("PIL.Image", alias="Image")
+HAVE_NUMPY = _available("numpy")
+np = _LazyImport("numpy", alias="np")
 
 load_dotenv()
 
@@ -121,12 +195,61 @@ def _normalize_allowlist(raw: Dict[str, Iterable[str]]) -> Dict[str, List[str]]:
 
 ALLOW = _normalize_allowlist(ALLOW)
 
+
+class Settings(NamedTuple):
+    """Read-only snapshot of the reloadable settings of one config file.
+
+    A reload builds a new snapshot and swaps it in with one assignment;
+    each request keeps the snapshot it started with.
+    """
+    cfg: Mapping
+    token: str
+    feat: Mapping[str, bool]
+    allow: Mapping[str, Tuple[str, ...]]
+    pw_enabled: bool
+    version: int = 1
+    loaded_at: float = 0.0
+
+
+def _settings_from(cfg: dict, env_token: bool = False, version: int = 1) -> Settings:
+    token = cfg.get('security', {}).get('token') or ""
+    if env_token:
+        token = os.getenv("COPILOTPC_TOKEN") or token
+    feat = _feature_overrides(cfg.get('features', {}))
+    allow = _normalize_allowlist(cfg.get('run', {}).get('allowlist', {}))
+    return Settings(
+        cfg=MappingProxyType(cfg),
+        token=token.strip(),
+        feat=MappingProxyType(feat),
+        allow=MappingProxyType({name: tuple(cmd) for name, cmd in allow.items()}),
+        pw_enabled=bool(feat.get('browser_playwright', False)),
+        version=version,
+        loaded_at=time.time(),
+    )
+
+
+SETTINGS = _settings_from(CFG, env_token=True)
+
 STATIC = ROOT / "static"
 SHOTS = ROOT / 'shots'
 SHOTS.mkdir(exist_ok=True)
 
 app = FastAPI(title="CopilotPC Lite", version="0.4")
 
+# apps en service dans ce processus : le module et chaque create_app() partagent ces hooks,
+# et ce qui pilote le bureau (threads UI, index des fenêtres, client HTTP) ne s'arrête qu'avec le dernier
+RUNNING_APPS = 0
+
+@app.on_event("startup")
+def _app_started():
+    global RUNNING_APPS
+    RUNNING_APPS += 1
+
+@app.on_event("shutdown")
+def _app_stopping():
+    global RUNNING_APPS
+    RUNNING_APPS = max(0, RUNNING_APPS - 1)
+
 # ================== Logging ==================
 from datetime import datetime
 
@@ -162,228 +285,2154 @@ def ui():
 
 # ================== Playwright (optionnel, async) ==================
 PW_ENABLED = bool(FEAT.get('browser_playwright', False))
-if PW_ENABLED:
-    from playwright.async_api import async_playwright, BrowserContext, Page
-    pw = None
-    ctx: Optional[BrowserContext] = None
-    page: Optional[Page] = None
-
-    @app.on_event("startup")
-    async def _pw_start():
-        global pw, ctx, page
-        pw = await async_playwright().start()
-        user_data = str(ROOT / "pw-user-data")
-        ctx = await pw.chromium.launch_persistent_context(
-            user_data_dir=user_data,
-            headless=False,
-            args=["--start-maximized"],
-        )
-        page = await ctx.new_page()
-
-    @app.on_event("shutdown")
-    async def _pw_stop():
-        global pw, ctx, page
-        try:
-            if page and not page.is_closed(): await page.close()
-            if ctx: await ctx.close()
-            if pw: await pw.stop()
-        except Exception:
-            pass
-else:
-    page = None
+BROWSER_CFG = CFG.get('browser', {})
 
 # ================== Models ==================
 class OneAction(BaseModel):
-    type: Literal['goto','click','fill','type','press','wait','eval','screenshot']
+    type: Literal['goto','click','fill','type','press','wait','eval','screenshot','parallel']
     url: Optional[str] = None
     selector: Optional[str] = None
     text: Optional[str] = None
     key: Optional[str] = None
     expression: Optional[str] = None
     timeout_ms: Optional[int] = 10000
+    branches: Optional[List[List["OneAction"]]] = None   # parallel: une liste d'étapes par onglet
 
 class ScriptBody(BaseModel):
     steps: List[OneAction] = Field(default_factory=list)
+    session: Optional[str] = Field(None, max_length=64)
 
 # ================== Security ==================
+# (profile, settings snapshot) serving the current request, set by _ProfileScope; unset -> module configuration
+_PROFILE: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar("profile", default=None)
+
+def current_profile() -> "Profile":
+    bound = _PROFILE.get()
+    return bound[0] if bound else DEFAULT_PROFILE
+
+def current_settings() -> Settings:
+    """Settings the current request started with, even if the config was reloaded since."""
+    bound = _PROFILE.get()
+    if bound and bound[1] is not None:
+        return bound[1]
+    return current_profile().settings
+
 def require_enabled():
-    global DISABLED
-    if DISABLED:
+    if current_profile().disabled:
         raise HTTPException(423, "CopilotPC is disabled (panic mode)")
 
 def auth(request: Request):
-    if TOKEN:
+    token = current_settings().token
+    if token:
         t = request.query_params.get('token','')
-        if t != TOKEN:
+        if t != token:
             raise HTTPException(401, "Unauthorized")
 
 # ================== Basic Routes ==================
 @app.get("/panic")
 def panic():
-    global DISABLED; DISABLED = True
+    current_profile().disabled = True
     return {"status":"ok","disabled":True}
 
 @app.get("/enable")
 def enable():
-    global DISABLED; DISABLED = False
+    current_profile().disabled = False
     return {"status":"ok","disabled":False}
 
 
 @app.get("/status")
 def status(request: Request):
     auth(request)
+    prof = current_profile()
+    settings = current_settings()
     return {
         "status": "ok",
+        "profile": prof.name,
         "host": HOST,
         "port": PORT,
-        "disabled": DISABLED,
-        "token_configured": bool(TOKEN),
-        "features": FEAT,
+        "disabled": prof.disabled,
+        "token_configured": bool(settings.token),
+        "features": dict(settings.feat),
         "feature_env": FEATURE_ENV,
-        "allowlist": sorted(ALLOW.keys()),
-        "playwright_enabled": bool(FEAT.get('browser_playwright', False)),
-        "config_path": str(CONFIG_PATH),
+        "allowlist": sorted(settings.allow.keys()),
+        "playwright_enabled": settings.pw_enabled,
+        "config_path": str(prof.config_path) if prof.config_path else None,
+        "config_version": settings.version,
+        "config_watch": prof.watcher.stats() if prof.watcher else None,
+        "http_pool": HTTP_POOL.stats(),
+        "window_index": dict(WINDOW_INDEX.stats),
+        "ui_executor": UI_EXECUTOR.stats(),
+        "input_queues": INPUT_SCHEDULER.stats(),
+        "shot_buffer": SHOT_BUFFER.stats(),
+        "text_injection": TEXT_INJECTOR.stats(),
+        "plan_cache": prof.plan_cache.stats(),
+        "jobs": prof.jobs.stats(),
+        "browser_pool": prof.browser_pool.stats(),
+        "lazy_imports": dict(LAZY_IMPORTS),
+        "control": dict(CONTROL_STATS),
+        "screen_streams": {f"{m}/{q}/{sc:g}": st.stats() for (m, q, sc), st in SCREEN_STREAMS.items()},
         "version": app.version,
     }
 
-# OS: mouse / keyboard / clipboard
-@app.get("/os/mouse/move")
-def mouse_move(request: Request, x:int=Query(...), y:int=Query(...)):
-    auth(request); require_enabled()
-    if not FEAT.get('mouse',True): raise HTTPException(403,"mouse disabled")
-    pyautogui.moveTo(x,y,duration=0.1)
+# ================== UI executor ==================
+EXECUTOR_CFG = CFG.get('executor', {})
+
+
+class UIExecutor:
+    """Bounded thread pool for blocking pyautogui / pywinauto / mss work.
+
+    Keeps the event loop free while input is injected. Calls tagged with
+    devices are serialized per device (locks taken in sorted order), so two
+    requests never interleave keystrokes while unrelated devices run in parallel.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = max(1, int(workers))
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._device_locks: Dict[str, threading.Lock] = {}
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="copilotpc-ui")
+            return self._pool
+
+    def _device_lock(self, device: str) -> threading.Lock:
+        with self._lock:
+            return self._device_locks.setdefault(device, threading.Lock())
+
+    def _call(self, fn, args, kwargs, devices: Tuple[str, ...]):
+        locks = [self._device_lock(d) for d in sorted(set(devices))]
+        for lk in locks:
+            lk.acquire()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            for lk in reversed(locks):
+                lk.release()
+
+    async def run(self, fn, *args, devices: Iterable[str] = (), **kwargs):
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        call = functools.partial(self._call, fn, args, kwargs, tuple(devices))
+        with self._lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        try:
+            return await loop.run_in_executor(self._executor(), ctx.run, call)
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def submit(self, fn, *args, devices: Iterable[str] = (), **kwargs):
+        """Fire-and-forget variant of run(), for cleanup that must outlive a cancelled caller."""
+        return self._executor().submit(self._call, fn, args, kwargs, tuple(devices))
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.pending,
+            "max_queue_depth": self.max_pending,
+            "completed": self.completed,
+            "busy_devices": sorted(d for d, lk in self._device_locks.items() if lk.locked()),
+        }
+
+
+UI_EXECUTOR = UIExecutor(workers=_env_int("COPILOTPC_UI_WORKERS", int(EXECUTOR_CFG.get("workers", 4))))
+
+
+@app.on_event("shutdown")
+def _ui_executor_stop():
+    if not RUNNING_APPS:
+        UI_EXECUTOR.shutdown()
+
+# ================== Input scheduler ==================
+INPUT_CFG = CFG.get('input', {})
+MOVE_DURATION = max(0.0, float(INPUT_CFG.get("move_duration", 0.1)))
+INPUT_DEVICES = ("clipboard", "keyboard", "mouse", "window")
+_HELD_DEVICES: contextvars.ContextVar[frozenset] = contextvars.ContextVar("held_devices", default=frozenset())
+
+
+class WaitHistogram:
+    """Wait times in fixed millisecond buckets, plus their sum (device queues, browser pool)."""
+
+    BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+    LABELS = [f"le_{b}ms" for b in BUCKETS_MS] + [f"gt_{BUCKETS_MS[-1]}ms"]
+
+    def __init__(self):
+        self.counts = [0] * len(self.LABELS)
+        self.sum_ms = 0.0
+
+    def observe(self, waited_ms: float):
+        self.sum_ms += waited_ms
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, waited_ms)] += 1
+
+    def stats(self) -> dict:
+        return {"wait_ms_sum": round(self.sum_ms, 3), "wait_ms_histogram": dict(zip(self.LABELS, self.counts))}
+
+
+class _DeviceQueue:
+    def __init__(self, name: str):
+        self.name = name
+        self.busy = False
+        self.holder: Optional[str] = None
+        self.waiters: deque = deque()
+        self.granted: set = set()
+        self.max_depth = 0
+        self.grants = 0
+        self.waits = WaitHistogram()
+
+    def observe(self, waited_ms: float):
+        self.grants += 1
+        self.waits.observe(waited_ms)
+
+
+class InputScheduler:
+    """One FIFO queue per input device; a lease holds several devices atomically.
+
+    Devices are acquired in a fixed order so multi-device leases cannot
+    deadlock. Leases are re-entrant within a task (a plan holding the keyboard
+    can run keyboard steps), and callers get HTTP 429 when a queue is full.
+    """
+
+    def __init__(self, max_queue: int = 8):
+        self.max_queue = max(0, int(max_queue))
+        self._lock = threading.Lock()
+        self.queues = {d: _DeviceQueue(d) for d in INPUT_DEVICES}
+        self.rejected = 0
+
+    def _check_capacity(self, devices: List[str]):
+        with self._lock:
+            for d in devices:
+                q = self.queues[d]
+                if q.busy and len(q.waiters) >= self.max_queue:
+                    self.rejected += 1
+                    raise HTTPException(
+                        429,
+                        detail={"error": "input queue full", "device": d, "queue_position": len(q.waiters) + 1},
+                        headers={"Retry-After": "1"},
+                    )
+
+    async def _acquire(self, q: _DeviceQueue, owner: str):
+        t0 = time.perf_counter()
+        fut = None
+        with self._lock:
+            if not q.busy:
+                q.busy = True
+            else:
+                fut = asyncio.get_running_loop().create_future()
+                q.waiters.append(fut)
+                q.max_depth = max(q.max_depth, len(q.waiters))
+        if fut is not None:
+            try:
+                await fut
+            except asyncio.CancelledError:
+                with self._lock:
+                    granted = fut in q.granted
+                    q.granted.discard(fut)
+                    if fut in q.waiters:
+                        q.waiters.remove(fut)
+                if granted:
+                    # ownership was handed over just before cancellation: pass it on
+                    self._release(q)
+                raise
+            with self._lock:
+                q.granted.discard(fut)
+        q.holder = owner
+        q.observe((time.perf_counter() - t0) * 1000)
+
+    def _release(self, q: _DeviceQueue):
+        with self._lock:
+            q.holder = None
+            while q.waiters:
+                fut = q.waiters.popleft()
+                if not fut.cancelled():
+                    # hand the device over directly, keeping FIFO order
+                    q.granted.add(fut)
+                    fut.get_loop().call_soon_threadsafe(_resolve_future, fut)
+                    return
+            q.busy = False
+
+    @asynccontextmanager
+    async def lease(self, devices: Iterable[str], owner: str = ""):
+        held = _HELD_DEVICES.get()
+        needed = sorted(set(devices) - held)
+        self._check_capacity(needed)
+        acquired: List[_DeviceQueue] = []
+        try:
+            for d in needed:
+                q = self.queues[d]
+                await self._acquire(q, owner)
+                acquired.append(q)
+            token = _HELD_DEVICES.set(held | frozenset(needed))
+            try:
+                yield
+            finally:
+                _HELD_DEVICES.reset(token)
+        finally:
+            for q in reversed(acquired):
+                self._release(q)
+
+    def stats(self) -> dict:
+        return {
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "devices": {
+                d: {
+                    "busy": q.busy,
+                    "holder": q.holder,
+                    "depth": len(q.waiters),
+                    "max_depth": q.max_depth,
+                    "grants": q.grants,
+                    **q.waits.stats(),
+                }
+                for d, q in self.queues.items()
+            },
+        }
+
+
+def _resolve_future(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+INPUT_SCHEDULER = InputScheduler(max_queue=int(INPUT_CFG.get("max_queue", 8)))
+
+# ================== Browser pool (Playwright) ==================
+class PlaywrightPages:
+    """Page factory on one Chromium, started with the first page.
+
+    `isolation = "page"` opens tabs of the persistent profile (shared cookies,
+    as before); `"context"` gives every page its own fresh browser context.
+    """
+
+    def __init__(self, cfg: dict):
+        self.isolation = cfg.get("isolation", "page")
+        self.headless = bool(cfg.get("headless", False))
+        self.pw = self.browser = self.persistent = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self.pw is not None:
+                return
+            from playwright.async_api import async_playwright
+            self.pw = await async_playwright().start()
+            if self.isolation == "context":
+                self.browser = await self.pw.chromium.launch(headless=self.headless, args=["--start-maximized"])
+            else:
+                self.persistent = await self.pw.chromium.launch_persistent_context(
+                    user_data_dir=str(ROOT / "pw-user-data"), headless=self.headless, args=["--start-maximized"])
+
+    async def new_page(self):
+        await self.start()
+        if self.browser is not None:
+            ctx = await self.browser.new_context(no_viewport=True)
+            return await ctx.new_page()
+        return await self.persistent.new_page()
+
+    async def close_page(self, page):
+        try:
+            if not page.is_closed():
+                await page.close()
+            if self.browser is not None:
+                await page.context.close()
+        except Exception:
+            pass
+
+    async def stop(self):
+        try:
+            if self.persistent: await self.persistent.close()
+            if self.browser: await self.browser.close()
+            if self.pw: await self.pw.stop()
+        except Exception:
+            pass
+        self.pw = self.browser = self.persistent = None
+
+
+class BrowserPool:
+    """Up to `size` pages leased one request (or one session id) at a time.
+
+    A session keeps its page between leases until it sits idle for `idle_ttl`
+    seconds; anonymous leases share the free pages. Pages that crashed or were
+    closed are recreated on lease, `maintain()` evicts idle pages down to
+    `prewarm` and probes the rest. Callers wait up to `lease_timeout` for a
+    page, then get HTTP 503.
+    """
+
+    def __init__(self, factory, size: int = 4, prewarm: int = 1, idle_ttl: float = 300.0,
+                 lease_timeout: float = 30.0, health_timeout: float = 2.0):
+        self.factory = factory
+        self.size = max(1, int(size))
+        self.prewarm_pages = max(0, min(self.size, int(prewarm)))
+        self.idle_ttl = float(idle_ttl)
+        self.lease_timeout = float(lease_timeout)
+        self.health_timeout = float(health_timeout)
+        self.slots: List[dict] = []
+        self.sessions: Dict[str, dict] = {}
+        self._cond = None
+        self._loop = None
+        self._next_id = 0
+        self.leases = self.waited = self.timeouts = 0
+        self.created = self.recreated = self.evicted = 0
+        self.max_in_use = 0
+        self.maintenance: Optional[asyncio.Task] = None
+        self.waits = WaitHistogram()
+
+    def _condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._cond is None or self._loop is not loop:
+            self._cond, self._loop = asyncio.Condition(), loop
+        return self._cond
+
+    def _new_slot(self, session: Optional[str]) -> dict:
+        self._next_id += 1
+        slot = {"id": self._next_id, "page": None, "session": session, "busy": False,
+                "last_used": time.monotonic(), "suspect": False, "reset": False, "leases": 0}
+        self.slots.append(slot)
+        return slot
+
+    def _pick(self, session: Optional[str]) -> Optional[dict]:
+        if session is not None and session in self.sessions:
+            slot = self.sessions[session]
+            return None if slot["busy"] else slot
+        free = [s for s in self.slots if not s["busy"] and s["session"] is None]
+        fresh = [s for s in free if not s["leases"]]
+        if session is not None and fresh:
+            slot = fresh[0]   # page préchauffée jamais servie : rien à nettoyer
+        elif free and session is None:
+            slot = max(free, key=lambda s: s["last_used"])   # la plus chaude, les autres vieillissent
+        elif len(self.slots) < self.size:
+            slot = self._new_slot(None)
+        elif free:
+            slot = max(free, key=lambda s: s["last_used"])
+            slot["reset"] = True   # une session ne reprend pas l'état d'une autre requête
+        else:
+            idle = [s for s in self.slots if not s["busy"]]
+            if not idle:
+                return None
+            # pool plein : on reprend la page de la session inactive depuis le plus longtemps
+            slot = min(idle, key=lambda s: s["last_used"])
+            del self.sessions[slot["session"]]
+            slot["reset"] = True
+        if session is not None:
+            self.sessions[session] = slot
+        slot["session"] = session
+        return slot
+
+    async def _healthy(self, slot: dict) -> bool:
+        page = slot["page"]
+        if page is None or page.is_closed():
+            return False
+        if not slot["suspect"]:
+            return True
+        try:
+            await asyncio.wait_for(page.evaluate("1"), self.health_timeout)
+            return True
+        except Exception:
+            return False
+
+    async def _ready(self, slot: dict):
+        """Give the slot a working page, (re)creating it when needed."""
+        if not slot["reset"] and await self._healthy(slot):
+            slot["suspect"] = False
+            return
+        if slot["page"] is not None:
+            await self.factory.close_page(slot["page"])
+            self.recreated += 1
+        else:
+            self.created += 1
+        slot["page"], slot["suspect"], slot["reset"] = None, False, False
+        slot["page"] = await self.factory.new_page()
+
+    def _drop(self, slot: dict):
+        if slot in self.slots:
+            self.slots.remove(slot)
+        if slot["session"] is not None and self.sessions.get(slot["session"]) is slot:
+            del self.sessions[slot["session"]]
+
+    def _observe(self, waited_ms: float):
+        self.leases += 1
+        self.waits.observe(waited_ms)
+
+    @asynccontextmanager
+    async def lease(self, session: Optional[str] = None):
+        """Yield a slot dict whose `page` is exclusively the caller's until exit."""
+        t0 = time.perf_counter()
+        cond = self._condition()
+        async with cond:
+            slot = self._pick(session)
+            if slot is None:
+                self.waited += 1
+                try:
+                    slot = await asyncio.wait_for(cond.wait_for(lambda: self._pick(session)), self.lease_timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise HTTPException(503, "browser pool busy", headers={"Retry-After": "1"})
+            slot["busy"] = True
+            slot["leases"] += 1
+            self.max_in_use = max(self.max_in_use, sum(1 for s in self.slots if s["busy"]))
+        try:
+            await self._ready(slot)
+        except Exception as e:
+            async with cond:
+                self._drop(slot)
+                cond.notify_all()
+            raise HTTPException(503, f"browser page unavailable: {e}")
+        self._observe((time.perf_counter() - t0) * 1000)
+        try:
+            yield slot
+        except BaseException:
+            slot["suspect"] = True   # sonde la page au prochain bail
+            raise
+        finally:
+            async with cond:
+                slot["busy"], slot["last_used"] = False, time.monotonic()
+                cond.notify_all()
+
+    async def prewarm(self, n: Optional[int] = None):
+        n = self.prewarm_pages if n is None else min(self.size, int(n))
+        cond = self._condition()
+        while sum(1 for s in self.slots if s["session"] is None) < n and len(self.slots) < self.size:
+            slot = self._new_slot(None)
+            slot["busy"] = True
+            try:
+                await self._ready(slot)
+            except Exception as e:
+                self._drop(slot)
+                log_event("browser_prewarm_failed", {"error": str(e)})
+                return
+            finally:
+                async with cond:
+                    slot["busy"] = False
+                    cond.notify_all()
+
+    async def maintain(self, now: Optional[float] = None):
+        """Close pages idle past `idle_ttl` (keeping `prewarm` anonymous ones), recreate crashed
+        idle pages, then top the anonymous pages back up to `prewarm`."""
+        now = time.monotonic() if now is None else now
+        cond = self._condition()
+        async with cond:
+            idle = sorted((s for s in self.slots if not s["busy"]), key=lambda s: s["last_used"], reverse=True)
+            keep = self.prewarm_pages
+            doomed = []
+            for s in idle:
+                if s["session"] is None and keep > 0:
+                    keep -= 1
+                elif now - s["last_used"] > self.idle_ttl:
+                    doomed.append(s)
+            for s in doomed:
+                self._drop(s)
+            probed = [s for s in idle if s not in doomed]
+            for s in probed:
+                s["suspect"] = s["busy"] = True
+        for s in doomed:
+            if s["page"] is not None:
+                await self.factory.close_page(s["page"])
+            self.evicted += 1
+        for s in probed:
+            try:
+                await self._ready(s)
+            except Exception:
+                async with cond:
+                    self._drop(s)
+            finally:
+                async with cond:
+                    s["busy"] = False
+                    cond.notify_all()
+        await self.prewarm()
+
+    async def close(self):
+        slots, self.slots, self.sessions = self.slots, [], {}
+        for s in slots:
+            if s["page"] is not None:
+                await self.factory.close_page(s["page"])
+        await self.factory.stop()
+
+    def stats(self) -> dict:
+        in_use = sum(1 for s in self.slots if s["busy"])
+        return {
+            "size": self.size,
+            "open": len(self.slots),
+            "in_use": in_use,
+            "utilization": round(in_use / self.size, 3),
+            "max_in_use": self.max_in_use,
+            "sessions": len(self.sessions),
+            "leases": self.leases,
+            "waited": self.waited,
+            "timeouts": self.timeouts,
+            "created": self.created,
+            "recreated": self.recreated,
+            "evicted": self.evicted,
+            **self.waits.stats(),
+        }
+
+
+def _browser_pool_from(cfg: dict) -> BrowserPool:
+    return BrowserPool(PlaywrightPages(cfg), size=int(cfg.get("pool_size", 4)),
+                       prewarm=int(cfg.get("prewarm", 1)), idle_ttl=float(cfg.get("idle_ttl", 300)),
+                       lease_timeout=float(cfg.get("lease_timeout", 30)),
+                       health_timeout=float(cfg.get("health_timeout", 2)))
+
+
+BROWSER_POOL = _browser_pool_from(BROWSER_CFG)
+
+
+async def _browser_pool_maintenance(pool: BrowserPool):
+    # Chromium se lance au premier script, ou ici en tâche de fond si prewarm > 0
+    await pool.prewarm()
+    while True:
+        await asyncio.sleep(max(1.0, pool.idle_ttl / 2))
+        try:
+            await pool.maintain()
+        except Exception as e:
+            log_event("browser_maintain_failed", {"error": str(e)})
+
+@app.on_event("startup")
+async def _pw_start():
+    prof = current_profile()
+    if current_settings().pw_enabled:
+        prof.browser_pool.maintenance = asyncio.get_running_loop().create_task(_browser_pool_maintenance(prof.browser_pool))
+
+@app.on_event("shutdown")
+async def _pw_stop():
+    pool = current_profile().browser_pool
+    if pool.maintenance is not None:
+        pool.maintenance.cancel()
+    await pool.close()
+
+# ================== Window index ==================
+WINDOW_CFG = CFG.get('window', {})
+
+
+def _window_key(w) -> object:
+    # handle UIA ; à défaut, l'objet lui-même (wrappers sans handle)
+    return getattr(w, "handle", None) or id(w)
+
+
+EVENT_OBJECT_CREATE, EVENT_OBJECT_DESTROY, EVENT_OBJECT_NAMECHANGE = 0x8000, 0x8001, 0x800C
+WINDOW_EVENTS = (EVENT_OBJECT_CREATE, EVENT_OBJECT_DESTROY, EVENT_OBJECT_NAMECHANGE)
+WM_QUIT = 0x0012
+
+
+class WindowIndex:
+    """Cached view of the top-level windows (title -> wrapper/handle).
+
+    UIA enumeration is slow, so lookups read a snapshot that is refreshed when
+    it is older than `ttl`, when a lookup misses, when a window create/destroy
+    event marks it dirty, or periodically by the background refresher.
+    """
+
+    def __init__(self, ttl: float = 2.0, refresh_sec: float = 1.0):
+        self.ttl = ttl
+        self.refresh_sec = refresh_sec
+        self._lock = threading.Lock()
+        self._entries: List[Tuple[str, str, object]] = []  # (lowercase title, title, wrapper)
+        self._exact: Dict[str, Tuple[str, object]] = {}
+        self._stamp = 0.0
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._hook_tid: Optional[int] = None   # thread de _event_hook (Windows), pour lui poster WM_QUIT
+        self.stats = {"refreshes": 0, "hits": 0, "misses": 0, "invalidations": 0, "events": 0}
+
+    # ---- cache maintenance ----
+    def refresh(self):
+        entries = []
+        for w in Desktop(backend="uia").windows():
+            t = w.window_text() or ""
+            if t:
+                entries.append((t.lower(), t, w))
+        exact: Dict[str, Tuple[str, object]] = {}
+        for low, t, w in entries:
+            exact.setdefault(low, (t, w))
+        with self._lock:
+            self._entries = entries
+            self._exact = exact
+            self._stamp = time.monotonic()
+            self.stats["refreshes"] += 1
+        return entries
+
+    def invalidate(self):
+        self._stamp = 0.0
+        self.stats["invalidations"] += 1
+
+    def on_window_event(self):
+        """Window created/destroyed/renamed: drop the snapshot and wake the refresher."""
+        self.stats["events"] += 1
+        self._stamp = 0.0
+        self._dirty.set()
+
+    def entries(self) -> List[Tuple[str, str, object]]:
+        if not self._stamp or time.monotonic() - self._stamp > self.ttl:
+            return self.refresh()
+        return self._entries
+
+    def handles(self) -> Dict[str, Optional[int]]:
+        return {t: getattr(w, "handle", None) for _, t, w in self.entries()}
+
+    def keys(self) -> set:
+        """Identity of every window open right now (fresh enumeration)."""
+        return {_window_key(w) for _, _, w in self.refresh()}
+
+    # ---- lookups ----
+    def _match(self, low: str, entries) -> Optional[Tuple[str, object]]:
+        hit = self._exact.get(low)
+        if hit is not None:
+            return hit
+        for l, t, w in entries:
+            if low in l:
+                return t, w
+        return None
+
+    def find(self, title: str) -> Optional[Tuple[str, object]]:
+        low = title.lower()
+        fresh = bool(self._stamp) and time.monotonic() - self._stamp <= self.ttl
+        hit = self._match(low, self.entries())
+        if hit is None and fresh:
+            # the window may have appeared since the last snapshot
+            hit = self._match(low, self.refresh())
+        self.stats["hits" if hit else "misses"] += 1
+        return hit
+
+    def focus(self, title: str) -> Tuple[str, object]:
+        hit = self.find(title)
+        if hit is None:
+            raise HTTPException(404, "window not found")
+        t, w = hit
+        try:
+            w.set_focus()
+        except Exception:
+            # stale wrapper (window closed or recreated): rebuild and retry once
+            self.invalidate()
+            hit = self.find(title)
+            if hit is None:
+                raise HTTPException(404, "window not found")
+            t, w = hit
+            w.set_focus()
+        return t, w
+
+    _MATCH_KINDS = ("exact", "prefix", "substring")
+
+    def _rank(self, candidates: List[str], entries, exclude=None) -> Optional[Tuple[Tuple[int, int, int], str, object, str]]:
+        best = None
+        for pos, (low, t, w) in enumerate(entries):
+            if exclude and _window_key(w) in exclude:
+                continue
+            for ci, cand in enumerate(candidates):
+                if low == cand:
+                    rank = 0
+                elif low.startswith(cand):
+                    rank = 1
+                elif cand in low:
+                    rank = 2
+                else:
+                    continue
+                key = (rank, ci, pos)
+                if best is None or key < best[0]:
+                    best = (key, t, w, cand)
+        return best
+
+    def resolve(self, candidates: Iterable[str], retry_on_miss: bool = True, exclude=None) -> Optional[dict]:
+        """Best window for any candidate title in a single pass over the snapshot.
+
+        Ranking: exact > prefix > substring, then candidate order, then window order.
+        Windows whose key is in `exclude` (see keys()) are skipped.
+        """
+        t0 = time.perf_counter()
+        cands: List[str] = []
+        for c in candidates:
+            low = (c or "").strip().lower()
+            if low and low not in cands:
+                cands.append(low)
+        if not cands:
+            return None
+        fresh = bool(self._stamp) and time.monotonic() - self._stamp <= self.ttl
+        entries = self.entries()
+        t1 = time.perf_counter()
+        best = self._rank(cands, entries, exclude)
+        if best is None and fresh and retry_on_miss:
+            entries = self.refresh()
+            t1 = time.perf_counter()
+            best = self._rank(cands, entries, exclude)
+        t2 = time.perf_counter()
+        self.stats["hits" if best else "misses"] += 1
+        if best is None:
+            return None
+        key, t, w, cand = best
+        return {
+            "title": t,
+            "window": w,
+            "candidate": cand,
+            "match": self._MATCH_KINDS[key[0]],
+            "scanned": len(entries),
+            "timings": {"snapshot_ms": round((t1 - t0) * 1000, 3), "match_ms": round((t2 - t1) * 1000, 3)},
+        }
+
+    def focus_best(self, candidates: Iterable[str], exclude=None) -> dict:
+        candidates = list(candidates)
+        res = self.resolve(candidates, exclude=exclude)
+        if res is None:
+            raise HTTPException(404, "window not found")
+        try:
+            res["window"].set_focus()
+        except Exception:
+            self.invalidate()
+            res = self.resolve(candidates, exclude=exclude)
+            if res is None:
+                raise HTTPException(404, "window not found")
+            res["window"].set_focus()
+        return res
+
+    # ---- background refresh ----
+    def _refresher(self):
+        while not self._stop.is_set():
+            self._dirty.wait(self.refresh_sec)
+            self._dirty.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.warning("Window index refresh failed: %s", e)
+
+    def _event_hook(self):
+        import ctypes
+        from ctypes import wintypes
+
+        user32, kernel32 = ctypes.windll.user32, ctypes.windll.kernel32
+        WINEVENT_OUTOFCONTEXT, PM_NOREMOVE = 0x0000, 0x0000
+        WinEventProc = ctypes.WINFUNCTYPE(None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+                                          wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+
+        def _callback(hook, event, hwnd, id_object, id_child, thread, ms):
+            # OBJID_WINDOW on a top-level window only; focus, moves, show/hide never change the index
+            if (event in WINDOW_EVENTS and id_object == 0 and id_child == 0 and hwnd
+                    and not user32.GetParent(hwnd)):
+                self.on_window_event()
+
+        proc = WinEventProc(_callback)
+        # create + destroy are adjacent, name change is registered on its own
+        ranges = [(EVENT_OBJECT_CREATE, EVENT_OBJECT_DESTROY), (EVENT_OBJECT_NAMECHANGE, EVENT_OBJECT_NAMECHANGE)]
+        hooks = [user32.SetWinEventHook(lo, hi, 0, proc, 0, 0, WINEVENT_OUTOFCONTEXT) for lo, hi in ranges]
+        if not all(hooks):
+            logging.warning("SetWinEventHook failed; window index relies on periodic refresh")
+            for hook in filter(None, hooks):
+                user32.UnhookWinEvent(hook)
+            return
+        msg = wintypes.MSG()
+        # la file de messages doit exister avant que stop() puisse y poster WM_QUIT
+        user32.PeekMessageW(ctypes.byref(msg), 0, 0, 0, PM_NOREMOVE)
+        self._hook_tid = kernel32.GetCurrentThreadId()
+        try:
+            while not self._stop.is_set() and user32.GetMessageW(ctypes.byref(msg), 0, 0, 0) > 0:
+                user32.TranslateMessage(ctypes.byref(msg))
+                user32.DispatchMessageW(ctypes.byref(msg))
+        finally:
+            self._hook_tid = None
+            for hook in hooks:
+                user32.UnhookWinEvent(hook)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        targets = [self._refresher]
+        if sys.platform == "win32":
+            targets.append(self._event_hook)
+        for target in targets:
+            th = threading.Thread(target=target, name=f"window-index{target.__name__}", daemon=True)
+            th.start()
+            self._threads.append(th)
+
+    def stop(self, timeout: float = 2.0):
+        self._stop.set()
+        self._dirty.set()
+        tid = self._hook_tid
+        if tid:
+            # GetMessageW ne voit pas _stop : WM_QUIT le réveille et le hook est retiré
+            import ctypes
+            ctypes.windll.user32.PostThreadMessageW(tid, WM_QUIT, 0, 0)
+        for th in self._threads:
+            th.join(timeout)
+        self._threads = []
+
+
+WINDOW_INDEX = WindowIndex(
+    ttl=float(WINDOW_CFG.get("cache_ttl", 2.0)),
+    refresh_sec=float(WINDOW_CFG.get("refresh_sec", 1.0)),
+)
+
+WAIT_WINDOW_TIMEOUT = float(WINDOW_CFG.get("wait_timeout", 10.0))
+
+
+async def wait_window(candidates: List[str], timeout: float = WAIT_WINDOW_TIMEOUT,
+                      interval: float = 0.05, max_interval: float = 0.25, exclude=None) -> dict:
+    """Poll the desktop until one of `candidates` exists; backs off from `interval` to `max_interval`.
+
+    With `exclude` (WINDOW_INDEX.keys() taken before a launch) only a window
+    that was not open then counts; if none shows up before `timeout`, an
+    already open match is returned with "new": False (single-instance apps).
+    """
+    t0 = time.monotonic()
+    polls = 0
+    while True:
+        polls += 1
+        await UI_EXECUTOR.run(WINDOW_INDEX.refresh, devices=("window",))
+        res = WINDOW_INDEX.resolve(candidates, retry_on_miss=False, exclude=exclude)
+        waited = time.monotonic() - t0
+        if res is None and exclude and waited >= timeout:
+            res = WINDOW_INDEX.resolve(candidates, retry_on_miss=False)
+            if res is not None:
+                return {"window": res["title"], "match": res["match"], "waited_ms": round(waited * 1000, 1),
+                        "polls": polls, "new": False}
+        if res is not None:
+            out = {"window": res["title"], "match": res["match"], "waited_ms": round(waited * 1000, 1), "polls": polls}
+            if exclude is not None:
+                out["new"] = True
+            return out
+        if waited >= timeout:
+            raise HTTPException(504, f"window not found after {timeout:g}s: {', '.join(candidates)}")
+        await asyncio.sleep(min(interval, max(0.0, timeout - waited)))
+        interval = min(interval * 1.5, max_interval)
+
+
+if WINDOW_CFG.get("background_refresh", True):
+    @app.on_event("startup")
+    def _window_index_start():
+        WINDOW_INDEX.start()
+
+    @app.on_event("shutdown")
+    def _window_index_stop():
+        if not RUNNING_APPS:
+            WINDOW_INDEX.stop()
+
+# ================== Screenshots ==================
+SCREENSHOT_CFG = CFG.get('screenshot', {})
+SHOT_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+# small, cheap capture for the LLM planner round trips
+SHOT_PREVIEW = {
+    "format": "jpeg",
+    "quality": int(SCREENSHOT_CFG.get("preview_quality", 60)),
+    "scale": float(SCREENSHOT_CFG.get("preview_scale", 0.25)),
+}
+
+
+class ShotBuffer:
+    """Bounded LRU of encoded captures, served from memory by `/shots/{name}`."""
+
+    def __init__(self, max_items: int = 32, max_bytes: int = 64 * 1024 * 1024):
+        self.max_items = max(1, int(max_items))
+        self.max_bytes = int(max_bytes)
+        self._items: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def put(self, name: str, data: bytes, mime: str):
+        with self._lock:
+            self._items[name] = (data, mime)
+            self._bytes += len(data)
+            while len(self._items) > 1 and (len(self._items) > self.max_items or self._bytes > self.max_bytes):
+                _, (old, _) = self._items.popitem(last=False)
+                self._bytes -= len(old)
+                self.evicted += 1
+
+    def get(self, name: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            item = self._items.get(name)
+            if item is not None:
+                self._items.move_to_end(name)
+            return item
+
+    def stats(self) -> dict:
+        return {"items": len(self._items), "bytes": self._bytes, "evicted": self.evicted}
+
+
+SHOT_BUFFER = ShotBuffer(
+    max_items=int(SCREENSHOT_CFG.get("buffer_size", 32)),
+    max_bytes=int(SCREENSHOT_CFG.get("buffer_mb", 64)) * 1024 * 1024,
+)
+
+
+def _grab(monitor: int = 0, region: Optional[Tuple[int, int, int, int]] = None):
+    """Capture a monitor (0 = all monitors) or a (left, top, width, height) region of it, in memory."""
+    with mss.mss() as sct:
+        monitors = sct.monitors
+        if not 0 <= monitor < len(monitors):
+            raise HTTPException(400, f"unknown monitor {monitor} (0..{len(monitors) - 1})")
+        area = dict(monitors[monitor])
+        if region is not None:
+            left, top, width, height = region
+            if width <= 0 or height <= 0:
+                raise HTTPException(400, "region width/height must be positive")
+            area = {"left": area["left"] + left, "top": area["top"] + top, "width": width, "height": height}
+        return sct.grab(area)
+
+
+def _encode(img, fmt: str = "png", quality: int = 80, scale: float = 1.0) -> Tuple[bytes, int, int]:
+    if fmt not in SHOT_FORMATS:
+        raise HTTPException(400, f"unsupported format {fmt}")
+    width, height = img.size
+    if not HAVE_PIL:
+        if fmt != "png" or scale != 1.0:
+            raise HTTPException(501, "jpeg/webp and scaling need Pillow (pip install pillow)")
+        from mss import tools
+        return tools.to_png(img.rgb, img.size), width, height
+    im = _to_image(img, scale)
+    return _encode_image(im, fmt, quality), im.width, im.height
+
+
+def _to_image(img, scale: float = 1.0):
+    im = Image.frombytes("RGB", img.size, img.rgb)
+    if scale != 1.0:
+        width, height = max(1, int(im.width * scale)), max(1, int(im.height * scale))
+        im = im.resize((width, height), Image.BILINEAR)
+    return im
+
+
+def _encode_image(im, fmt: str = "png", quality: int = 80) -> bytes:
+    import io
+    buf = io.BytesIO()
+    if fmt == "png":
+        im.save(buf, "PNG", compress_level=int(SCREENSHOT_CFG.get("png_level", 1)))
+    else:
+        im.save(buf, SHOT_FORMATS[fmt][0], quality=int(quality))
+    return buf.getvalue()
+
+
+def capture(monitor: int = 0, region: Optional[Tuple[int, int, int, int]] = None, fmt: str = "png",
+            quality: int = 80, scale: float = 1.0, save: bool = False) -> dict:
+    """Grab, encode and keep a capture under a unique id; written to `shots/` only when `save`."""
+    fmt = (fmt or "png").lower().replace("jpg", "jpeg")
+    scale = max(0.05, min(1.0, float(scale)))
+    t0 = time.perf_counter()
+    img = _grab(int(monitor), region)
+    t1 = time.perf_counter()
+    data, width, height = _encode(img, fmt, int(quality), scale)
+    t2 = time.perf_counter()
+    ext = "jpg" if fmt == "jpeg" else fmt
+    name = f"{uuid.uuid4().hex[:16]}.{ext}"
+    SHOT_BUFFER.put(name, data, SHOT_FORMATS[fmt][1])
+    res = {
+        "status": "ok",
+        "id": name.rsplit(".", 1)[0],
+        "url": f"/shots/{name}",
+        "format": fmt,
+        "width": width,
+        "height": height,
+        "bytes": len(data),
+        "timings": {"grab_ms": round((t1 - t0) * 1000, 2), "encode_ms": round((t2 - t1) * 1000, 2)},
+    }
+    if save:
+        path = SHOTS / name
+        path.write_bytes(data)
+        res["path"] = str(path)
+    return res
+
+
+# ---- Delta mode: only the tiles that changed since the session's previous frame ----
+def dirty_rects(prev, cur, tile: int = 32) -> List[Tuple[int, int, int, int]]:
+    """(x, y, w, h) rectangles covering the tiles that differ between two HxWx3 frames.
+
+    Each band of `tile` rows is first checked with one `array_equal`; only
+    changed bands are reduced per tile column (`logical_or.reduceat`). Dirty
+    tiles become horizontal runs per band, and runs spanning the same columns
+    on consecutive bands are merged vertically.
+    """
+    h, w = cur.shape[:2]
+    if prev is None or prev.shape != cur.shape:
+        return [(0, 0, w, h)]
+    rows, cols = -(-h // tile), -(-w // tile)
+    flat_prev, flat_cur = prev.reshape(h, -1), cur.reshape(h, -1)
+    col_starts = np.arange(0, w, tile) * cur.shape[2]
+    mask = np.zeros((rows, cols), dtype=bool)
+    for r in range(rows):
+        a, b = flat_prev[r * tile:(r + 1) * tile], flat_cur[r * tile:(r + 1) * tile]
+        if not np.array_equal(a, b):
+            mask[r] = np.logical_or.reduceat((a != b).any(axis=0), col_starts)
+
+    open_runs: Dict[Tuple[int, int], List[int]] = {}  # (col0, col1) -> [row0, row1]
+    rects: List[Tuple[Tuple[int, int], int, int]] = []
+    for r in range(rows):
+        runs = set()
+        if mask[r].any():
+            line = mask[r]
+            c = 0
+            while c < cols:
+                if line[c]:
+                    c0 = c
+                    while c < cols and line[c]:
+                        c += 1
+                    runs.add((c0, c))
+                else:
+                    c += 1
+        for span in list(open_runs):
+            if span in runs:
+                open_runs[span][1] = r + 1
+                runs.discard(span)
+            else:
+                rects.append((span, *open_runs.pop(span)))
+        for span in runs:
+            open_runs[span] = [r, r + 1]
+    rects.extend((span, *rr) for span, rr in open_runs.items())
+
+    out = []
+    for (c0, c1), r0, r1 in sorted(rects, key=lambda x: (x[1], x[0])):
+        x, y = c0 * tile, r0 * tile
+        out.append((x, y, min(c1 * tile, w) - x, min(r1 * tile, h) - y))
+    return out
+
+
+class FrameSessions:
+    """Last frame (and its hash) per client session, bounded LRU."""
+
+    def __init__(self, max_sessions: int = 16):
+        self.max_sessions = max(1, int(max_sessions))
+        self._frames: "OrderedDict[str, Tuple[object, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def swap(self, session: str, frame, digest: str):
+        with self._lock:
+            prev = self._frames.pop(session, None)
+            self._frames[session] = (frame, digest)
+            while len(self._frames) > self.max_sessions:
+                self._frames.popitem(last=False)
+        return prev
+
+    def drop(self, session: str):
+        with self._lock:
+            self._frames.pop(session, None)
+
+
+FRAME_SESSIONS = FrameSessions(int(SCREENSHOT_CFG.get("delta_sessions", 16)))
+
+
+def capture_delta(session: str, monitor: int = 0, region: Optional[Tuple[int, int, int, int]] = None,
+                  fmt: str = "png", quality: int = 80, scale: float = 1.0, tile: int = 32) -> dict:
+    """Capture and return only the rectangles that changed since this session's last frame.
+
+    Each client needs its own `session`: a shared one would diff against
+    another client's frame.
+    """
+    if not (HAVE_NUMPY and HAVE_PIL):
+        raise HTTPException(501, "delta screenshots need numpy and Pillow")
+    fmt = (fmt or "png").lower().replace("jpg", "jpeg")
+    if fmt not in SHOT_FORMATS:
+        raise HTTPException(400, f"unsupported format {fmt}")
+    tile = max(8, min(256, int(tile)))
+    scale = max(0.05, min(1.0, float(scale)))
+    t0 = time.perf_counter()
+    img = _grab(int(monitor), region)
+    if scale == 1.0:
+        frame = np.frombuffer(img.rgb, dtype=np.uint8).reshape(img.size[1], img.size[0], 3)
+    else:
+        frame = np.asarray(_to_image(img, scale))
+    digest = hashlib.sha1(frame.data).hexdigest()
+    t1 = time.perf_counter()
+    prev = FRAME_SESSIONS.swap(session, frame, digest)
+    if prev is not None and prev[1] == digest:
+        rects = []
+    else:
+        rects = dirty_rects(prev[0] if prev else None, frame, tile)
+    t2 = time.perf_counter()
+    out, total = [], 0
+    for x, y, w, h in rects:
+        data = _encode_image(Image.fromarray(frame[y:y + h, x:x + w]), fmt, quality)
+        total += len(data)
+        out.append({"x": x, "y": y, "w": w, "h": h, "data": base64.b64encode(data).decode("ascii")})
+    t3 = time.perf_counter()
+    return {
+        "status": "ok",
+        "mode": "full" if prev is None or prev[0].shape != frame.shape else "delta",
+        "session": session,
+        "hash": digest,
+        "previous_hash": prev[1] if prev else None,
+        "width": frame.shape[1],
+        "height": frame.shape[0],
+        "format": fmt,
+        "rects": out,
+        "bytes": total,
+        "timings": {
+            "grab_ms": round((t1 - t0) * 1000, 2),
+            "diff_ms": round((t2 - t1) * 1000, 2),
+            "encode_ms": round((t3 - t2) * 1000, 2),
+        },
+    }
+
+
+def _region(left: Optional[int], top: Optional[int], width: Optional[int], height: Optional[int]):
+    if width is None and height is None:
+        return None
+    if width is None or height is None:
+        raise HTTPException(400, "region needs both width and height")
+    return (int(left or 0), int(top or 0), int(width), int(height))
+
+# ---- Live streaming: one capture loop per (monitor, quality, scale), shared by all viewers ----
+STREAM_MAX_FPS = float(SCREENSHOT_CFG.get("stream_max_fps", 15))
+
+
+class _StreamSubscriber:
+    def __init__(self, fps: float):
+        self.fps = max(0.1, min(STREAM_MAX_FPS, float(fps)))
+        self.frame: Optional[bytes] = None
+        self.ready = asyncio.Event()
+        self.last_push = 0.0
+        self.sent = 0
+        self.dropped = 0
+
+    def push(self, frame: bytes, now: float):
+        if now - self.last_push < 1.0 / self.fps:
+            return
+        if self.frame is not None:
+            self.dropped += 1  # viewer is behind: replace, never queue
+        self.frame = frame
+        self.last_push = now
+        self.ready.set()
+
+    async def next_frame(self) -> bytes:
+        await self.ready.wait()
+        self.ready.clear()
+        frame, self.frame = self.frame, None
+        self.sent += 1
+        return frame
+
+
+class ScreenStream:
+    """Captures JPEG frames at the fastest rate any subscriber asked for and fans them out."""
+
+    def __init__(self, monitor: int, quality: int, scale: float):
+        self.monitor, self.quality, self.scale = monitor, quality, scale
+        self.key = (monitor, quality, scale)
+        self.subscribers: List[_StreamSubscriber] = []
+        self.frames = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, fps: float) -> _StreamSubscriber:
+        sub = _StreamSubscriber(fps)
+        self.subscribers.append(sub)
+        SCREEN_STREAMS.setdefault(self.key, self)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+        return sub
+
+    def unsubscribe(self, sub: _StreamSubscriber):
+        if sub in self.subscribers:
+            self.subscribers.remove(sub)
+        if not self.subscribers and SCREEN_STREAMS.get(self.key) is self:
+            # dernier spectateur parti : la boucle de capture s'arrête, l'entrée disparaît avec elle
+            del SCREEN_STREAMS[self.key]
+
+    def _grab_jpeg(self) -> bytes:
+        return _encode(_grab(self.monitor), "jpeg", self.quality, self.scale)[0]
+
+    async def _loop(self):
+        while self.subscribers:
+            t0 = time.monotonic()
+            try:
+                frame = await UI_EXECUTOR.run(self._grab_jpeg)
+            except Exception as e:
+                log_event("screen_stream_error", {"monitor": self.monitor, "error": str(e)})
+                frame = None
+            if frame is not None:
+                self.frames += 1
+                now = time.monotonic()
+                for sub in list(self.subscribers):
+                    sub.push(frame, now)
+            interval = 1.0 / max(sub.fps for sub in self.subscribers) if self.subscribers else 0
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - t0)))
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "frames": self.frames,
+            "sent": sum(s.sent for s in self.subscribers),
+            "dropped": sum(s.dropped for s in self.subscribers),
+        }
+
+
+SCREEN_STREAMS: Dict[Tuple[int, int, float], ScreenStream] = {}
+# échelles proposées aux flux : celle du client est ramenée à la plus proche pour borner les clés
+STREAM_SCALES = (0.25, 0.5, 0.75, 1.0)
+
+
+def _screen_stream(monitor: int, quality: int, scale: float) -> ScreenStream:
+    if not current_settings().feat.get("screenshot", True):
+        raise HTTPException(403, "screenshot disabled")
+    scale = min(STREAM_SCALES, key=lambda s: abs(s - float(scale)))
+    key = (int(monitor), max(1, min(100, int(quality))), scale)
+    stream = SCREEN_STREAMS.get(key)
+    if stream is None:
+        stream = SCREEN_STREAMS[key] = ScreenStream(*key)
+    return stream
+
+
+# ================== Text injection ==================
+TEXT_CFG = CFG.get('text', {})
+TEXT_STRATEGIES = ("direct", "chunked", "clipboard")
+
+
+class TextInjector:
+    """One way to put text into the focused window, for every typing path.
+
+    - direct: one `typewrite` call (short ASCII text, and single keys like "\\r");
+    - chunked: `typewrite` in `chunk_size` slices with `chunk_interval` between keys,
+      stopping at the next slice if panic mode is switched on;
+    - clipboard: copy + ctrl+v, the previous clipboard restored after `restore_delay`
+      (non-ASCII, multi-line or longer than `chunk_max`); texts beyond `paste_chunk`
+      chars are pasted in several pieces.
+    `on_progress(dict)` is called after each slice / piece. Characters per second
+    are tracked per strategy.
+    """
+
+    def __init__(self, cfg: Dict):
+        self.direct_max = int(cfg.get("direct_max", 64))
+        self.chunk_max = int(cfg.get("chunk_max", 100))
+        self.chunk_size = max(1, int(cfg.get("chunk_size", 50)))
+        self.chunk_interval = float(cfg.get("chunk_interval", 0.0))
+        self.restore = bool(cfg.get("clipboard_restore", True))
+        self.restore_delay = float(cfg.get("restore_delay", 0.15))
+        self.paste_chunk = max(1, int(cfg.get("paste_chunk", 20000)))
+        self._lock = threading.Lock()
+        self.counters = {k: {"calls": 0, "chars": 0, "seconds": 0.0} for k in TEXT_STRATEGIES}
+
+    def choose(self, text: str) -> str:
+        if not text.isascii() or len(text) > self.chunk_max or (len(text) > 1 and ("\n" in text or "\r" in text)):
+            return "clipboard"
+        return "direct" if len(text) <= self.direct_max else "chunked"
+
+    def devices(self, text: str, strategy: Optional[str] = None) -> Tuple[str, ...]:
+        return ("clipboard", "keyboard") if (strategy or self.choose(text)) == "clipboard" else ("keyboard",)
+
+    @staticmethod
+    def _slices(text: str, size: int) -> List[str]:
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    @staticmethod
+    def _progress(on_progress, done: int, total: int, n: int, count: int):
+        if on_progress:
+            on_progress({"chars_done": done, "chars_total": total, "chunk": n + 1, "chunks": count})
+
+    def _chunked(self, text: str, on_progress=None):
+        chunks = self._slices(text, self.chunk_size)
+        done = 0
+        for n, chunk in enumerate(chunks):
+            if current_profile().disabled:
+                raise HTTPException(423, f"panic mode: typing stopped after {done} chars")
+            # pyautogui.PAUSE only after the last slice
+            pyautogui.typewrite(chunk, interval=self.chunk_interval, _pause=n == len(chunks) - 1)
+            done += len(chunk)
+            self._progress(on_progress, done, len(text), n, len(chunks))
+
+    def _clipboard(self, text: str, on_progress=None):
+        previous = None
+        if self.restore:
+            try:
+                previous = pyperclip.paste()
+            except Exception:
+                previous = None
+        pieces = self._slices(text, self.paste_chunk)
+        done = 0
+        try:
+            for n, piece in enumerate(pieces):
+                if n:
+                    if current_profile().disabled:
+                        raise HTTPException(423, f"panic mode: paste stopped after {done} chars")
+                    time.sleep(self.restore_delay)   # l'appli doit avoir lu le morceau précédent
+                pyperclip.copy(piece)
+                pyautogui.hotkey("ctrl", "v")
+                done += len(piece)
+                self._progress(on_progress, done, len(text), n, len(pieces))
+        finally:
+            if previous is not None:
+                time.sleep(self.restore_delay)   # laisse l'appli lire le presse-papier avant de le restaurer
+                pyperclip.copy(previous)
+
+    def inject(self, text: str, strategy: Optional[str] = None, on_progress=None) -> dict:
+        strategy = strategy or self.choose(text)
+        if strategy not in TEXT_STRATEGIES:
+            raise HTTPException(422, f"unknown strategy {strategy}")
+        t0 = time.perf_counter()
+        if strategy == "direct":
+            pyautogui.typewrite(text)
+        elif strategy == "chunked":
+            self._chunked(text, on_progress)
+        else:
+            self._clipboard(text, on_progress)
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            c = self.counters[strategy]
+            c["calls"] += 1; c["chars"] += len(text); c["seconds"] += elapsed
+        return {"strategy": strategy, "chars": len(text), "elapsed_ms": round(elapsed * 1000, 3),
+                "cps": round(len(text) / elapsed, 1) if elapsed > 0 else None}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {k: {"calls": c["calls"], "chars": c["chars"],
+                        "cps": round(c["chars"] / c["seconds"], 1) if c["seconds"] > 0 else None}
+                    for k, c in self.counters.items()}
+
+
+TEXT_INJECTOR = TextInjector(TEXT_CFG)
+
+
+# ================== Actions (shared by routes and in-process dispatch) ==================
+def _act_mouse_move(x: int, y: int, duration: Optional[float] = None):
+    require_enabled()
+    if not current_settings().feat.get('mouse',True): raise HTTPException(403,"mouse disabled")
+    pyautogui.moveTo(int(x),int(y),duration=MOVE_DURATION if duration is None else float(duration))
     return {"status":"ok"}
 
-@app.get("/os/mouse/click")
-def mouse_click(request: Request, button:str="left", clicks:int=1):
-    auth(request); require_enabled()
-    if not FEAT.get('mouse',True): raise HTTPException(403,"mouse disabled")
+def _act_mouse_click(button: str = "left", clicks: int = 1):
+    require_enabled()
+    if not current_settings().feat.get('mouse',True): raise HTTPException(403,"mouse disabled")
     pyautogui.click(button=button, clicks=int(clicks))
     return {"status":"ok"}
 
-@app.get("/os/clipboard/set")
-def cb_set(request: Request, text: str = Query("")):
-    auth(request); require_enabled()
+def _act_clipboard_set(text: str = ""):
+    require_enabled()
     pyperclip.copy(text or "")
     return {"status": "ok", "len": len(text or "")}
 
-@app.get("/os/keyboard/paste")
-def kb_paste(request: Request):
-    auth(request); require_enabled()
+def _act_keyboard_paste():
+    require_enabled()
     pyautogui.hotkey('ctrl', 'v')
     return {"status":"ok","action":"paste"}
 
-@app.get("/os/keyboard/type")
-def kb_type(request: Request, text:str=Query("")):
-    auth(request); require_enabled()
-    if not FEAT.get('keyboard',True): raise HTTPException(403,"keyboard disabled")
-    pyautogui.typewrite(text)
-    return {"status":"ok"}
+def _act_keyboard_type(text: str = "", strategy: Optional[str] = None, on_progress=None):
+    require_enabled()
+    if not current_settings().feat.get('keyboard',True): raise HTTPException(403,"keyboard disabled")
+    return {"status":"ok", **TEXT_INJECTOR.inject(text, strategy, on_progress)}
 
-@app.get("/os/keyboard/hotkey")
-def kb_hotkey(request: Request, keys:str=Query(...)):
-    auth(request); require_enabled()
-    if not FEAT.get('keyboard',True): raise HTTPException(403,"keyboard disabled")
+def _act_keyboard_hotkey(keys: str):
+    require_enabled()
+    if not current_settings().feat.get('keyboard',True): raise HTTPException(403,"keyboard disabled")
     parts = [k.strip() for k in keys.split('+') if k.strip()]
     pyautogui.hotkey(*parts)
     return {"status":"ok","keys":parts}
 
+def _act_window_activate(title: str):
+    require_enabled()
+    if not current_settings().feat.get('window',True): raise HTTPException(403,"window feature disabled")
+    res = WINDOW_INDEX.focus_best([title] + WINDOW_TITLES.get(resolve_app(title), []))
+    return {"status":"ok","window":res["title"],"match":res["match"],"timings":res["timings"]}
+
+async def _act_window_wait(title: str, timeout: float = WAIT_WINDOW_TIMEOUT):
+    require_enabled()
+    if not current_settings().feat.get('window',True): raise HTTPException(403,"window feature disabled")
+    res = await wait_window([title] + WINDOW_TITLES.get(resolve_app(title), []), timeout=float(timeout))
+    return {"status":"ok", **res}
+
+def _act_window_click_center(title: str):
+    require_enabled()
+    t, w = WINDOW_INDEX.focus(title)
+    rect = w.rectangle()
+    cx,cy = (rect.left+rect.right)//2,(rect.top+rect.bottom)//2
+    pyautogui.moveTo(cx,cy,duration=MOVE_DURATION); pyautogui.click()
+    return {"status":"ok","window":t,"x":cx,"y":cy}
+
+def _act_screenshot(monitor: int = 0, left: Optional[int] = None, top: Optional[int] = None,
+                    width: Optional[int] = None, height: Optional[int] = None, format: str = "png",
+                    quality: int = 80, scale: float = 1.0, save: bool = False, delta: bool = False,
+                    session: Optional[str] = None, tile: int = 32):
+    if not current_settings().feat.get('screenshot',True): raise HTTPException(403,"screenshot disabled")
+    if delta:
+        if not session: raise HTTPException(422,"session required for delta screenshots")
+        return capture_delta(session, monitor, _region(left, top, width, height), format, quality, scale, tile)
+    return capture(monitor, _region(left, top, width, height), format, quality, scale, save)
+
+# exécutables de l'allowlist déjà trouvés dans le PATH ; vidé quand la config est rechargée
+_EXE_PATHS: Dict[str, str] = {}
+
+def resolve_exe(exe: str) -> Optional[str]:
+    path = _EXE_PATHS.get(exe)
+    if path is None:
+        path = shutil.which(exe)
+        if path:
+            _EXE_PATHS[exe] = path
+    return path
+
+def _act_app_run(name: str):
+    require_enabled()
+    if not current_settings().feat.get('run_apps',True): raise HTTPException(403,"run apps disabled")
+    allow = current_settings().allow
+    if name not in allow: raise HTTPException(403,f"{name} not in allowlist")
+    cmd = allow[name]; exe=cmd[0]
+    if not resolve_exe(exe): raise HTTPException(404,f"not found: {exe}")
+    subprocess.Popen(cmd); return {"status":"ok","launched":cmd}
+
+def _act_browser_open(url: str):
+    require_enabled()
+    if not current_settings().feat.get('browser_open',True): raise HTTPException(403,"browser_open disabled")
+    import webbrowser
+    if not url.startswith("http"): url="https://"+url
+    webbrowser.open_new_tab(url)
+    return {"status":"ok","opened":url}
+
+# Route path -> (action, devices it drives, or a function of the params giving them);
+# also used by the LLM planner to skip the HTTP loopback.
+LOCAL_ACTIONS = {
+    "/os/mouse/move": (_act_mouse_move, ("mouse",)),
+    "/os/mouse/click": (_act_mouse_click, ("mouse",)),
+    "/os/clipboard/set": (_act_clipboard_set, ("clipboard",)),
+    "/os/keyboard/paste": (_act_keyboard_paste, ("keyboard",)),
+    "/os/keyboard/type": (_act_keyboard_type, lambda text="", strategy=None, **_: TEXT_INJECTOR.devices(text, strategy)),
+    "/os/keyboard/hotkey": (_act_keyboard_hotkey, ("keyboard",)),
+    "/window/activate": (_act_window_activate, ("window",)),
+    "/window/wait": (_act_window_wait, ()),
+    "/window/click_center": (_act_window_click_center, ("window", "mouse")),
+    "/screen/screenshot": (_act_screenshot, ()),
+    "/app/run": (_act_app_run, ()),
+    "/browser/open": (_act_browser_open, ()),
+}
+
+async def run_action(path: str, **params):
+    """Execute a route's action: coroutines inline, blocking ones on the UI executor."""
+    fn, devices = LOCAL_ACTIONS[path]
+    if callable(devices):
+        devices = devices(**params)
+    async with INPUT_SCHEDULER.lease(devices, owner=path):
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(**params)
+        return await UI_EXECUTOR.run(fn, devices=devices, **params)
+
+async def call_local(path: str, params: Optional[dict] = None) -> Tuple[bool, int, dict]:
+    """Run the action behind a route in-process; mirrors the (ok, status, data) of an HTTP call."""
+    if path not in LOCAL_ACTIONS:
+        return False, 404, {"detail": f"unknown local action {path}"}
+    try:
+        data = await run_action(path, **(params or {}))
+    except HTTPException as e:
+        return False, e.status_code, {"detail": e.detail}
+    return True, 200, data
+
+# OS: mouse / keyboard / clipboard
+@app.get("/os/mouse/move")
+async def mouse_move(request: Request, x:int=Query(...), y:int=Query(...),
+                     duration:Optional[float]=Query(None, ge=0, le=5)):
+    auth(request)
+    return await run_action("/os/mouse/move", x=x, y=y, duration=duration)
+
+@app.get("/os/mouse/click")
+async def mouse_click(request: Request, button:str="left", clicks:int=1):
+    auth(request)
+    return await run_action("/os/mouse/click", button=button, clicks=clicks)
+
+@app.get("/os/clipboard/set")
+async def cb_set(request: Request, text: str = Query("")):
+    auth(request)
+    return await run_action("/os/clipboard/set", text=text)
+
+TEXT_MAX_BODY = int(float(TEXT_CFG.get("max_body_mb", 16)) * 1024 * 1024)
+
+async def read_text_body(request: Request) -> Tuple[str, dict]:
+    """Text of a POST body, read as a stream: JSON {"text": ..., "strategy": ...} or raw text/plain."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > TEXT_MAX_BODY:
+        raise HTTPException(413, f"body larger than {TEXT_MAX_BODY} bytes")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > TEXT_MAX_BODY:
+            raise HTTPException(413, f"body larger than {TEXT_MAX_BODY} bytes")
+    ctype = request.headers.get("content-type", "").lower()
+    if ctype.startswith("application/json"):
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(400, f"invalid JSON body: {e}")
+        if not isinstance(data, dict) or not isinstance(data.get("text"), str):
+            raise HTTPException(422, 'JSON body must be {"text": "..."}')
+        return data["text"], {k: data[k] for k in ("strategy",) if data.get(k)}
+    charset = ctype.split("charset=", 1)[1].split(";")[0].strip() if "charset=" in ctype else "utf-8"
+    try:
+        return body.decode(charset), {}
+    except (LookupError, UnicodeDecodeError) as e:
+        raise HTTPException(400, f"cannot decode body: {e}")
+
+@app.post("/os/clipboard/set")
+async def cb_set_body(request: Request):
+    auth(request)
+    text, _ = await read_text_body(request)
+    return await run_action("/os/clipboard/set", text=text)
+
+@app.get("/os/keyboard/paste")
+async def kb_paste(request: Request):
+    auth(request)
+    return await run_action("/os/keyboard/paste")
+
+@app.get("/os/keyboard/type")
+async def kb_type(request: Request, text:str=Query(""), strategy: Optional[Literal["direct","chunked","clipboard"]]=Query(None)):
+    auth(request)
+    return await run_action("/os/keyboard/type", text=text, strategy=strategy)
+
+@app.post("/os/keyboard/type")
+async def kb_type_body(request: Request, strategy: Optional[Literal["direct","chunked","clipboard"]]=Query(None),
+                       progress: bool = Query(False)):
+    """Same as GET, text in the body; `progress=1` answers SSE `progress` events, then `done`."""
+    auth(request)
+    text, opts = await read_text_body(request)
+    strategy = opts.get("strategy") or strategy
+    if not progress:
+        return await run_action("/os/keyboard/type", text=text, strategy=strategy)
+
+    async def work(emit):
+        loop = asyncio.get_running_loop()
+        report = lambda data: loop.call_soon_threadsafe(emit, "progress", data)   # appelé depuis le thread UI
+        return await run_action("/os/keyboard/type", text=text, strategy=strategy, on_progress=report)
+    return sse_response(work)
+
+@app.get("/os/keyboard/hotkey")
+async def kb_hotkey(request: Request, keys:str=Query(...)):
+    auth(request)
+    return await run_action("/os/keyboard/hotkey", keys=keys)
+
+# Batch of primitive actions: validated once, run in one hop on the UI executor
+# action -> (feature flag, required args)
+BATCH_ACTIONS = {
+    "move": ("mouse", ("x", "y")),
+    "click": ("mouse", ()),
+    "type": ("keyboard", ("text",)),
+    "hotkey": ("keyboard", ("keys",)),
+    "paste": ("keyboard", ()),
+    "wait_ms": (None, ("ms",)),
+    "screenshot": ("screenshot", ()),
+}
+SHOT_ARGS = ("monitor", "left", "top", "width", "height", "format", "quality", "scale", "save", "delta", "session", "tile")
+OS_BATCH_MAX = int(INPUT_CFG.get("max_batch", 200))
+# les pauses gardent les périphériques réservés : budget total par batch (chaque wait_ms reste <= PLAN_SLEEP_MAX)
+OS_BATCH_WAIT_BUDGET_MS = float(INPUT_CFG.get("batch_wait_budget_ms", 10000))
+# argument -> accepted type, checked before any device is leased
+BATCH_ARG_TYPES = {
+    **dict.fromkeys(("x", "y", "clicks", "ms", "duration", "monitor", "left", "top", "width", "height",
+                     "quality", "scale", "tile"), (int, float)),
+    **dict.fromkeys(("text", "keys", "button", "strategy", "format", "session"), str),
+    **dict.fromkeys(("save", "delta"), bool),
+}
+
+class OsBatch(BaseModel):
+    actions: List[dict]
+    stop_on_error: bool = True
+
+def _batch_devices(a: dict) -> Tuple[str, ...]:
+    kind = a["action"]
+    if kind in ("move", "click"):
+        return ("mouse",)
+    if kind == "type":
+        return TEXT_INJECTOR.devices(a["text"], a.get("strategy"))
+    if kind == "hotkey":
+        return ("keyboard",)
+    if kind == "paste":
+        return ("clipboard", "keyboard") if "text" in a else ("keyboard",)
+    return ()
+
+def _validate_batch(actions: List[dict]):
+    if len(actions) > OS_BATCH_MAX:
+        raise HTTPException(413, f"too many actions (max {OS_BATCH_MAX})")
+    waited = 0.0
+    for i, a in enumerate(actions):
+        spec = BATCH_ACTIONS.get(a.get("action"))
+        if spec is None:
+            raise HTTPException(422, f"action {i}: unknown action {a.get('action')!r}")
+        feature, required = spec
+        missing = [k for k in required if k not in a]
+        if missing:
+            raise HTTPException(422, f"action {i}: missing {', '.join(missing)}")
+        for k, v in a.items():
+            types = BATCH_ARG_TYPES.get(k)
+            if types is None or (v is None and k not in required):
+                continue
+            if not isinstance(v, types) or (isinstance(v, bool) and types is not bool):
+                raise HTTPException(422, f"action {i}: invalid {k}")
+        if a.get("delta") and not a.get("session"):
+            raise HTTPException(422, f"action {i}: session required for delta screenshots")
+        if a["action"] == "wait_ms":
+            if not 0 <= a["ms"] <= PLAN_SLEEP_MAX * 1000:
+                raise HTTPException(422, f"action {i}: ms must be between 0 and {PLAN_SLEEP_MAX * 1000:g}")
+            waited += a["ms"]
+            if waited > OS_BATCH_WAIT_BUDGET_MS:
+                raise HTTPException(422, f"action {i}: total wait exceeds {OS_BATCH_WAIT_BUDGET_MS:g} ms")
+        if feature and not current_settings().feat.get(feature, True):
+            raise HTTPException(403, f"action {i}: {feature} disabled")
+
+def _run_batch_action(a: dict):
+    kind = a["action"]
+    if kind == "move":
+        pyautogui.moveTo(int(a["x"]), int(a["y"]), duration=float(a.get("duration", MOVE_DURATION)))
+        return {"x": int(a["x"]), "y": int(a["y"])}
+    if kind == "click":
+        if "x" in a and "y" in a:
+            pyautogui.click(int(a["x"]), int(a["y"]), button=a.get("button", "left"), clicks=int(a.get("clicks", 1)))
+        else:
+            pyautogui.click(button=a.get("button", "left"), clicks=int(a.get("clicks", 1)))
+        return {}
+    if kind == "type":
+        return TEXT_INJECTOR.inject(str(a["text"]), a.get("strategy"))
+    if kind == "hotkey":
+        keys = [k.strip() for k in str(a["keys"]).split("+") if k.strip()]
+        pyautogui.hotkey(*keys)
+        return {"keys": keys}
+    if kind == "paste":
+        if "text" in a:
+            return TEXT_INJECTOR.inject(str(a["text"]), "clipboard")
+        pyautogui.hotkey("ctrl", "v")
+        return {}
+    if kind == "wait_ms":
+        time.sleep(max(0.0, min(float(a["ms"]), PLAN_SLEEP_MAX * 1000)) / 1000)
+        return {}
+    return _act_screenshot(**{k: a[k] for k in SHOT_ARGS if k in a})
+
+def _run_batch(actions: List[dict], stop_on_error: bool) -> List[dict]:
+    out = []
+    for i, a in enumerate(actions):
+        t0 = time.perf_counter()
+        try:
+            if current_profile().disabled:
+                raise HTTPException(423, "Server disabled (panic mode)")
+            res = {"index": i, "action": a["action"], "ok": True, "result": _run_batch_action(a)}
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            res = {"index": i, "action": a["action"], "ok": False, "error": detail}
+        res["duration_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        out.append(res)
+        if not res["ok"] and stop_on_error:
+            break
+    return out
+
+@app.post("/os/batch")
+async def os_batch(request: Request, payload: OsBatch = Body(...)):
+    auth(request); require_enabled()
+    t0 = time.perf_counter()
+    _validate_batch(payload.actions)
+    devices = set().union(*(_batch_devices(a) for a in payload.actions))
+    async with INPUT_SCHEDULER.lease(devices, owner="/os/batch"):
+        results = await UI_EXECUTOR.run(_run_batch, payload.actions, payload.stop_on_error, devices=tuple(devices))
+    return {"ok": len(results) == len(payload.actions) and all(r["ok"] for r in results),
+            "results": results, "total_ms": round((time.perf_counter() - t0) * 1000, 3)}
+
+# ================== Control channel (WebSocket) ==================
+# op -> (feature it needs, required fields); the channel skips pyautogui.PAUSE
+CONTROL_OPS = {
+    "move": ("mouse", ("x", "y")),
+    "move_rel": ("mouse", ("dx", "dy")),
+    "down": ("mouse", ()),
+    "up": ("mouse", ()),
+    "key_down": ("keyboard", ("key",)),
+    "key_up": ("keyboard", ("key",)),
+    "scroll": ("mouse", ()),
+    "ping": (None, ()),
+}
+CONTROL_MOVES = ("move", "move_rel")
+CONTROL_NUMBERS = ("x", "y", "dx", "dy")
+CONTROL_STATS = {"sessions": 0, "active": 0, "events": 0, "coalesced": 0, "errors": 0, "batches": 0, "apply_ms": 0.0}
+
+def _control_event(raw, received: float) -> dict:
+    """Normalise one incoming event; problems are kept in ev["error"] and acked as such."""
+    if not isinstance(raw, dict):
+        return {"seq": None, "op": None, "_t": received, "error": "event must be an object"}
+    ev = dict(raw, _t=received)
+    spec = CONTROL_OPS.get(ev.get("op"))
+    if spec is None:
+        ev["error"] = f"unknown op {ev.get('op')!r}"
+        return ev
+    feature, required = spec
+    missing = [k for k in required if k not in ev]
+    if missing:
+        ev["error"] = f"missing {', '.join(missing)}"
+        return ev
+    for k in CONTROL_NUMBERS:
+        if k in ev:
+            v = ev[k]
+            try:
+                if isinstance(v, bool) or not isinstance(v, (int, float)):
+                    raise TypeError
+                ev[k] = int(v)
+            except (TypeError, ValueError, OverflowError):
+                ev["error"] = f"{k} must be a number"
+                return ev
+    if feature and not current_settings().feat.get(feature, True):
+        ev["error"] = f"{feature} disabled"
+    return ev
+
+def _coalesce_moves(events: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """Fold each run of pending moves into one: an absolute move supersedes
+    whatever precedes it, relative moves add up. Returns (to run, superseded)."""
+    out, dropped = [], []
+    for ev in events:
+        last = out[-1] if out else None
+        if (last is None or ev.get("op") not in CONTROL_MOVES or last.get("op") not in CONTROL_MOVES
+                or "error" in ev or "error" in last):
+            out.append(ev)
+            continue
+        if ev["op"] == "move_rel":
+            if last["op"] == "move":
+                ev = dict(ev, op="move", x=int(last["x"]) + int(ev["dx"]), y=int(last["y"]) + int(ev["dy"]))
+            else:
+                ev = dict(ev, dx=int(last["dx"]) + int(ev["dx"]), dy=int(last["dy"]) + int(ev["dy"]))
+        dropped.append(last)
+        out[-1] = ev
+    return out, dropped
+
+def _control_apply(ev: dict):
+    op = ev["op"]
+    if op == "move":
+        pyautogui.moveTo(int(ev["x"]), int(ev["y"]), duration=0, _pause=False)
+    elif op == "move_rel":
+        pyautogui.moveRel(int(ev["dx"]), int(ev["dy"]), duration=0, _pause=False)
+    elif op == "down":
+        pyautogui.mouseDown(button=ev.get("button", "left"), _pause=False)
+    elif op == "up":
+        pyautogui.mouseUp(button=ev.get("button", "left"), _pause=False)
+    elif op == "key_down":
+        pyautogui.keyDown(str(ev["key"]), _pause=False)
+    elif op == "key_up":
+        pyautogui.keyUp(str(ev["key"]), _pause=False)
+    elif op == "scroll":
+        if ev.get("dy"):
+            pyautogui.scroll(int(ev["dy"]), _pause=False)
+        if ev.get("dx"):
+            pyautogui.hscroll(int(ev["dx"]), _pause=False)
+
+def _control_run(events: List[dict]) -> List[Optional[str]]:
+    errors = []
+    for ev in events:
+        err = ev.get("error")
+        if err is None and current_profile().disabled and ev["op"] != "ping":
+            err = "CopilotPC is disabled (panic mode)"
+        if err is None:
+            try:
+                _control_apply(ev)
+            except Exception as e:
+                err = str(e)
+        errors.append(err)
+    return errors
+
+def _control_release(held: set):
+    # touches/boutons restés enfoncés quand le client se déconnecte
+    for kind, name in held:
+        try:
+            if kind == "key":
+                pyautogui.keyUp(name, _pause=False)
+            else:
+                pyautogui.mouseUp(button=name, _pause=False)
+        except Exception:
+            pass
+
+def _control_track(held: set, ev: dict):
+    op = ev["op"]
+    if op in ("key_down", "key_up"):
+        item = ("key", str(ev["key"]))
+    elif op in ("down", "up"):
+        item = ("button", ev.get("button", "left"))
+    else:
+        return
+    (held.add if op in ("key_down", "down") else held.discard)(item)
+
+@app.websocket("/ws/control")
+async def control_ws(ws: WebSocket, coalesce: bool = True):
+    try:
+        auth(ws)
+    except HTTPException as e:
+        await ws.close(code=1008, reason=str(e.detail))
+        return
+    await ws.accept()
+    pending: deque = deque()
+    wake = asyncio.Event()
+    held: set = set()
+    CONTROL_STATS["sessions"] += 1; CONTROL_STATS["active"] += 1
+
+    async def receiver():
+        # a message is one event or a list of events
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                return
+            now = time.perf_counter()
+            try:
+                data = json.loads(msg.get("text") or msg.get("bytes") or b"")
+            except ValueError:
+                data = [None]
+            for raw in data if isinstance(data, list) else [data]:
+                pending.append(_control_event(raw, now))
+            wake.set()
+
+    async def worker():
+        try:
+            await work()
+        except Exception as e:
+            # a bug must not leave the client waiting for acks that never come
+            log_event("control_ws_error", {"error": str(e)})
+            await ws.close(code=1011, reason="internal error")
+
+    async def work():
+        # moves queued behind a slow injection are coalesced before they run
+        while True:
+            await wake.wait()
+            wake.clear()
+            events = list(pending); pending.clear()
+            run, dropped = _coalesce_moves(events) if coalesce else (events, [])
+            devices = {CONTROL_OPS[e["op"]][0] for e in run if "error" not in e} - {None}
+            t0 = time.perf_counter()
+            try:
+                if devices:
+                    async with INPUT_SCHEDULER.lease(devices, owner="/ws/control"):
+                        errors = await UI_EXECUTOR.run(_control_run, run, devices=tuple(devices))
+                else:
+                    errors = _control_run(run)
+            except HTTPException as e:
+                errors = [e.detail] * len(run)
+            CONTROL_STATS["batches"] += 1
+            CONTROL_STATS["apply_ms"] += (time.perf_counter() - t0) * 1000
+            CONTROL_STATS["events"] += len(events); CONTROL_STATS["coalesced"] += len(dropped)
+            for ev in dropped:
+                await ws.send_json({"ack": ev.get("seq"), "ok": True, "coalesced": True})
+            done = time.perf_counter()
+            for ev, err in zip(run, errors):
+                ack = {"ack": ev.get("seq"), "ok": err is None, "ms": round((done - ev["_t"]) * 1000, 3)}
+                if err is None:
+                    _control_track(held, ev)
+                else:
+                    ack["error"] = err
+                    CONTROL_STATS["errors"] += 1
+                await ws.send_json(ack)
+
+    tasks = [asyncio.ensure_future(receiver()), asyncio.ensure_future(worker())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in tasks:
+            t.cancel()
+        CONTROL_STATS["active"] -= 1
+        # submitted before any await: a cancelled session still lets go of its keys
+        release = UI_EXECUTOR.submit(_control_release, set(held), devices=("keyboard", "mouse")) if held else None
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if release is not None:
+            await asyncio.wrap_future(release)
+
 # Window
 @app.get("/window/activate")
-def win_activate(request: Request, title:str=Query(...)):
-    auth(request); require_enabled()
-    if not FEAT.get('window',True): raise HTTPException(403,"window feature disabled")
-    d = Desktop(backend="uia")
-    for w in d.windows():
-        t = w.window_text() or ""
-        if title.lower() in t.lower():
-            w.set_focus()
-            return {"status":"ok","window":t}
-    raise HTTPException(404,"window not found")
+async def win_activate(request: Request, title:str=Query(...)):
+    auth(request)
+    return await run_action("/window/activate", title=title)
+
+@app.get("/window/wait")
+async def win_wait(request: Request, title:str=Query(...), timeout:float=Query(WAIT_WINDOW_TIMEOUT, ge=0, le=60)):
+    auth(request)
+    return await run_action("/window/wait", title=title, timeout=timeout)
 
 @app.get("/window/click_center")
-def win_click_center(request: Request, title:str=Query(...)):
-    auth(request); require_enabled()
-    d = Desktop(backend="uia")
-    for w in d.windows():
-        t = w.window_text() or ""
-        if title.lower() in t.lower():
-            w.set_focus()
-            rect = w.rectangle()
-            cx,cy = (rect.left+rect.right)//2,(rect.top+rect.bottom)//2
-            pyautogui.moveTo(cx,cy,duration=0.1); pyautogui.click()
-            return {"status":"ok","window":t,"x":cx,"y":cy}
-    raise HTTPException(404,"window not found")
+async def win_click_center(request: Request, title:str=Query(...)):
+    auth(request)
+    return await run_action("/window/click_center", title=title)
 
 # Screenshot
 @app.get("/screen/screenshot")
-def screenshot():
-    if not FEAT.get('screenshot',True): raise HTTPException(403,"screenshot disabled")
-    with mss.mss() as sct:
-        path = SHOTS / "shot.png"
-        sct.shot(mon=-1, output=str(path))
-    return {"status":"ok","path":str(path),"url":f"/shots/{path.name}"}
+async def screenshot(monitor:int=Query(0, ge=0), left:Optional[int]=None, top:Optional[int]=None,
+                     width:Optional[int]=Query(None, gt=0), height:Optional[int]=Query(None, gt=0),
+                     format:Literal['png','jpeg','jpg','webp']="png", quality:int=Query(80, ge=1, le=100),
+                     scale:float=Query(1.0, gt=0, le=1), save:bool=False, delta:bool=False,
+                     session:Optional[str]=Query(None, max_length=64), tile:int=Query(32, ge=8, le=256)):
+    return await run_action("/screen/screenshot", monitor=monitor, left=left, top=top, width=width,
+                            height=height, format=format, quality=quality, scale=scale, save=save,
+                            delta=delta, session=session, tile=tile)
+
+@app.get("/screen/stream.mjpeg")
+async def screen_stream_mjpeg(request: Request, fps:float=Query(5, gt=0), monitor:int=Query(0, ge=0),
+                              quality:int=Query(60, ge=1, le=100), scale:float=Query(0.5, gt=0, le=1),
+                              frames:int=Query(0, ge=0)):
+    auth(request)
+    stream = _screen_stream(monitor, quality, scale)
+
+    async def body():
+        sub = stream.subscribe(fps)
+        try:
+            while frames == 0 or sub.sent < frames:
+                frame = await sub.next_frame()
+                yield (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                       + str(len(frame)).encode() + b"\r\n\r\n" + frame + b"\r\n")
+        finally:
+            stream.unsubscribe(sub)
+
+    return StreamingResponse(body(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+@app.websocket("/screen/stream/ws")
+async def screen_stream_ws(ws: WebSocket, fps:float=5, monitor:int=0, quality:int=60, scale:float=0.5):
+    try:
+        auth(ws)
+        stream = _screen_stream(monitor, quality, scale)
+    except HTTPException as e:
+        await ws.close(code=1008, reason=str(e.detail))
+        return
+    await ws.accept()
+    sub = stream.subscribe(fps)
+
+    async def sender():
+        try:
+            while True:
+                await ws.send_bytes(await sub.next_frame())
+        except WebSocketDisconnect:
+            return   # viewer gone mid-send: end quietly, the subscription is dropped below
+
+    async def receiver():
+        # watches for disconnects; {"fps": n} changes the viewer's rate on the fly
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                return
+            try:
+                sub.fps = max(0.1, min(STREAM_MAX_FPS, float(json.loads(msg.get("text") or "{}")["fps"])))
+            except (ValueError, KeyError, TypeError):
+                pass
+
+    tasks = [asyncio.ensure_future(sender()), asyncio.ensure_future(receiver())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # désabonner avant d'attendre : une annulation du handler ne doit pas laisser le flux tourner
+        stream.unsubscribe(sub)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 @app.get("/shots/{name}")
 def serve_shot(name:str):
-    return FileResponse(SHOTS / name)
+    item = SHOT_BUFFER.get(name)
+    if item is not None:
+        data, mime = item
+        return Response(data, media_type=mime)
+    path = SHOTS / Path(name).name
+    if not path.is_file(): raise HTTPException(404, "shot not found")
+    return FileResponse(path)
 
 # Run allowlisted apps
 @app.get("/app/run")
-def app_run(request: Request, name:str=Query(...)):
-    auth(request); require_enabled()
-    if not FEAT.get('run_apps',True): raise HTTPException(403,"run apps disabled")
-    if name not in ALLOW: raise HTTPException(403,f"{name} not in allowlist")
-    cmd = ALLOW[name]; exe=cmd[0]
-    if not shutil.which(exe): raise HTTPException(404,f"not found: {exe}")
-    subprocess.Popen(cmd); return {"status":"ok","launched":cmd}
+async def app_run(request: Request, name:str=Query(...)):
+    auth(request)
+    return await run_action("/app/run", name=name)
 
 # Browser open
 @app.get("/browser/open")
-def browser_open(request: Request, url:str=Query(...)):
-    auth(request); require_enabled()
-    if not FEAT.get('browser_open',True): raise HTTPException(403,"browser_open disabled")
-    import webbrowser
-    if not url.startswith("http"): url="https://"+url
-    webbrowser.open_new_tab(url)
-    return {"status":"ok","opened":url}
+async def browser_open(request: Request, url:str=Query(...)):
+    auth(request)
+    return await run_action("/browser/open", url=url)
 
 # Browser (Playwright)
+# type -> required fields; one compiler for /browser/script and the playwright_script plan step
+BROWSER_STEPS = {
+    "goto": ("url",), "click": ("selector",), "fill": ("selector",), "type": (), "press": ("key",),
+    "wait": ("selector",), "eval": (), "screenshot": (), "parallel": ("branches",),
+}
+
+
+class BrowserProgram:
+    """A browser step list validated and turned into coroutine calls once.
+
+    `run(slot)` replays it on the slot's page and times every step. A
+    `parallel` step runs each of its branches on a page of its own, leased
+    from the profile's browser pool, and gathers their results; `pages` is how many extra
+    pages the program can hold at the same time.
+    """
+
+    def __init__(self, steps: List[dict], where: str = "step"):
+        self.ops = []
+        self.pages = 0
+        for i, s in enumerate(steps):
+            self.ops.append(self._compile(s, f"{where} {i}"))
+
+    def _compile(self, s: dict, where: str):
+        t = s.get("type")
+        required = BROWSER_STEPS.get(t)
+        if required is None:
+            raise HTTPException(400, f"{where}: unknown action {t!r}")
+        missing = [k for k in required if not s.get(k)]
+        if missing:
+            raise HTTPException(400, f"{where}: {', '.join(missing)} required")
+        timeout = int(s.get("timeout_ms") or 10000)
+        if t == "goto":
+            url = s["url"]
+            async def op(slot): await slot["page"].goto(url)
+        elif t == "click":
+            sel = s["selector"]
+            async def op(slot): await slot["page"].click(sel, timeout=timeout)
+        elif t == "fill":
+            sel, text = s["selector"], s.get("text") or ""
+            async def op(slot): await slot["page"].fill(sel, text, timeout=timeout)
+        elif t == "type":
+            text = s.get("text") or ""
+            async def op(slot): await slot["page"].keyboard.type(text)
+        elif t == "press":
+            key = s["key"]
+            async def op(slot): await slot["page"].keyboard.press(key)
+        elif t == "wait":
+            sel = s["selector"]
+            async def op(slot): await slot["page"].wait_for_selector(sel, timeout=timeout)
+        elif t == "eval":
+            js = f"(function(){{ try{{ return {s.get('expression') or 'document.title'}; }}catch(e){{ return String(e); }} }})()"
+            async def op(slot): return {"result": await slot["page"].evaluate(js)}
+        elif t == "screenshot":
+            async def op(slot):
+                out = ROOT/'shots'/f'playwright-{slot["id"]}.png'
+                await slot["page"].screenshot(path=str(out), full_page=True)
+                return {"path": str(out)}
+        else:
+            branches = [BrowserProgram(b, f"{where} branch {j} step") for j, b in enumerate(s["branches"])]
+            self.pages = max(self.pages, sum(1 + b.pages for b in branches))
+            async def op(slot):
+                done = await asyncio.gather(*(b.run_on_new_page() for b in branches))
+                return {"ok": all(d["ok"] for d in done), "branches": done}
+        return t, op
+
+    async def run(self, slot: dict) -> List[dict]:
+        results = []
+        for t, op in self.ops:
+            t0 = time.perf_counter()
+            res = await op(slot) or {}
+            results.append({"ok": True, "type": t, **res, "duration_ms": round((time.perf_counter() - t0) * 1000, 3)})
+        return results
+
+    async def run_on_new_page(self) -> dict:
+        t0 = time.perf_counter()
+        out = {"ok": True, "page": None}
+        try:
+            async with current_profile().browser_pool.lease() as slot:
+                out["page"] = slot["id"]
+                out["results"] = await self.run(slot)
+        except Exception as e:
+            out["ok"], out["error"] = False, e.detail if isinstance(e, HTTPException) else str(e)
+        out["duration_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        return out
+
+
+def compile_browser_steps(steps: List[dict]) -> BrowserProgram:
+    program = BrowserProgram(steps)
+    size = current_profile().browser_pool.size
+    if 1 + program.pages > size:
+        raise HTTPException(400, f"script needs {1 + program.pages} pages at once, pool_size is {size}")
+    return program
+
+async def run_browser_steps(steps: List[dict], session: Optional[str] = None) -> dict:
+    program = compile_browser_steps(steps)
+    t0 = time.perf_counter()
+    async with current_profile().browser_pool.lease(session) as slot:
+        results = await program.run(slot)
+    return {"results": results, "page": slot["id"], "total_ms": round((time.perf_counter() - t0) * 1000, 3)}
+
 @app.post("/browser/script")
 async def browser_script(request: Request, body: ScriptBody = Body(...)):
     auth(request); require_enabled()
-    if not PW_ENABLED: raise HTTPException(403, "Playwright not enabled. Set features.browser_playwright = true and install it.")
-    if page is None:  raise HTTPException(500, "Playwright page not ready.")
-    results = []
-    for a in body.steps:
-        t = a.type
-        if t == 'goto':
-            if not a.url: raise HTTPException(400, "url required")
-            await page.goto(a.url); results.append({"ok":True}); continue
-        if t == 'click':
-            if not a.selector: raise HTTPException(400, "selector required")
-            await page.click(a.selector, timeout=a.timeout_ms); results.append({"ok":True}); continue
-        if t == 'fill':
-            if not a.selector: raise HTTPException(400, "selector required")
-            await page.fill(a.selector, a.text or "", timeout=a.timeout_ms); results.append({"ok":True}); continue
-        if t == 'type':
-            await page.keyboard.type(a.text or ""); results.append({"ok":True}); continue
-        if t == 'press':
-            if not a.key: raise HTTPException(400, "key required")
-            await page.keyboard.press(a.key); results.append({"ok":True}); continue
-        if t == 'wait':
-            if not a.selector: raise HTTPException(400, "selector required")
-            await page.wait_for_selector(a.selector, timeout=a.timeout_ms); results.append({"ok":True}); continue
-        if t == 'eval':
-            expr = a.expression or "document.title"
-            res = await page.evaluate(f"(function(){{ try{{ return {expr}; }}catch(e){{ return String(e); }} }})()")
-            results.append({"ok":True,"result":res}); continue
-        if t == 'screenshot':
-            out = ROOT/'shots'/'playwright.png'
-            await page.screenshot(path=str(out), full_page=True)
-            results.append({"ok":True,"path":str(out)}); continue
-        raise HTTPException(400, f"Unknown action: {t}")
-    return {"ok":True,"results":results}
+    if not current_settings().pw_enabled: raise HTTPException(403, "Playwright not enabled. Set features.browser_playwright = true and install it.")
+    return {"ok":True, **(await run_browser_steps([a.model_dump(exclude_none=True) for a in body.steps], body.session))}
 
 # ================== Helpers (OS + plans) ==================
 def _open_url(u:str):
@@ -392,35 +2441,30 @@ def _open_url(u:str):
     webbrowser.open_new_tab(u); return u
 
 def _focus(title:str):
-    d=Desktop(backend="uia")
-    for w in d.windows():
-        t = w.window_text() or ""
-        if title.lower() in t.lower():
-            w.set_focus(); return t
-    raise HTTPException(404,"window not found")
-
-def _screenshot_json():
-    with mss.mss() as sct:
-        path=SHOTS/"shot.png"; sct.shot(mon=-1,output=str(path))
-    return {"status":"ok","path":str(path),"url":f"/shots/{path.name}"}
+    return WINDOW_INDEX.focus(title)[0]
+
+def _screenshot_json(s: Optional[dict] = None):
+    s = s or {}
+    region = _region(s.get("left"), s.get("top"), s.get("width"), s.get("height"))
+    return capture(int(s.get("monitor", 0)), region, s.get("format", "png"), int(s.get("quality", 80)),
+                   float(s.get("scale", 1.0)), bool(s.get("save", True)))
 
 WINDOW_TITLES = {
     "notepad": ["Bloc-notes", "Notepad", "Sans titre", "Untitled"],
 }
 
-def _focus_best(app_key: str, fallback_title: str = ""):
-    titles = WINDOW_TITLES.get(app_key.lower(), [])
-    tried = set()
-    for t in titles + ([fallback_title] if fallback_title else []):
-        tt = (t or "").strip()
-        if not tt or tt.lower() in tried:
-            continue
-        tried.add(tt.lower())
+def _focus_best(app_key: str, fallback_title: str = "", exclude=None) -> dict:
+    titles = WINDOW_TITLES.get(app_key.lower(), []) + ([fallback_title] if fallback_title else [])
+    try:
         try:
-            return _focus(tt)
+            res = WINDOW_INDEX.focus_best(titles, exclude=exclude)
         except HTTPException:
-            continue
-    return _focus("Chrome")
+            if not exclude:
+                raise
+            res = WINDOW_INDEX.focus_best(titles)   # pas de nouvelle fenêtre : l'appli a réutilisé la sienne
+    except HTTPException:
+        res = WINDOW_INDEX.focus_best([DEFAULT_FOCUS])
+    return {"window": res["title"], "match": res["match"], "candidate": res["candidate"], "timings": res["timings"]}
 
 # Intents FR (regex)
 INTENT_PATTERNS = [
@@ -432,9 +2476,31 @@ INTENT_PATTERNS = [
     ("tab",            re.compile(r"\b(tab|onglet suivant|passe au champ suivant)\b", re.I)),
     ("type_text",      re.compile(r"\b(tape|écrit|ecris|saisis)\b\s+(?:\"([^\"]+)\"|'([^']+)'|(.+))", re.I)),
     ("screenshot",     re.compile(r"\b(capture|screenshot|photo d'?écran)\b", re.I)),
+    # interpret_command fallback when no intent above matched
+    ("type_fallback",  re.compile(r"\b(écrit|ecris|tape|saisis)\b\s+(.+)", re.I)),
 ]
 DEFAULT_FOCUS = "Chrome"
 
+# Mots-clés par lesquels commence chaque INTENT_PATTERNS : un littéral qui en contient
+# un n'est pas inerte pour le cache de plans
+INTENT_KEYWORDS = re.compile(
+    r"\b(?:ouvre|ouvrir|lance|d[ée]marre|va(?:s)? sur|coinbase|focus|active|mets au premier plan|donne le focus"
+    r"|appuie|valide|enter|entr(?:é|e)e|tab|onglet suivant|passe au champ suivant|tape|écrit|ecris|saisis"
+    r"|capture|screenshot|photo d'?écran)\b",
+    re.I,
+)
+
+
+def match_intent(text: str, skip: Iterable[str] = ()) -> Optional[Tuple[str, "re.Match"]]:
+    """First INTENT_PATTERNS entry (priority order) found in `text`, with its match."""
+    for name, rx in INTENT_PATTERNS:
+        if name in skip:
+            continue
+        m = rx.search(text)
+        if m:
+            return name, m
+    return None
+
 # Alias appli -> clé allowlist
 APP_ALIASES = {
     "notepad":"notepad","bloc-notes":"notepad","bloc notes":"notepad",
@@ -447,114 +2513,209 @@ def resolve_app(name:str)->str:
     key = re.sub(r"\s+"," ",name.strip().lower())
     return APP_ALIASES.get(key,key)
 
-async def run_plan(steps: list[dict])->list[dict]:
-    out=[]
+# Devices each plan step drives; a plan leases all of them for its whole run.
+STEP_DEVICES = {
+    "type": ("keyboard",),
+    "hotkey": ("keyboard",),
+    "focus": ("window",),
+    "focus_best": ("window",),
+    "wait_window": ("window",),
+}
+
+# step type -> (feature flag, {field: (accepted type, required)}); what /jobs checks before accepting a plan
+PLAN_STEPS = {
+    "open": ("browser_open", {"url": (str, True)}),
+    "focus": ("window", {"title": (str, False)}),
+    "focus_best": ("window", {"app": (str, False), "fallback": (str, False), "new": (bool, False)}),
+    "wait_window": ("window", {"title": (str, False), "app": (str, False), "fallback": (str, False),
+                               "timeout": ((int, float), False), "new": (bool, False)}),
+    "type": ("keyboard", {"text": (str, True)}),
+    "hotkey": ("keyboard", {"keys": (str, True)}),
+    "sleep": (None, {"sec": ((int, float), False)}),
+    "screenshot": ("screenshot", {}),
+    "run_app": ("run_apps", {"name": (str, True)}),
+    "playwright_script": ("browser_playwright", {"steps": (list, True), "session": (str, False)}),
+}
+# une pause de plan garde les périphériques réservés : même plafond que l'outil sleep du LLM
+PLAN_SLEEP_MAX = 5.0
+PLAN_WAIT_MAX = 30.0
+
+def _step_feature_error(step: dict) -> Optional[HTTPException]:
+    feature = PLAN_STEPS.get(step.get("type"), (None,))[0]
+    if feature == "browser_playwright":
+        if not current_settings().pw_enabled:
+            return HTTPException(403, "Playwright not enabled")
+    elif feature and not current_settings().feat.get(feature, True):
+        return HTTPException(403, f"{feature} disabled")
+    return None
+
+def validate_plan(steps: list) -> list[dict]:
+    """Check client-supplied plan steps like the HTTP routes would (422 / 403), with pauses clamped."""
+    out = []
+    for i, s in enumerate(steps):
+        if not isinstance(s, dict) or s.get("type") not in PLAN_STEPS:
+            kind = s.get("type") if isinstance(s, dict) else None
+            raise HTTPException(422, f"step {i}: unknown type {kind!r}")
+        for field, (types, required) in PLAN_STEPS[s["type"]][1].items():
+            value = s.get(field)
+            if value is None:
+                if required:
+                    raise HTTPException(422, f"step {i} ({s['type']}): {field} required")
+            elif not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+                raise HTTPException(422, f"step {i} ({s['type']}): invalid {field}")
+        err = _step_feature_error(s)
+        if err is not None:
+            raise err
+        if s["type"] == "sleep":
+            s = {**s, "sec": max(0.0, min(PLAN_SLEEP_MAX, float(s.get("sec", 0.8))))}
+        elif s["type"] == "wait_window" and s.get("timeout") is not None:
+            s = {**s, "timeout": max(0.0, min(PLAN_WAIT_MAX, float(s["timeout"])))}
+        out.append(s)
+    return out
+
+def plan_devices(steps: list[dict]) -> set:
+    out = set()
     for s in steps:
-        k=s["type"]
+        if s.get("type") == "type":
+            out.update(TEXT_INJECTOR.devices(s.get("text", "")))   # + presse-papier si collage
+        else:
+            out.update(STEP_DEVICES.get(s.get("type"), ()))
+    return out
+
+async def run_plan(steps: list[dict], on_event=None)->list[dict]:
+    async with INPUT_SCHEDULER.lease(plan_devices(steps), owner="plan"):
+        return await _run_plan_steps(steps, on_event)
+
+def _step_event(index: int, step: dict, result: dict, ts: float, t0: float) -> dict:
+    return {"index": index, "type": step.get("type"), "ok": result.get("ok", True) is not False, "result": result,
+            "ts": round(ts, 3), "duration_ms": round((time.perf_counter() - t0) * 1000, 3)}
+
+async def _run_plan_steps(steps: list[dict], on_event=None)->list[dict]:
+    """Run plan steps in order; `on_event(name, data)` is called after each one.
+
+    Panic mode is checked before every step: the plan stops and the 423 is raised
+    to the caller (a job then ends with the `panic` status).
+    """
+    out=[]
+    launched_from = None   # fenêtres ouvertes avant le dernier run_app
+    for i, s in enumerate(steps):
+        k = s.get("type")
+        ts, t0 = time.time(), time.perf_counter()
         try:
+            require_enabled()
+            err = _step_feature_error(s)
+            if err is not None:
+                raise err
             if k=="open":
-                u=_open_url(s["url"]); out.append({"ok":True,"opened":u})
+                u=await UI_EXECUTOR.run(_open_url, s["url"]); out.append({"ok":True,"opened":u})
             elif k=="focus_best":
                 app_key = s.get("app",""); fb = s.get("fallback","")
-                t = _focus_best(app_key, fb); out.append({"ok": True, "window": t})
+                exclude = launched_from if s.get("new") else None
+                out.append({"ok": True, **(await UI_EXECUTOR.run(_focus_best, app_key, fb, exclude, devices=("window",)))})
+            elif k=="wait_window":
+                if "title" in s:
+                    cands = [s["title"]]
+                else:
+                    cands = WINDOW_TITLES.get(s.get("app","").lower(), []) + ([s["fallback"]] if s.get("fallback") else [])
+                try:
+                    res = await wait_window(cands, timeout=float(s.get("timeout", WAIT_WINDOW_TIMEOUT)),
+                                            exclude=launched_from if s.get("new") else None)
+                except HTTPException as e:
+                    if e.status_code != 504:
+                        raise
+                    # aucun titre attendu (vs code, word...) : pas bloquant, focus_best / DEFAULT_FOCUS prend le relais
+                    out.append({"ok": False, "error": f"{e.status_code}: {e.detail}", "timed_out": True})
+                else:
+                    out.append({"ok": True, **res})
             elif k=="focus":
-                t=_focus(s.get("title",DEFAULT_FOCUS)); out.append({"ok":True,"window":t})
+                t=await UI_EXECUTOR.run(_focus, s.get("title",DEFAULT_FOCUS), devices=("window",)); out.append({"ok":True,"window":t})
             elif k=="type":
-                pyautogui.typewrite(s.get("text","")); out.append({"ok":True})
+                txt = s.get("text","")
+                res = await UI_EXECUTOR.run(TEXT_INJECTOR.inject, txt, devices=TEXT_INJECTOR.devices(txt)); out.append({"ok":True, **res})
             elif k=="hotkey":
-                pyautogui.hotkey(*[x for x in s.get("keys","").split("+") if x]); out.append({"ok":True})
+                await UI_EXECUTOR.run(pyautogui.hotkey, *[x for x in s.get("keys","").split("+") if x], devices=("keyboard",)); out.append({"ok":True})
             elif k=="sleep":
-                await asyncio.sleep(s.get("sec",0.8)); out.append({"ok":True})
+                await asyncio.sleep(max(0.0, min(PLAN_SLEEP_MAX, float(s.get("sec",0.8))))); out.append({"ok":True})
             elif k=="screenshot":
-                out.append(_screenshot_json())
+                out.append(await UI_EXECUTOR.run(_screenshot_json, s))
             elif k=="run_app":
                 name=s["name"]
-                if name not in ALLOW: raise HTTPException(403,f"{name} not in allowlist")
-                cmd = ALLOW[name]; exe=cmd[0]
-                if not shutil.which(exe): raise HTTPException(404,f"not found: {exe}")
-                subprocess.Popen(cmd); out.append({"ok":True,"launched":cmd})
+                allow = current_settings().allow
+                if name not in allow: raise HTTPException(403,f"{name} not in allowlist")
+                cmd = allow[name]; exe=cmd[0]
+                if not resolve_exe(exe): raise HTTPException(404,f"not found: {exe}")
+                if any(x.get("new") for x in steps[i+1:]):
+                    launched_from = await UI_EXECUTOR.run(WINDOW_INDEX.keys, devices=("window",))
+                await UI_EXECUTOR.run(subprocess.Popen, cmd); out.append({"ok":True,"launched":cmd})
             elif k=="playwright_script":
-                if not PW_ENABLED: raise HTTPException(403,"Playwright not enabled")
-                if page is None: raise HTTPException(500,"Playwright page not ready")
-                res=[]
-                for a in s.get("steps",[]):
-                    t=a.get("type")
-                    if t=="goto":      await page.goto(a["url"]); res.append({"ok":True})
-                    elif t=="click":   await page.click(a["selector"], timeout=a.get("timeout_ms",10000)); res.append({"ok":True})
-                    elif t=="fill":    await page.fill(a["selector"], a.get("text",""), timeout=a.get("timeout_ms",10000)); res.append({"ok":True})
-                    elif t=="press":   await page.keyboard.press(a["key"]); res.append({"ok":True})
-                    elif t=="wait":    await page.wait_for_selector(a["selector"], timeout=a.get("timeout_ms",10000)); res.append({"ok":True})
-                    elif t=="screenshot":
-                        outp = ROOT/'shots'/'playwright.png'
-                        await page.screenshot(path=str(outp), full_page=True); res.append({"ok":True,"path":str(outp)})
-                    else: res.append({"ok":False,"error":f"unknown {t}"})
-                out.append({"ok":True,"playwright_results":res})
+                if not current_settings().pw_enabled: raise HTTPException(403,"Playwright not enabled")
+                res = await run_browser_steps(s.get("steps",[]), s.get("session"))
+                out.append({"ok":True,"playwright_results":res["results"],"page":res["page"]})
             else:
                 out.append({"ok":False,"error":f"unknown {k}"})
             log_event("run_step_done", {"type": k, "status": "ok"})
+            if on_event:
+                on_event("step", _step_event(i, s, out[-1], ts, t0))
         except Exception as e:
             log_event("run_step_error", {"type": k, "error": str(e)})
-            out.append({"ok":False,"error":str(e),"step":s}); break
+            out.append({"ok":False,"error":str(e),"step":s})
+            if on_event:
+                on_event("step", _step_event(i, s, out[-1], ts, t0))
+            if isinstance(e, HTTPException) and e.status_code == 423:
+                raise
+            break
     return out
 
 # -------- Interpréteur "mono-commande" --------
-def interpret_single(text: str) -> list[dict]:
-    t = text.strip()
-
-    # open_app
-    m = INTENT_PATTERNS[0][1].search(t)
-    if m:
+def _intent_steps(name: str, m: "re.Match") -> list[dict]:
+    if name == "open_app":
         raw = m.group(2)
         app = resolve_app(raw)
+        # "new" : seule une fenêtre absente avant run_app compte (pas une instance déjà ouverte)
         return [
             {"type":"run_app","name":app},
-            {"type":"sleep","sec":0.8},
-            {"type":"focus_best","app":app, "fallback": raw},
+            {"type":"wait_window","app":app, "fallback": raw, "new": True},
+            {"type":"focus_best","app":app, "fallback": raw, "new": True},
         ]
-
-    # coinbase
-    m = INTENT_PATTERNS[1][1].search(t)
-    if m:
+    if name == "open_coinbase":
         return [{"type":"focus","title":DEFAULT_FOCUS},
                 {"type":"open","url":"https://www.coinbase.com/signin"},
                 {"type":"sleep","sec":1.0}]
-
-    # open_url
-    m = INTENT_PATTERNS[2][1].search(t)
-    if m:
+    if name == "open_url":
         return [{"type":"focus","title":DEFAULT_FOCUS},{"type":"open","url":m.group(2)}]
-
-    # focus
-    m = INTENT_PATTERNS[3][1].search(t)
-    if m:
+    if name == "focus":
         return [{"type":"focus","title":m.group(2)}]
-
-    # enter
-    m = INTENT_PATTERNS[4][1].search(t)
-    if m:
+    if name == "enter":
         return [{"type":"type","text":"\r"}]
-
-    # tab
-    m = INTENT_PATTERNS[5][1].search(t)
-    if m:
+    if name == "tab":
         return [{"type":"type","text":"\t"}]
-
-    # type_text (avec guillemets gérés)
-    m = INTENT_PATTERNS[6][1].search(t)
-    if m:
+    if name == "type_text":
+        # avec guillemets gérés
         txt = m.group(2) or m.group(3) or m.group(4) or ""
         return [{"type":"type","text": txt}]
-
-    # screenshot
-    m = INTENT_PATTERNS[7][1].search(t)
-    if m:
+    if name == "screenshot":
         return [{"type":"screenshot"}]
+    if name == "type_fallback":
+        return [{"type":"type","text": m.group(2)}]
+    return []
+
+def interpret_single(text: str) -> list[dict]:
+    return _interpret_clause(text, type_fallback=False)
+
+def _interpret_clause(text: str, type_fallback: bool = True) -> list[dict]:
+    t = text.strip()
+    hit = match_intent(t, skip=() if type_fallback else ("type_fallback",))
+    if hit and hit[0] != "type_fallback":
+        return _intent_steps(*hit)
 
     # fallback "ouvre ..."
     if t.lower().startswith("ouvre "):
         url = t[6:].strip()
         return [{"type":"focus","title":DEFAULT_FOCUS},{"type":"open","url":url}]
 
+    # interpret_command: "tape ..." sans intention reconnue
+    if hit:
+        return _intent_steps(*hit)
     return []
 
 # -------- Interpréteur multi-clauses --------
@@ -565,38 +2726,455 @@ def interpret_command(text: str) -> list[dict]:
     clauses = [c.strip() for c in _CLAUSE_SPLIT.split(raw) if c.strip()]
     whole: list[dict] = []
     for i, clause in enumerate(clauses):
-        sub = interpret_single(clause)
-        if not sub:
-            m = re.search(r'\b(écrit|ecris|tape|saisis)\b\s+(.+)', clause, re.IGNORECASE)
-            if m:
-                sub = [{"type":"type","text": m.group(2)}]
+        sub = _interpret_clause(clause)
         whole.extend(sub)
-        if i < len(clauses)-1:
+        # an opened app is already awaited by wait_window; no fixed pause needed after it
+        waited = len(sub) >= 2 and sub[-2]["type"] == "wait_window"
+        if i < len(clauses)-1 and not waited:
             whole.append({"type":"sleep","sec":0.4})
     return whole
 
+# -------- Cache de plans --------
+AGENT_CFG = CFG.get('agent', {})
+_LITERAL = re.compile(r'"([^"]*)"|\'([^\']*)\'')
+_PLACEHOLDER = "\ue000{}\ue001"
+_SLOT = re.compile("\ue000(\\d+)\ue001")
+
+
+def _fold(text: str) -> str:
+    """Case folded only: "Appuie Entrée" == "appuie ENTRÉE".
+
+    The intent patterns ignore case (re.I) but not accents or repeated
+    spaces ("ecrit" is no keyword, "photo  d'écran" no screenshot), so
+    folding those would give two commands of different meaning one key.
+    """
+    return text.lower()
+
+
+class PlanCache:
+    """Bounded LRU of interpret_command results, keyed on the command skeleton.
+
+    Quoted literals that are plain `type` payloads become placeholders, so
+    `tape "bonjour"` and `tape "merci"` share one template. A template whose
+    values are all constants (nothing copied from the text) is stored under the
+    folded skeleton; anything else is keyed on the exact skeleton. Every template
+    is checked against a direct interpretation before it is stored, and the
+    cache is flushed when ALLOW, APP_ALIASES, WINDOW_TITLES or DEFAULT_FOCUS
+    change.
+    """
+
+    def __init__(self, max_items: int = 256, recheck_sec: float = 1.0):
+        self.max_items = max(1, int(max_items))
+        self.recheck_sec = float(recheck_sec)
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # squelettes -> (template, slots)
+        self._texts: "OrderedDict[str, list]" = OrderedDict()   # textes exacts -> plans
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._signature = None
+        self._checked = 0.0
+        self.hits = self.misses = self.uncacheable = self.invalidations = 0
+
+    @staticmethod
+    def fingerprint() -> str:
+        src = json.dumps([dict(current_settings().allow), APP_ALIASES, WINDOW_TITLES, DEFAULT_FOCUS], sort_keys=True, default=str)
+        return hashlib.sha1(src.encode()).hexdigest()
+
+    def invalidate(self):
+        with self._lock:
+            self._items.clear()
+            self._texts.clear()
+            self.invalidations += 1
+
+    def _check_fingerprint(self):
+        # identité + taille à chaque appel ; contenu complet à chaque changement ou toutes les recheck_sec
+        allow = current_settings().allow
+        sig = (id(allow), len(allow), id(APP_ALIASES), len(APP_ALIASES), id(WINDOW_TITLES), len(WINDOW_TITLES), DEFAULT_FOCUS)
+        now = time.monotonic()
+        if sig == self._signature and now - self._checked < self.recheck_sec:
+            return
+        self._signature, self._checked = sig, now
+        fp = self.fingerprint()
+        if fp != self._fingerprint:
+            if self._fingerprint is not None:
+                self.invalidate()
+            self._fingerprint = fp
+
+    @staticmethod
+    def _skeleton(text: str) -> Tuple[str, list]:
+        """Replace inert quoted literals (no intent keyword, no clause separator) by placeholders."""
+        literals: list = []
+
+        def sub(m):
+            lit = m.group(1) if m.group(1) is not None else m.group(2)
+            if not lit or INTENT_KEYWORDS.search(lit) or _CLAUSE_SPLIT.search(lit):
+                return m.group(0)
+            literals.append(lit)
+            q = m.group(0)[0]
+            return q + _PLACEHOLDER.format(len(literals) - 1) + q
+        return _LITERAL.sub(sub, text.strip()), literals
+
+    @staticmethod
+    def _slots(template: list) -> list:
+        """(step index, field, literal index) of every placeholder in a template."""
+        return [(i, k, int(m.group(1))) for i, step in enumerate(template) for k, v in step.items()
+                if isinstance(v, str) and (m := _SLOT.fullmatch(v))]
+
+    @staticmethod
+    def _fill(template: list, slots: list, literals: list) -> list:
+        plan = [dict(step) for step in template]
+        for i, k, n in slots:
+            plan[i][k] = literals[n]
+        return plan
+
+    def _template(self, skeleton: str, literals: list, plan: list) -> Optional[list]:
+        """Template for `skeleton`, or None when the placeholders do not map 1:1 onto type payloads."""
+        if not literals:
+            return plan
+        template = interpret_command(skeleton)
+        texts = [s.get("text") for s in template if s.get("type") == "type"]
+        if sorted(texts.count(_PLACEHOLDER.format(i)) for i in range(len(literals))) != [1] * len(literals):
+            return None
+        if self._fill(template, self._slots(template), literals) != plan:
+            return None
+        return template
+
+    def _foldable(self, skeleton: str, template: list) -> Optional[str]:
+        folded = _fold(skeleton)
+        for step in template:
+            for k, v in step.items():
+                if k == "type" or not isinstance(v, str) or "\ue000" in v:
+                    continue
+                fv = _fold(v)
+                if fv and fv in folded:
+                    return None   # valeur copiée du texte : la casse / les accents comptent
+        return folded if interpret_command(folded) == template else None
+
+    @staticmethod
+    def _lookup(table: OrderedDict, key: str) -> Optional[list]:
+        item = table.get(key)
+        if item is not None:
+            table.move_to_end(key)
+        return item
+
+    def _store(self, table: OrderedDict, key: str, value: list):
+        table[key] = value
+        table.move_to_end(key)
+        while len(table) > self.max_items:
+            table.popitem(last=False)
+
+    def get_plan(self, text: str) -> Tuple[list, bool]:
+        """(plan, cache_hit) for a natural-language command."""
+        self._check_fingerprint()
+        with self._lock:
+            plan = self._lookup(self._texts, text)   # texte déjà vu tel quel
+            if plan is not None:
+                self.hits += 1
+                return [dict(step) for step in plan], True
+        skeleton, literals = self._skeleton(text)
+        with self._lock:
+            template = self._lookup(self._items, "~" + _fold(skeleton))
+            if template is None:
+                template = self._lookup(self._items, "=" + skeleton)
+            if template is not None:
+                self.hits += 1
+                return self._fill(*template, literals), True
+            self.misses += 1
+
+        plan = interpret_command(text)
+        template = self._template(skeleton, literals, plan)
+        if template is None:
+            self.uncacheable += 1
+            return plan, False
+        folded = self._foldable(skeleton, template)
+        with self._lock:
+            self._store(self._items, "~" + folded if folded is not None else "=" + skeleton,
+                        (template, self._slots(template)))
+            self._store(self._texts, text, plan)
+        return [dict(step) for step in plan], False
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"items": len(self._items), "texts": len(self._texts), "max_items": self.max_items, "hits": self.hits,
+                "misses": self.misses, "uncacheable": self.uncacheable,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "invalidations": self.invalidations}
+
+
+def _plan_cache_from(cfg: dict) -> PlanCache:
+    return PlanCache(int(cfg.get("plan_cache_size", 256)), float(cfg.get("plan_cache_recheck", 1.0)))
+
+
+PLAN_CACHE = _plan_cache_from(AGENT_CFG)
+
+# -------- Optimiseur de plans --------
+# Steps that may move the keyboard focus; a focus step after them is never redundant.
+FOCUS_CHANGERS = {"open", "run_app", "hotkey", "playwright_script"}
+# Steps that do not depend on the UI having settled: they can start before a pending sleep.
+HOISTABLE = {"open", "run_app"}
+# Fixed per-step cost (s) used to estimate the time an optimization saves.
+STEP_COST = {"focus": 0.05, "focus_best": 0.05}
+
+
+def _step_cost(step: dict) -> float:
+    if step["type"] == "sleep":
+        return float(step.get("sec", 0.8))
+    if step["type"] in ("type", "hotkey"):
+        return float(getattr(pyautogui, "PAUSE", 0.1))   # pause pyautogui après chaque appel
+    return STEP_COST.get(step["type"], 0.0)
+
+
+def _plain_text(step: dict) -> bool:
+    return step["type"] == "type" and not any(c in step.get("text", "") for c in "\r\n\t")
+
+
+def optimize_plan(steps: list[dict]) -> Tuple[list[dict], list[dict]]:
+    """Rewrite a plan without changing what it does; returns (steps, changes).
+
+    Rules, applied until nothing changes:
+    - focus: dropped when the same window is already focused, or right before an
+      `open` (webbrowser opens its own tab whatever the focus);
+    - sleep: consecutive sleeps collapse to the longest one; sleeps between two
+      plain-text `type` steps, right after a `screenshot`, right before a
+      `wait_window` (which waits itself) or at the end of the plan are dropped;
+    - type: adjacent steps are merged into one call;
+    - open / run_app: hoisted ahead of a preceding sleep so the launch overlaps it.
+    """
+    out = [dict(s) for s in steps]
+    changes: list[dict] = []
+
+    def note(rule, i, saved, **extra):
+        changes.append({"rule": rule, "index": i, "saved_sec": round(saved, 3), **extra})
+
+    changed = True
+    while changed:
+        changed = False
+        focused = None
+        i = 0
+        while i < len(out):
+            s, k = out[i], out[i]["type"]
+            prev = out[i - 1] if i else None
+            nxt = out[i + 1] if i + 1 < len(out) else None
+            if k in ("focus", "focus_best"):
+                target = (k, s.get("title", DEFAULT_FOCUS) if k == "focus" else s.get("app", ""))
+                if target == focused or (nxt and nxt["type"] == "open"):
+                    note("drop_focus", i, _step_cost(s), step=out.pop(i))
+                    changed = True
+                    continue
+                focused = target
+            elif k in FOCUS_CHANGERS or (k == "type" and not _plain_text(s)):
+                focused = None
+            if k == "sleep":
+                if nxt and nxt["type"] == "sleep":
+                    keep = max(float(s.get("sec", 0.8)), float(nxt.get("sec", 0.8)))
+                    saved = _step_cost(s) + _step_cost(nxt) - keep
+                    merged = {"type": "sleep", "sec": keep}
+                    if s.get("_overlapped") or nxt.get("_overlapped"):
+                        merged["_overlapped"], saved = True, 0.0
+                    out[i:i + 2] = [merged]
+                    note("collapse_sleep", i, saved)
+                    changed = True
+                    continue
+                if nxt is None or nxt["type"] == "wait_window" or (prev and prev["type"] == "screenshot") or (
+                        prev and _plain_text(prev) and _plain_text(nxt)):
+                    # a sleep already overlapped by a hoisted launch was counted by "hoist"
+                    note("drop_sleep", i, 0.0 if s.pop("_overlapped", False) else _step_cost(s), step=out.pop(i))
+                    changed = True
+                    continue
+                if nxt["type"] in HOISTABLE:
+                    out[i], out[i + 1] = nxt, s
+                    note("hoist", i, 0.0 if s.get("_overlapped") else _step_cost(s), step=nxt)
+                    s["_overlapped"] = True
+                    changed = True
+                    i += 1
+                    continue
+            if k == "type" and nxt and nxt["type"] == "type":
+                out[i:i + 2] = [{"type": "type", "text": s.get("text", "") + nxt.get("text", "")}]
+                note("merge_type", i, _step_cost(nxt))
+                changed = True
+                continue
+            i += 1
+    for s in out:
+        s.pop("_overlapped", None)
+    return out, changes
+
+
+def explain_plan(before: list[dict], after: list[dict], changes: list[dict]) -> dict:
+    return {
+        "steps_before": len(before),
+        "steps_after": len(after),
+        "estimated_sec_before": round(sum(_step_cost(s) for s in before), 3),
+        "estimated_sec_saved": round(sum(c["saved_sec"] for c in changes), 3),
+        "changes": changes,
+    }
+
+
 # ================== Endpoints Agent ==================
+_BACKGROUND_TASKS: set = set()
+
+
+def _sse(event: str, data) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode()
+
+
+def sse_response(work) -> StreamingResponse:
+    """Stream `await work(emit)` as Server-Sent Events.
+
+    Each `emit(name, data)` becomes one event (with `ts` and `elapsed_ms`), the
+    returned dict is sent as `done`, a failure as `error`. The work runs in its
+    own task: a client that disconnects stops receiving events but does not
+    interrupt a plan halfway through.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    started = time.perf_counter()
+
+    def emit(name: str, data: dict):
+        data = {"ts": round(time.time(), 3), **data, "elapsed_ms": round((time.perf_counter() - started) * 1000, 3)}
+        queue.put_nowait((name, data))
+
+    async def runner():
+        try:
+            emit("done", await work(emit))
+        except HTTPException as e:
+            emit("error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            emit("error", {"status": 500, "detail": str(e)})
+        finally:
+            queue.put_nowait(None)
+
+    async def events():
+        task = asyncio.create_task(runner())
+        _BACKGROUND_TASKS.add(task)
+        task.add_done_callback(_BACKGROUND_TASKS.discard)
+        while (item := await queue.get()) is not None:
+            yield _sse(*item)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 class AgentCommand(BaseModel):
     text: str
 
 @app.post("/agent/command")
-async def agent_command(request: Request, payload: AgentCommand = Body(...)):
+async def agent_command(request: Request, payload: AgentCommand = Body(...), explain: bool = False):
     auth(request); require_enabled()
     log_event("agent_command", {"text": payload.text})
-    plan = interpret_command(payload.text)
-    if not plan:
+    interpreted, _ = current_profile().plan_cache.get_plan(payload.text)
+    if not interpreted:
         log_event("no_intent_detected", {"text": payload.text})
         return {"ok": False, "reason": "no_intent_detected"}
+    plan, changes = optimize_plan(interpreted)
     results = await run_plan(plan)
     log_event("plan_executed", {"plan": plan, "results": results})
-    return {"ok": True, "plan": plan, "results": results}
+    out = {"ok": True, "plan": plan, "results": results}
+    if explain:
+        out["explain"] = {**explain_plan(interpreted, plan, changes), "interpreted": interpreted}
+    return out
+
+@app.post("/agent/command/stream")
+async def agent_command_stream(request: Request, payload: AgentCommand = Body(...)):
+    auth(request); require_enabled()
+    log_event("agent_command", {"text": payload.text, "stream": True})
+
+    async def work(emit):
+        interpreted, cached = current_profile().plan_cache.get_plan(payload.text)
+        if not interpreted:
+            log_event("no_intent_detected", {"text": payload.text})
+            return {"ok": False, "reason": "no_intent_detected"}
+        plan, changes = optimize_plan(interpreted)
+        emit("plan", {"plan": plan, "cached": cached, "optimized": len(changes)})
+        results = await run_plan(plan, on_event=emit)
+        log_event("plan_executed", {"plan": plan, "results": results})
+        return {"ok": True, "results": results}
+    return sse_response(work)
+
+class AgentCommands(BaseModel):
+    commands: List[str]
+    # groupes d'indices pouvant s'exécuter en même temps (les étapes clavier/souris/fenêtres restent en série)
+    parallel_groups: List[List[int]] = Field(default_factory=list)
+    stop_on_error: bool = False
+
+AGENT_MAX_BATCH = int(AGENT_CFG.get("max_batch", 100))
+
+
+def _batch_schedule(n: int, groups: List[List[int]]) -> List[List[int]]:
+    """Execution order: each group runs where its first item sits, other items one by one."""
+    owner: Dict[int, int] = {}
+    for g, idx in enumerate(groups):
+        for i in idx:
+            if not 0 <= i < n:
+                raise HTTPException(422, f"parallel_groups: index {i} out of range")
+            if i in owner:
+                raise HTTPException(422, f"parallel_groups: index {i} listed twice")
+            owner[i] = g
+    schedule, seen = [], set()
+    for i in range(n):
+        if i not in owner:
+            schedule.append([i])
+        elif owner[i] not in seen:
+            seen.add(owner[i])
+            schedule.append(sorted(groups[owner[i]]))
+    return schedule
+
+
+@app.post("/agent/commands")
+async def agent_commands(request: Request, payload: AgentCommands = Body(...)):
+    auth(request); require_enabled()
+    if len(payload.commands) > AGENT_MAX_BATCH:
+        raise HTTPException(413, f"too many commands (max {AGENT_MAX_BATCH})")
+    t_start = time.perf_counter()
+    schedule = _batch_schedule(len(payload.commands), payload.parallel_groups)
+    log_event("agent_commands", {"count": len(payload.commands), "parallel_groups": payload.parallel_groups})
+
+    items = []
+    for i, text in enumerate(payload.commands):
+        t0 = time.perf_counter()
+        interpreted, cached = current_profile().plan_cache.get_plan(text)
+        plan, _ = optimize_plan(interpreted)
+        items.append({"index": i, "text": text, "plan": plan, "cached": cached,
+                      "timings": {"interpret_ms": round((time.perf_counter() - t0) * 1000, 3)}})
+    t_interpreted = time.perf_counter()
+
+    async def run_item(item: dict):
+        t0 = time.perf_counter()
+        if not item["plan"]:
+            item.update(ok=False, reason="no_intent_detected")
+        else:
+            item["results"] = await _run_plan_steps(item["plan"])
+            item["ok"] = all(r.get("ok", True) is not False for r in item["results"])
+        item["timings"]["run_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        return item["ok"]
+
+    async def run_chain(chain: List[dict]):
+        for item in chain:
+            await run_item(item)
+
+    devices = set().union(*(plan_devices(item["plan"]) for item in items))
+    failed = False
+    async with INPUT_SCHEDULER.lease(devices, owner="batch"):
+        for group in schedule:
+            if failed and payload.stop_on_error:
+                for i in group:
+                    items[i].update(ok=False, reason="skipped")
+                continue
+            members = [items[i] for i in group]
+            ui = [it for it in members if plan_devices(it["plan"])]
+            free = [it for it in members if not plan_devices(it["plan"])]
+            await asyncio.gather(run_chain(ui), *(run_item(it) for it in free))
+            failed = failed or not all(it["ok"] for it in members)
+
+    t_end = time.perf_counter()
+    log_event("agent_commands_done", {"count": len(items), "ok": sum(bool(it["ok"]) for it in items)})
+    return {
+        "ok": all(it["ok"] for it in items),
+        "items": items,
+        "timings": {"interpret_ms": round((t_interpreted - t_start) * 1000, 3),
+                    "run_ms": round((t_end - t_interpreted) * 1000, 3),
+                    "total_ms": round((t_end - t_start) * 1000, 3)},
+    }
 
 # =============== Mode LLM (Chat Completions + Tools) ===============
-try:
-    import json, httpx
-    HAVE_HTTPX = True
-except Exception:
-    HAVE_HTTPX = False
+HAVE_HTTPX = _available("httpx")
+httpx = _LazyImport("httpx")
 
 
 
@@ -605,9 +3183,93 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") or ""   # <-- via env
 OPENAI_BASE = os.getenv("OPENAI_BASE", "https://api.openai.com/v1")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+# ---- Pooled HTTP client (OpenAI + remote planner) ----
+HTTP_CFG = CFG.get('http', {})
+
+
+class HttpClientPool:
+    """App-lifetime httpx client: keep-alive (and optional HTTP/2) instead of a new client per call.
+
+    Every request is traced so `/status` can show how many TCP/TLS handshakes
+    were needed per host versus how many requests reused a pooled connection.
+    """
+
+    def __init__(self, cfg: Dict):
+        self.cfg = cfg
+        self.timeout = float(cfg.get("timeout", 30))
+        self.llm_timeout = float(cfg.get("llm_timeout", 120))
+        self._client = None
+        self._loop = None
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def _http2(self) -> bool:
+        if not self.cfg.get("http2", False):
+            return False
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning("http.http2 requested but the 'h2' package is missing; using HTTP/1.1")
+            return False
+        return True
+
+    async def _on_request(self, request):
+        counters = self.counters.setdefault(
+            request.url.host, {"requests": 0, "connections": 0, "tls_handshakes": 0}
+        )
+        counters["requests"] += 1
+
+        async def _trace(event: str, info: dict):
+            if event == "connection.connect_tcp.complete":
+                counters["connections"] += 1
+            elif event == "connection.start_tls.complete":
+                counters["tls_handshakes"] += 1
+
+        request.extensions["trace"] = _trace
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        # connections are bound to the loop that opened them
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                http2=self._http2(),
+                limits=httpx.Limits(
+                    max_connections=int(self.cfg.get("max_connections", 20)),
+                    max_keepalive_connections=int(self.cfg.get("max_keepalive", 10)),
+                    keepalive_expiry=float(self.cfg.get("keepalive_expiry", 30)),
+                ),
+                event_hooks={"request": [self._on_request]},
+            )
+            self._loop = loop
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            host: dict(c, reused=max(0, c["requests"] - c["connections"]))
+            for host, c in self.counters.items()
+        }
+
+
+HTTP_POOL = HttpClientPool(HTTP_CFG)
+
+if HAVE_HTTPX:
+    @app.on_event("shutdown")
+    async def _http_stop():
+        if not RUNNING_APPS:
+            await HTTP_POOL.aclose()
+
+PLANNER_URL = os.getenv("COPILOTPC_PLANNER_URL", "").strip()
+
 class LLMPlanner:
-    def __init__(self, base_url: str, token: str):
-        self.base = base_url.rstrip("/")
+    """Tool-calling loop; tools run in-process unless `base_url` points to a (remote) CopilotPC server."""
+    def __init__(self, base_url: Optional[str] = None, token: str = ""):
+        self.base = base_url.rstrip("/") if base_url else None
         self.token = token
 
     KNOWN_SITES = {
@@ -672,8 +3334,19 @@ class LLMPlanner:
                 "type":"function",
                 "function":{
                     "name":"screenshot",
-                    "description":"Faire une capture d'écran et renvoyer l'URL locale.",
-                    "parameters":{"type":"object","properties":{}}
+                    "description":"Faire une capture d'écran et renvoyer l'URL locale (preview=true : petite image JPEG, plus rapide).",
+                    "parameters":{"type":"object","properties":{"preview":{"type":"boolean"},"monitor":{"type":"integer","minimum":0}}}
+                }
+            },
+            {
+                "type": "function",
+                "function": {
+                    "name": "wait_window",
+                    "description": "Attendre qu'une fenêtre dont le titre contient 'title' apparaisse (retourne dès qu'elle existe).",
+                    "parameters": {"type": "object",
+                                   "properties": {"title": {"type": "string"},
+                                                  "timeout": {"type": "number", "minimum": 0, "maximum": 30}},
+                                   "required": ["title"]}
                 }
             },
             {
@@ -688,20 +3361,36 @@ class LLMPlanner:
             },
         ]
 
+    async def _get(self, path, params=None):
+        if self.base is None:
+            return await call_local(path, params)
+        params = dict(params or {})
+        if self.token:
+            params["token"] = self.token
+        r = await HTTP_POOL.client().get(f"{self.base}{path}", params=params)
+        return self._reply(r)
+
+    async def _post_text(self, path, text, params=None):
+        """Text in the request body (no URL length limit, not logged with the URL)."""
+        if self.base is None:
+            return await call_local(path, {**(params or {}), "text": text})
+        params = dict(params or {})
+        if self.token:
+            params["token"] = self.token
+        r = await HTTP_POOL.client().post(f"{self.base}{path}", params=params, content=text.encode("utf-8"),
+                                          headers={"Content-Type": "text/plain; charset=utf-8"})
+        return self._reply(r)
+
+    @staticmethod
+    def _reply(r):
+        ok = r.status_code < 400
+        try:
+            data = r.json()
+        except Exception:
+            data = {"raw": r.text}
+        return ok, r.status_code, data
+
     async def tool_dispatch(self, name, args):
-        # Utilitaires réseau locaux
-        async def _get(path, params=None):
-            params = params or {}
-            if self.token:
-                params["token"] = self.token
-            async with httpx.AsyncClient(timeout=30) as cli:
-                r = await cli.get(f"{self.base}{path}", params=params)
-                ok = r.status_code < 400
-                try:
-                    data = r.json()
-                except Exception:
-                    data = {"raw": await r.aread()}
-                return ok, r.status_code, data
 
         if name == "run_app":
             app_name = args.get("name", "")
@@ -709,56 +3398,62 @@ class LLMPlanner:
                 app_key = resolve_app(app_name)
             except Exception:
                 app_key = app_name
-            ok, status, data = await _get("/app/run", {"name": app_key})
+            ok, status, data = await self._get("/app/run", {"name": app_key})
             if not ok:
                 return {"ok": False, "status": status, "error": data, "tried_name": app_name, "normalized_key": app_key}
             return data
 
         if name == "sleep":
             sec = float(args.get("sec", 0.5))
-            sec = max(0.0, min(5.0, sec))
+            sec = max(0.0, min(PLAN_SLEEP_MAX, sec))
             await asyncio.sleep(sec)
             return {"ok": True, "slept": sec}
 
+        if name == "wait_window":
+            params = {"title": args["title"]}
+            if args.get("timeout") is not None:
+                params["timeout"] = max(0.0, min(PLAN_WAIT_MAX, float(args["timeout"])))
+            ok, status, data = await self._get("/window/wait", params)
+            return data if ok else {"ok": False, "status": status, "error": data}
+
         if name == "focus_window":
-            ok, status, data = await _get("/window/activate", {"title": args["title"]})
+            ok, status, data = await self._get("/window/activate", {"title": args["title"]})
             return data if ok else {"ok": False, "status": status, "error": data}
 
         if name == "open_url":
-            ok, status, data = await _get("/browser/open", {"url": args["url"]})
+            ok, status, data = await self._get("/browser/open", {"url": args["url"]})
             return data if ok else {"ok": False, "status": status, "error": data}
 
         if name == "paste_text":
             txt = args.get("text")
             if not isinstance(txt, str) or not txt.strip():
                 return {"ok": False, "status": 400, "error": "missing_text_argument"}
-            ok1, st1, d1 = await _get("/os/clipboard/set", {"text": txt})
-            ok2, st2, d2 = await _get("/os/keyboard/paste")
-            return {"ok": ok1 and ok2, "clipboard": d1, "paste": d2}
+            ok, status, data = await self._post_text("/os/keyboard/type", txt, {"strategy": "clipboard"})
+            return data if ok else {"ok": False, "status": status, "error": data}
 
         if name == "type_text":
             txt = args.get("text")
             if not isinstance(txt, str) or not txt.strip():
                 return {"ok": False, "status": 400, "error": "missing_text_argument"}
-            multiline = ("\n" in txt) or ("\r" in txt)
-            too_long = len(txt) > 300
-            has_non_ascii = any(ord(c) > 127 for c in txt)
-            if multiline or too_long or has_non_ascii:
-                return await self.tool_dispatch("paste_text", {"text": txt})
-            ok, status, data = await _get("/os/keyboard/type", {"text": txt})
+            # TEXT_INJECTOR choisit frappe directe, par blocs ou collage
+            ok, status, data = await self._post_text("/os/keyboard/type", txt)
             return data if ok else {"ok": False, "status": status, "error": data}
 
         if name == "hotkey":
-            ok, status, data = await _get("/os/keyboard/hotkey", {"keys": args["keys"]})
+            ok, status, data = await self._get("/os/keyboard/hotkey", {"keys": args["keys"]})
             return data if ok else {"ok": False, "status": status, "error": data}
 
         if name == "screenshot":
-            ok, status, data = await _get("/screen/screenshot")
+            params = dict(SHOT_PREVIEW) if args.get("preview") else {}
+            if args.get("monitor") is not None:
+                params["monitor"] = int(args["monitor"])
+            ok, status, data = await self._get("/screen/screenshot", params)
             return data if ok else {"ok": False, "status": status, "error": data}
 
         return {"error": f"unknown tool {name}"}
 
-    async def run(self, user_text: str):
+    async def run(self, user_text: str, on_event=None):
+        """Tool-calling loop; `on_event(name, data)` is called after each LLM turn and tool call."""
         if not OPENAI_API_KEY:
             return {"ok": False, "error": "OPENAI_API_KEY missing"}
         if not HAVE_HTTPX:
@@ -785,7 +3480,7 @@ class LLMPlanner:
 
         # ----------------- (2) Prompt système + messages -----------------
         try:
-            allowed_apps = ", ".join(sorted(ALLOW.keys())) or "(aucune)"
+            allowed_apps = ", ".join(sorted(current_settings().allow.keys())) or "(aucune)"
         except Exception:
             allowed_apps = "(indisponible)"
 
@@ -794,7 +3489,7 @@ class LLMPlanner:
             "- Si la cible est un SITE/Service (ex: coinbase, gmail, linkedin, youtube), utilise l'outil open_url avec l'URL complète.\n"
             "- N'utilise run_app QUE pour les applications installées et autorisées.\n"
             f"- Applications autorisées (allowlist): {allowed_apps}\n"
-            "- Pour ouvrir une application puis écrire dedans, séquence recommandée : run_app -> sleep(0.8) -> focus_window('Bloc-notes' ou 'Notepad') -> type_text (ou paste_text pour les longs textes).\n"
+            "- Pour ouvrir une application puis écrire dedans, séquence recommandée : run_app -> wait_window('Bloc-notes') -> focus_window('Bloc-notes' ou 'Notepad') -> type_text (ou paste_text pour les longs textes).\n"
             "- Après chaque étape, si l'action échoue (ex: not in allowlist), essaie une stratégie alternative (ex: open_url).\n"
             "- Utilise les outils pour agir; donne une courte réponse finale quand c'est terminé."
         )
@@ -804,7 +3499,9 @@ class LLMPlanner:
             {"role": "user", "content": user_text}
         ]
 
+        turn = 0
         while True:
+            turn += 1
             payload = {
                 "model": OPENAI_MODEL,
                 "messages": messages,
@@ -814,20 +3511,29 @@ class LLMPlanner:
             }
 
             url = f"{OPENAI_BASE}/chat/completions"
-            async with httpx.AsyncClient(timeout=120) as cli:
-                resp = await cli.post(url, headers=headers, json=payload)
-                if resp.status_code >= 400:
-                    try:
-                        return {"ok": False, "error": f"{resp.status_code} {resp.reason_phrase}", "body": resp.json()}
-                    except Exception:
-                        return {"ok": False, "error": f"{resp.status_code} {resp.reason_phrase}",
-                                "body": await resp.aread()}
-                data = resp.json()
+            cli = HTTP_POOL.client()
+            ts, t0 = time.time(), time.perf_counter()
+            resp = await cli.post(url, headers=headers, json=payload, timeout=HTTP_POOL.llm_timeout)
+            turn_ms = round((time.perf_counter() - t0) * 1000, 3)
+            if resp.status_code >= 400:
+                if on_event:
+                    on_event("llm_turn", {"turn": turn, "status": resp.status_code, "ts": round(ts, 3), "duration_ms": turn_ms})
+                try:
+                    return {"ok": False, "error": f"{resp.status_code} {resp.reason_phrase}", "body": resp.json()}
+                except Exception:
+                    return {"ok": False, "error": f"{resp.status_code} {resp.reason_phrase}",
+                            "body": resp.text}
+            data = resp.json()
 
             choice = (data.get("choices") or [{}])[0]
             message = choice.get("message", {})
             tool_calls = message.get("tool_calls") or []
             final_text = message.get("content")
+            if on_event:
+                on_event("llm_turn", {"turn": turn, "status": resp.status_code, "ts": round(ts, 3), "duration_ms": turn_ms,
+                                      "finish_reason": choice.get("finish_reason"),
+                                      "tool_calls": [tc["function"]["name"] for tc in tool_calls],
+                                      "content": final_text})
 
             if tool_calls:
                 # 1) Ajouter le message assistant contenant les tool_calls
@@ -842,7 +3548,11 @@ class LLMPlanner:
                         args = json.loads(args_json) if isinstance(args_json, str) else args_json
                     except Exception:
                         args = {}
+                    ts, t0 = time.time(), time.perf_counter()
                     result = await self.tool_dispatch(name, args)
+                    if on_event:
+                        on_event("tool_call", {"turn": turn, "id": tc["id"], "name": name, "args": args, "result": result,
+                                               "ts": round(ts, 3), "duration_ms": round((time.perf_counter() - t0) * 1000, 3)})
 
                     messages.append({
                         "role": "tool",
@@ -862,11 +3572,468 @@ class LLMCommand(BaseModel):
 async def agent_llm(request: Request, payload: LLMCommand = Body(...)):
     auth(request); require_enabled()
     log_event("agent_llm_request", {"text": payload.text})
-    planner = LLMPlanner(base_url=f"http://{HOST}:{PORT}", token=(TOKEN or ""))
+    planner = LLMPlanner(base_url=(PLANNER_URL or None), token=(current_settings().token or ""))
     res = await planner.run(payload.text)
     log_event("agent_llm_result", res)
     return res
 
+@app.post("/agent/llm/stream")
+async def agent_llm_stream(request: Request, payload: LLMCommand = Body(...)):
+    auth(request); require_enabled()
+    log_event("agent_llm_request", {"text": payload.text, "stream": True})
+    planner = LLMPlanner(base_url=(PLANNER_URL or None), token=(current_settings().token or ""))
+
+    async def work(emit):
+        res = await planner.run(payload.text, on_event=emit)
+        log_event("agent_llm_result", res)
+        return res
+    return sse_response(work)
+
+# ================== Jobs ==================
+JOBS_CFG = CFG.get('jobs', {})
+JOB_STATES = ("queued", "running", "done", "failed", "cancelled", "panic")
+
+
+class JobManager:
+    """Background jobs for long plans / LLM sessions: submit, poll, cancel.
+
+    Jobs are asyncio tasks on the server loop; a semaphore caps how many run at
+    once (the others stay `queued`). Finished jobs keep their result for `ttl`
+    seconds, then are evicted; at most `max_jobs` are tracked at any time.
+    """
+
+    def __init__(self, max_concurrent: int = 4, ttl: float = 600.0, max_jobs: int = 256, max_events: int = 200):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.ttl = float(ttl)
+        self.max_jobs = max(1, int(max_jobs))
+        self.max_events = int(max_events)
+        self.jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._sem = None
+        self._loop = None
+        self.submitted = self.evicted = 0
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._sem is None or self._loop is not loop:
+            self._sem, self._loop = asyncio.Semaphore(self.max_concurrent), loop
+        return self._sem
+
+    def evict(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        for jid in [j for j, job in self.jobs.items()
+                    if job["finished"] is not None and now - job["finished"] > self.ttl]:
+            del self.jobs[jid]
+            self.evicted += 1
+
+    def submit(self, kind: str, work, meta: Optional[dict] = None) -> dict:
+        """Start `await work(emit)` as a job; `emit(name, data)` records progress events."""
+        self.evict()
+        if len(self.jobs) >= self.max_jobs:
+            raise HTTPException(429, "too many jobs", headers={"Retry-After": "1"})
+        jid = uuid.uuid4().hex[:12]
+        job = {"id": jid, "kind": kind, "status": "queued", "meta": meta or {},
+               "created": time.time(), "started": None, "finished": None,
+               "result": None, "error": None, "events": deque(maxlen=self.max_events)}
+        self.jobs[jid] = job
+        task = asyncio.create_task(self._run(job, work))
+        self._tasks[jid] = task
+        task.add_done_callback(lambda _t, jid=jid: self._tasks.pop(jid, None))
+        self.submitted += 1
+        log_event("job_submitted", {"id": jid, "kind": kind})
+        return job
+
+    async def _run(self, job: dict, work):
+        def emit(name: str, data: dict):
+            job["events"].append({"event": name, "ts": round(time.time(), 3), **data})
+
+        try:
+            async with self._semaphore():
+                job["status"], job["started"] = "running", time.time()
+                job["result"] = await work(emit)
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+        except HTTPException as e:
+            # 423 : panic activé pendant le job, ses étapes restantes ne sont pas jouées
+            job["status"] = "panic" if e.status_code == 423 else "failed"
+            job["error"] = {"status": e.status_code, "detail": e.detail}
+        except Exception as e:
+            job["status"], job["error"] = "failed", {"status": 500, "detail": str(e)}
+        finally:
+            job["finished"] = time.time()
+            log_event("job_finished", {"id": job["id"], "status": job["status"]})
+
+    def get(self, jid: str) -> dict:
+        self.evict()
+        job = self.jobs.get(jid)
+        if job is None:
+            raise HTTPException(404, f"unknown job {jid}")
+        return job
+
+    def cancel(self, jid: str) -> dict:
+        """Cancel a queued/running job; a finished one is simply forgotten."""
+        job = self.get(jid)
+        task = self._tasks.get(jid)
+        if task is not None and not task.done():
+            task.cancel()
+            job["status"] = "cancelling"
+        else:
+            del self.jobs[jid]
+        return job
+
+    def cancel_all(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    @staticmethod
+    def view(job: dict, events: bool = True) -> dict:
+        out = {k: v for k, v in job.items() if k != "events"}
+        end = job["finished"] or time.time()
+        out["duration_ms"] = round((end - job["started"]) * 1000, 3) if job["started"] else None
+        if events:
+            out["events"] = list(job["events"])
+        return out
+
+    def stats(self) -> dict:
+        counts = {state: 0 for state in JOB_STATES}
+        for job in self.jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"max_concurrent": self.max_concurrent, "ttl": self.ttl, "tracked": len(self.jobs),
+                "submitted": self.submitted, "evicted": self.evicted, **counts}
+
+
+def _jobs_from(cfg: dict) -> JobManager:
+    return JobManager(
+        max_concurrent=int(cfg.get("max_concurrent", 4)),
+        ttl=float(cfg.get("result_ttl", 600)),
+        max_jobs=int(cfg.get("max_jobs", 256)),
+    )
+
+
+JOBS = _jobs_from(JOBS_CFG)
+
+
+@app.on_event("shutdown")
+def _jobs_stop():
+    current_profile().jobs.cancel_all()
+
+
+class JobRequest(BaseModel):
+    kind: Literal["command", "plan", "llm"] = "command"
+    text: Optional[str] = None
+    steps: Optional[List[dict]] = None
+
+
+@app.post("/jobs", status_code=202)
+async def jobs_submit(request: Request, payload: JobRequest = Body(...)):
+    auth(request); require_enabled()
+    if payload.kind == "plan":
+        if not payload.steps:
+            raise HTTPException(422, "steps required for a plan job")
+        steps = validate_plan(payload.steps)
+
+        async def work(emit):
+            results = await run_plan(steps, on_event=emit)
+            return {"ok": all(r.get("ok", True) is not False for r in results), "results": results}
+    elif not payload.text:
+        raise HTTPException(422, f"text required for a {payload.kind} job")
+    elif payload.kind == "command":
+        text = payload.text
+
+        async def work(emit):
+            interpreted, _ = current_profile().plan_cache.get_plan(text)
+            if not interpreted:
+                return {"ok": False, "reason": "no_intent_detected"}
+            plan, _ = optimize_plan(interpreted)
+            emit("plan", {"plan": plan})
+            return {"ok": True, "plan": plan, "results": await run_plan(plan, on_event=emit)}
+    else:
+        planner = LLMPlanner(base_url=(PLANNER_URL or None), token=(current_settings().token or ""))
+        text = payload.text
+
+        async def work(emit):
+            return await planner.run(text, on_event=emit)
+
+    job = current_profile().jobs.submit(payload.kind, work, {"text": payload.text} if payload.text else {"steps": len(payload.steps)})
+    return {"id": job["id"], "status": job["status"], "url": f"/jobs/{job['id']}"}
+
+
+@app.get("/jobs")
+async def jobs_list(request: Request):
+    auth(request)
+    jobs = current_profile().jobs
+    jobs.evict()
+    return {"jobs": [jobs.view(job, events=False) for job in jobs.jobs.values()], "stats": jobs.stats()}
+
+
+@app.get("/jobs/{job_id}")
+async def jobs_get(request: Request, job_id: str, events: bool = True):
+    auth(request)
+    jobs = current_profile().jobs
+    return jobs.view(jobs.get(job_id), events=events)
+
+
+@app.delete("/jobs/{job_id}")
+async def jobs_cancel(request: Request, job_id: str):
+    auth(request)
+    jobs = current_profile().jobs
+    return jobs.view(jobs.cancel(job_id), events=False)
+
+# ================== App factory ==================
+class Profile:
+    """One configuration served by an app: settings, panic state and its own pools.
+
+    What drives the physical desktop stays process-wide (UI threads, device
+    queues, window index, screenshot buffer, text injector, HTTP client), so
+    two profiles on the same machine never interleave input.
+    """
+
+    def __init__(self, cfg: dict, config_path: Optional[Path] = None, name: str = "profile"):
+        self.name = name
+        self.config_path = config_path
+        self.settings = _settings_from(cfg)
+        self.disabled = bool(cfg.get('security', {}).get('disabled', False))
+        self.watcher: Optional["ConfigWatcher"] = None
+        self.plan_cache = _plan_cache_from(cfg.get('agent', {}))
+        self.jobs = _jobs_from(cfg.get('jobs', {}))
+        self.browser_pool = _browser_pool_from(cfg.get('browser', {}))
+
+
+def _module_global(name: str):
+    return property(lambda self: globals()[name], lambda self, value: globals().__setitem__(name, value))
+
+
+class _ModuleProfile(Profile):
+    """The module-level configuration seen as a Profile: reads and writes go to
+    SETTINGS, DISABLED, JOBS... so patching the module still works."""
+
+    def __init__(self):
+        self.name = "default"
+        self.watcher = None
+
+    settings = _module_global("SETTINGS")
+    config_path = _module_global("CONFIG_PATH")
+    disabled = _module_global("DISABLED")
+    plan_cache = _module_global("PLAN_CACHE")
+    jobs = _module_global("JOBS")
+    browser_pool = _module_global("BROWSER_POOL")
+
+
+DEFAULT_PROFILE = _ModuleProfile()
+
+
+class _ProfileScope:
+    """ASGI middleware binding one profile to every request, websocket and lifespan event.
+
+    Requests and websockets also pin the settings snapshot current when they
+    start; lifespan hooks read the profile's latest one.
+    """
+
+    def __init__(self, app, profile: Profile):
+        self.app = app
+        self.profile = profile
+
+    async def __call__(self, scope, receive, send):
+        settings = self.profile.settings if scope["type"] != "lifespan" else None
+        token = _PROFILE.set((self.profile, settings))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _PROFILE.reset(token)
+
+
+def create_app(config=None, name: str = "profile") -> FastAPI:
+    """Return an app serving every route of this module on its own profile.
+
+    `config` is a parsed config dict, the path of a TOML file, or None for the
+    module configuration. Routes and startup hooks are shared with `app` and
+    nothing is re-imported, so an instance costs a few dicts and pools.
+    """
+    if config is None:
+        profile = DEFAULT_PROFILE
+    elif isinstance(config, dict):
+        profile = Profile(config, name=name)
+    else:
+        path = Path(config)
+        profile = Profile(tomllib.loads(path.read_text(encoding="utf-8")), config_path=path, name=name)
+    sub = FastAPI(title=app.title, version=app.version)
+    sub.router = app.router
+    sub.add_middleware(_ProfileScope, profile=profile)
+    sub.state.profile = profile
+    return sub
+
+
+app.add_middleware(_ProfileScope, profile=DEFAULT_PROFILE)
+
+# ================== Config reload ==================
+RELOAD_CFG = CFG.get('reload', {})
+# sections appliquées à chaud ; les autres (pools, exécuteurs, serveur) sont lues au démarrage
+HOT_SECTIONS = ("security", "features", "run")
+
+
+def _publish_module_settings(settings: Settings):
+    # les anciens noms du module suivent le snapshot, pour ceux qui lisent server.FEAT, server.ALLOW...
+    global CFG, TOKEN, FEAT, ALLOW, PW_ENABLED
+    CFG = dict(settings.cfg)
+    TOKEN = settings.token
+    FEAT = dict(settings.feat)
+    ALLOW = {name: list(cmd) for name, cmd in settings.allow.items()}
+    PW_ENABLED = settings.pw_enabled
+
+
+def reload_config(profile: Optional[Profile] = None, source: str = "api") -> dict:
+    """Re-read the profile's config file and swap in a new settings snapshot.
+
+    Requests already running finish on the snapshot they started with. A file
+    that cannot be read or parsed leaves the current settings in place (400).
+    Panic mode is never lifted by a reload.
+    """
+    profile = profile or current_profile()
+    if profile.config_path is None:
+        raise HTTPException(409, "profile has no config file to reload")
+    t0 = time.perf_counter()
+    try:
+        cfg = tomllib.loads(Path(profile.config_path).read_text(encoding="utf-8"))
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        log_event("config_reload_failed", {"profile": profile.name, "source": source, "error": str(e)})
+        raise HTTPException(400, f"config not reloaded: {e}")
+    old = profile.settings
+    new = _settings_from(cfg, env_token=profile is DEFAULT_PROFILE, version=old.version + 1)
+    profile.settings = new
+    if profile is DEFAULT_PROFILE:
+        _publish_module_settings(new)
+    if cfg.get('security', {}).get('disabled', False):
+        profile.disabled = True
+    profile.plan_cache.invalidate()
+    _EXE_PATHS.clear()
+    result = {
+        "status": "ok",
+        "profile": profile.name,
+        "version": new.version,
+        "changed": [key for key in ("token", "feat", "allow") if getattr(old, key) != getattr(new, key)],
+        "restart_required": sorted(k for k in set(old.cfg) | set(cfg)
+                                   if k not in HOT_SECTIONS and old.cfg.get(k) != cfg.get(k)),
+        "duration_ms": round((time.perf_counter() - t0) * 1000, 2),
+    }
+    log_event("config_reloaded", {"source": source, **result})
+    return result
+
+
+class ConfigWatcher:
+    """Poll a profile's config file and reload it on the server loop when it changes.
+
+    One stat() every `interval` seconds; mtime and size together also catch
+    editors that rewrite the file within the same mtime tick.
+    """
+
+    def __init__(self, profile: Profile, interval: float = 1.0):
+        self.profile = profile
+        self.interval = max(0.1, float(interval))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop = None
+        self._sig = None
+        self.reloads = self.failures = 0
+
+    def _signature(self):
+        try:
+            st = Path(self.profile.config_path).stat()
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            sig = self._signature()
+            # fichier absent le temps d'un remplacement atomique : on attend le suivant
+            if sig is None or sig == self._sig:
+                continue
+            self._sig = sig
+            try:
+                self._loop.call_soon_threadsafe(self._reload)
+            except RuntimeError:
+                break   # boucle fermée
+
+    def _reload(self):
+        try:
+            reload_config(self.profile, source="watcher")
+            self.reloads += 1
+        except HTTPException:
+            self.failures += 1   # déjà journalisé ; la prochaine écriture retente
+
+    def start(self, loop):
+        if self._thread:
+            return
+        self._loop = loop
+        self._sig = self._signature()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"config-watch-{self.profile.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {"interval": self.interval, "reloads": self.reloads, "failures": self.failures}
+
+
+@app.post("/admin/reload")
+async def admin_reload(request: Request):
+    auth(request)
+    # sur la boucle : le rechargement ne croise jamais un autre rechargement ni le watcher
+    return reload_config(current_profile())
+
+
+if RELOAD_CFG.get("watch", True):
+    @app.on_event("startup")
+    async def _config_watch_start():
+        prof = current_profile()
+        if prof.config_path is not None and prof.watcher is None:
+            prof.watcher = ConfigWatcher(prof, RELOAD_CFG.get("interval", 1.0))
+            prof.watcher.start(asyncio.get_running_loop())
+
+    @app.on_event("shutdown")
+    def _config_watch_stop():
+        prof = current_profile()
+        if prof.watcher is not None:
+            prof.watcher.stop()
+            prof.watcher = None
+
+# ================== Warm-up ==================
+STARTUP_CFG = CFG.get('startup', {})
+# feature -> lazily imported modules it needs
+FEATURE_IMPORTS = {
+    "mouse": ("pyautogui",),
+    "keyboard": ("pyautogui", "pyperclip"),
+    "window": ("Desktop",),
+    "screenshot": ("mss", "Image", "np"),
+}
+
+def _warm_imports(names: List[str]):
+    for name in names:
+        obj = globals().get(name)
+        if isinstance(obj, _LazyImport):
+            try:
+                obj._load()
+            except Exception as e:
+                log_event("warm_import_failed", {"module": name, "error": str(e)})
+
+def warm_import_names() -> List[str]:
+    # dans l'ordre de FEATURE_IMPORTS : la saisie d'abord, pywinauto (le plus lent) ensuite
+    names = [n for feature, mods in FEATURE_IMPORTS.items() if current_settings().feat.get(feature, True) for n in mods]
+    if HAVE_HTTPX and (OPENAI_API_KEY or PLANNER_URL):
+        names.append("httpx")
+    return list(dict.fromkeys(names))
+
+if STARTUP_CFG.get("warm_imports", True):
+    @app.on_event("startup")
+    def _warm_start():
+        # le serveur répond tout de suite ; les modules des features actives se chargent à côté
+        threading.Thread(target=_warm_imports, args=(warm_import_names(),), name="copilotpc-warm", daemon=True).start()
+
 # ================== Runner ==================
 if __name__=="__main__":
+    import uvicorn
     uvicorn.run(app,host=HOST,port=PORT)
@@ -1,8 +1,12 @@
 import importlib
+import json
 import sys
+import threading
 import types
 from pathlib import Path
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
 
 # --- Stub external dependencies to avoid interacting with the host OS ---
@@ -11,12 +15,19 @@ pyautogui_stub.moves = []
 pyautogui_stub.clicks = []
 pyautogui_stub.hotkeys = []
 pyautogui_stub.typed = []
+pyautogui_stub.events = []
 
 
-def _record_move(x, y, duration=0.0):
+def _record_move(x, y, duration=0.0, _pause=True):
     pyautogui_stub.moves.append((x, y, duration))
 
 
+def _recorder(name):
+    def record(*args, _pause=True, **kwargs):
+        pyautogui_stub.events.append((name, args, kwargs))
+    return record
+
+
 def _record_click(*args, **kwargs):
     pyautogui_stub.clicks.append((args, kwargs))
 
@@ -25,7 +36,7 @@ def _record_hotkey(*keys):
     pyautogui_stub.hotkeys.append(tuple(keys))
 
 
-def _record_type(text):
+def _record_type(text, interval=0.0, _pause=True):
     pyautogui_stub.typed.append(text)
 
 
@@ -33,6 +44,8 @@ pyautogui_stub.moveTo = _record_move
 pyautogui_stub.click = _record_click
 pyautogui_stub.hotkey = _record_hotkey
 pyautogui_stub.typewrite = _record_type
+for _name in ("moveRel", "mouseDown", "mouseUp", "keyDown", "keyUp", "scroll", "hscroll"):
+    setattr(pyautogui_stub, _name, _recorder(_name))
 sys.modules.setdefault("pyautogui", pyautogui_stub)
 
 pyperclip_stub = types.ModuleType("pyperclip")
@@ -43,11 +56,35 @@ def _copy(text):
     pyperclip_stub.copied.append(text)
 
 
+def _paste():
+    return pyperclip_stub.copied[-1] if pyperclip_stub.copied else ""
+
+
 pyperclip_stub.copy = _copy
+pyperclip_stub.paste = _paste
 sys.modules.setdefault("pyperclip", pyperclip_stub)
 
 
+class _DummyGrab:
+    def __init__(self, area):
+        self.left = area["left"]
+        self.top = area["top"]
+        self.width = area["width"]
+        self.height = area["height"]
+        self.size = (self.width, self.height)
+        # deterministic gradient so encoders have something to compress
+        row = bytes((x * 7 + self.top) % 256 for x in range(self.width * 3))
+        self.rgb = row * self.height
+
+
 class _DummyShot:
+    monitors = [
+        {"left": 0, "top": 0, "width": 96, "height": 48},
+        {"left": 0, "top": 0, "width": 48, "height": 48},
+        {"left": 48, "top": 0, "width": 48, "height": 48},
+    ]
+    grabs: list[dict] = []
+
     def __init__(self):
         self.paths: list[Path] = []
 
@@ -58,6 +95,10 @@ class _DummyShot:
         self.paths.append(path)
         return str(path)
 
+    def grab(self, area):
+        _DummyShot.grabs.append(dict(area))
+        return _DummyGrab(area)
+
 
 class _DummyMSSCtx:
     def __init__(self):
@@ -78,6 +119,7 @@ def _mss_factory():
 
 
 mss_stub.mss = _mss_factory
+mss_stub.tools = types.SimpleNamespace(to_png=lambda data, size, level=6, output=None: b"\x89PNG-stub" + bytes(data[:16]))
 sys.modules.setdefault("mss", mss_stub)
 
 
@@ -182,7 +224,9 @@ def _reset_stubs():
     pyautogui_stub.clicks.clear()
     pyautogui_stub.hotkeys.clear()
     pyautogui_stub.typed.clear()
+    pyautogui_stub.events.clear()
     pyperclip_stub.copied.clear()
+    _DummyShot.grabs.clear()
     _DummyDesktop.set_windows(["Chrome"])
     yield
 
@@ -198,3 +242,52 @@ def load_server(monkeypatch):
 @pytest.fixture
 def server_module(load_server, tmp_path):
     return load_server(tmp_path)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, None))
+        self._reply({"status": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        self.server.requests.append(("POST", self.path, raw))
+        if self.path.startswith("/os/"):  # CopilotPC body endpoints
+            self._reply({"status": "ok"})
+            return
+        replies = self.server.post_replies
+        self._reply(replies.pop(0) if replies else {})
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_http_server():
+    """Local keep-alive HTTP server counting TCP connections; scripted JSON replies to POSTs."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    httpd.daemon_threads = True
+    httpd.connections = 0
+    httpd.requests = []
+    httpd.post_replies = []
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
@@ -2,16 +2,10 @@ import asyncio
 
 import pytest
 
+import agent_llm
 from agent_llm import LLMPlanner
 
 
-def test_needs_clipboard_detects_complex_text():
-    assert LLMPlanner._needs_clipboard("line1\nline2") is True
-    assert LLMPlanner._needs_clipboard("a" * 400) is True
-    assert LLMPlanner._needs_clipboard("café") is True
-    assert LLMPlanner._needs_clipboard("simple") is False
-
-
 def test_tool_schema_exposes_expected_tools():
     planner = LLMPlanner(base_url="http://localhost", token="")
     names = {item["function"]["name"] for item in planner.tool_schema()}
@@ -30,28 +24,31 @@ def test_tool_dispatch_type_text(monkeypatch):
     planner = LLMPlanner(base_url="http://localhost", token="")
     calls = []
 
-    async def fake_call(path, params=None):
-        calls.append((path, dict(params)))
+    async def fake_post(path, text, params=None):
+        calls.append((path, text, dict(params or {})))
         return {"status": "ok"}
 
-    monkeypatch.setattr(planner, "_call_local", fake_call)
+    monkeypatch.setattr(planner, "_post_text", fake_post)
     result = asyncio.run(planner.tool_dispatch("type_text", {"text": "hello"}))
     assert result["status"] == "ok"
-    assert calls == [("/os/keyboard/type", {"text": "hello"})]
+    assert calls == [("/os/keyboard/type", "hello", {})]
 
 
-def test_tool_dispatch_type_text_uses_clipboard(monkeypatch):
+def test_tool_dispatch_leaves_strategy_to_server(monkeypatch):
     planner = LLMPlanner(base_url="http://localhost", token="")
     calls = []
 
-    async def fake_call(path, params=None):
-        calls.append((path, dict(params)))
+    async def fake_post(path, text, params=None):
+        calls.append((path, text, dict(params or {})))
         return {"status": "ok"}
 
-    monkeypatch.setattr(planner, "_call_local", fake_call)
+    monkeypatch.setattr(planner, "_post_text", fake_post)
     asyncio.run(planner.tool_dispatch("type_text", {"text": "é"}))
-    assert calls[0][0] == "/os/clipboard/set"
-    assert calls[1][0] == "/os/keyboard/paste"
+    asyncio.run(planner.tool_dispatch("paste_text", {"text": "hello"}))
+    assert calls == [
+        ("/os/keyboard/type", "é", {}),
+        ("/os/keyboard/type", "hello", {"strategy": "clipboard"}),
+    ]
 
 
 def test_tool_dispatch_missing_text(monkeypatch):
@@ -65,3 +62,30 @@ def test_tool_dispatch_unknown_tool(monkeypatch):
     planner = LLMPlanner(base_url="http://localhost", token="")
     result = asyncio.run(planner.tool_dispatch("unknown", {}))
     assert "unknown tool" in result["error"]
+
+
+def test_run_reuses_one_connection_per_session(monkeypatch, stub_http_server):
+    monkeypatch.setattr(agent_llm, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(agent_llm, "OPENAI_BASE", stub_http_server.url)
+    tool_call = {"id": "c1", "function": {"name": "type_text", "arguments": '{"text": "hi"}'}}
+    stub_http_server.post_replies = [
+        {"output": [{"type": "message", "message": {"tool_calls": [tool_call], "content": []}}]},
+        {"output": [{"type": "message", "message": {"content": [{"type": "text", "text": "done"}]}}]},
+    ]
+
+    async def scenario():
+        async with LLMPlanner(base_url=stub_http_server.url, token="") as planner:
+            result = await planner.run("tape hi")
+            return result, dict(planner.stats)
+
+    result, stats = asyncio.run(scenario())
+    assert result == {"ok": True, "final": "done"}
+    assert [r[:2] for r in stub_http_server.requests] == [
+        ("POST", "/responses"),
+        ("POST", "/os/keyboard/type"),
+        ("POST", "/responses"),
+    ]
+    assert stub_http_server.requests[1][2] == b"hi"
+    assert stats["requests"] == 3
+    assert stats["connections"] == 1
+    assert stub_http_server.connections == 1
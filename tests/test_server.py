@@ -1,10 +1,13 @@
 import asyncio
 import sys
+import threading
+import time
 import types
 from pathlib import Path
 
 import pytest
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 
 
 def test_resolve_config_path_prefers_env(load_server, tmp_path):
@@ -199,3 +202,1350 @@ solo = \"/usr/bin/solo\"
 """
     module = load_server(tmp_path, config_text=config_text)
     assert module.ALLOW["solo"] == ["/usr/bin/solo"]
+
+
+def test_llm_planner_dispatches_in_process(server_module, monkeypatch):
+    def no_http(*args, **kwargs):
+        raise AssertionError("in-process dispatch must not open an HTTP client")
+
+    monkeypatch.setattr(server_module.httpx, "AsyncClient", no_http)
+    planner = server_module.LLMPlanner(token=server_module.TOKEN)
+    result = asyncio.run(planner.tool_dispatch("type_text", {"text": "hello"}))
+    assert result["status"] == "ok" and result["strategy"] == "direct"
+    assert sys.modules["pyautogui"].typed == ["hello"]
+
+
+def test_llm_planner_in_process_honours_flags_and_panic(load_server, tmp_path):
+    module = load_server(tmp_path, extra_env={"COPILOTPC_FEATURE_KEYBOARD": "0"})
+    planner = module.LLMPlanner()
+    denied = asyncio.run(planner.tool_dispatch("hotkey", {"keys": "ctrl+s"}))
+    assert denied["ok"] is False and denied["status"] == 403
+
+    module.DISABLED = True
+    blocked = asyncio.run(planner.tool_dispatch("focus_window", {"title": "Chrome"}))
+    assert blocked["ok"] is False and blocked["status"] == 423
+
+
+def test_llm_planner_pools_openai_connections(server_module, monkeypatch, stub_http_server):
+    monkeypatch.setattr(server_module, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(server_module, "OPENAI_BASE", stub_http_server.url)
+    tool_call = {"id": "c1", "type": "function", "function": {"name": "hotkey", "arguments": '{"keys": "ctrl+s"}'}}
+    stub_http_server.post_replies = [
+        {"choices": [{"message": {"role": "assistant", "tool_calls": [tool_call]}}]},
+        {"choices": [{"message": {"role": "assistant", "tool_calls": [tool_call]}}]},
+        {"choices": [{"message": {"role": "assistant", "content": "fini"}}]},
+    ]
+
+    async def scenario():
+        try:
+            return await server_module.LLMPlanner().run("enregistre")
+        finally:
+            await server_module.HTTP_POOL.aclose()
+
+    result = asyncio.run(scenario())
+    assert result == {"ok": True, "final": "fini"}
+    assert sys.modules["pyautogui"].hotkeys == [("ctrl", "s"), ("ctrl", "s")]
+    stats = server_module.HTTP_POOL.stats()["127.0.0.1"]
+    assert stats["requests"] == 3
+    assert stats["connections"] == 1
+    assert stats["reused"] == 2
+    assert stub_http_server.connections == 1
+
+
+def test_window_index_serves_lookups_from_cache(server_module):
+    server_module.Desktop.set_windows(["Sans titre - Bloc-notes", "Chrome"])
+    index = server_module.WINDOW_INDEX
+    index.invalidate()
+    assert server_module._focus("bloc") == "Sans titre - Bloc-notes"
+    assert server_module._focus("CHROME") == "Chrome"
+    assert index.stats["refreshes"] == 1
+    assert set(index.handles()) == {"Sans titre - Bloc-notes", "Chrome"}
+
+
+def test_window_index_refreshes_on_miss_and_events(server_module):
+    index = server_module.WINDOW_INDEX
+    server_module.Desktop.set_windows(["Chrome"])
+    index.invalidate()
+    assert server_module._focus("Chrome") == "Chrome"
+
+    server_module.Desktop.set_windows(["Chrome", "Notepad"])
+    assert server_module._focus("notepad") == "Notepad"  # miss -> refresh
+    assert index.stats["refreshes"] == 2
+
+    server_module.Desktop.set_windows(["Excel"])
+    index.on_window_event()
+    with pytest.raises(server_module.HTTPException):
+        server_module._focus("Chrome")
+    assert index.stats["refreshes"] == 3
+
+
+def test_window_index_invalidates_when_focus_fails(server_module):
+    index = server_module.WINDOW_INDEX
+    server_module.Desktop.set_windows(["Notepad"])
+    index.invalidate()
+    stale = index.find("Notepad")[1]
+
+    def _gone():
+        raise RuntimeError("window closed")
+
+    stale.set_focus = _gone
+    server_module.Desktop.set_windows(["Notepad"])  # recreated window
+    fresh = server_module.Desktop.windows_list[0]
+    assert server_module._focus("Notepad") == "Notepad"
+    assert fresh.focused is True
+    assert index.stats["invalidations"] >= 2
+
+
+def test_window_index_stop_joins_its_threads(server_module):
+    index = server_module.WINDOW_INDEX
+    index.start()
+    threads = list(index._threads)
+    assert threads and all(th.is_alive() for th in threads)
+    index.stop()
+    assert not index._threads
+    assert not any(th.is_alive() for th in threads)
+    index.start()  # un cycle stop/start repart proprement
+    assert all(th.is_alive() for th in index._threads)
+    index.stop()
+
+
+def test_window_resolve_ranks_exact_prefix_substring(server_module):
+    server_module.Desktop.set_windows(["Mon Notepad++", "Notepad - notes.txt", "Notepad"])
+    index = server_module.WINDOW_INDEX
+    index.invalidate()
+    res = index.resolve(["notepad"])
+    assert res["title"] == "Notepad" and res["match"] == "exact"
+    res = index.resolve(["bloc-notes", "notepad -"])
+    assert res["title"] == "Notepad - notes.txt" and res["match"] == "prefix"
+    assert res["scanned"] == 3 and set(res["timings"]) == {"snapshot_ms", "match_ms"}
+    assert index.resolve(["excel"]) is None
+
+
+def test_focus_best_step_resolves_in_one_pass(server_module):
+    server_module.Desktop.set_windows(["Chrome", "Sans titre - Bloc-notes"])
+    server_module.WINDOW_INDEX.invalidate()
+    results = asyncio.run(server_module.run_plan([{"type": "focus_best", "app": "notepad", "fallback": "notepad"}]))
+    assert results[0]["ok"] is True
+    assert results[0]["window"] == "Sans titre - Bloc-notes"
+    assert results[0]["match"] == "prefix"  # "Sans titre" alias
+    assert "timings" in results[0]
+    assert server_module.WINDOW_INDEX.stats["refreshes"] == 1
+
+
+def test_focus_best_falls_back_to_default_focus(server_module):
+    server_module.Desktop.set_windows(["Chrome"])
+    server_module.WINDOW_INDEX.invalidate()
+    assert server_module._focus_best("notepad")["window"] == "Chrome"
+
+
+def test_llm_focus_window_uses_app_aliases(server_module):
+    server_module.Desktop.set_windows(["Chrome", "Sans titre - Bloc-notes"])
+    server_module.WINDOW_INDEX.invalidate()
+    planner = server_module.LLMPlanner()
+    result = asyncio.run(planner.tool_dispatch("focus_window", {"title": "notepad"}))
+    assert result["window"] == "Sans titre - Bloc-notes"
+    assert result["match"] == "prefix"
+
+
+def test_open_app_plan_waits_for_window_instead_of_sleeping(server_module):
+    plan = server_module.interpret_command("ouvre notepad et tape bonjour")
+    assert [step["type"] for step in plan] == ["run_app", "wait_window", "focus_best", "type"]
+    assert plan[1] == {"type": "wait_window", "app": "notepad", "fallback": "notepad", "new": True}
+
+
+def test_wait_window_returns_once_window_appears(server_module, monkeypatch):
+    index = server_module.WINDOW_INDEX
+    real_refresh = index.refresh
+    calls = []
+
+    def refresh():
+        calls.append(1)
+        if len(calls) == 3:
+            server_module.Desktop.set_windows(["Chrome", "Sans titre - Bloc-notes"])
+        return real_refresh()
+
+    monkeypatch.setattr(index, "refresh", refresh)
+    results = asyncio.run(server_module.run_plan([{"type": "wait_window", "app": "notepad", "timeout": 5}]))
+    assert results[0]["ok"] is True
+    assert results[0]["window"] == "Sans titre - Bloc-notes"
+    assert results[0]["polls"] == 3
+    assert server_module._test_sleep_calls[:2] == [pytest.approx(0.05), pytest.approx(0.075)]
+
+
+def test_open_app_waits_for_a_new_window_not_an_open_one(server_module, monkeypatch):
+    desktop = server_module.Desktop
+    desktop.set_windows(["Chrome", "Sans titre - Bloc-notes"])
+    window_cls = type(desktop.windows_list[0])
+    old = desktop.windows_list[1]
+    launched = []
+
+    def popen(cmd):
+        launched.append(cmd)
+
+    index = server_module.WINDOW_INDEX
+    real_refresh = index.refresh
+    polls = []
+
+    def refresh():
+        if launched:
+            polls.append(1)
+            if len(polls) == 3:   # the launched app shows up on the third poll
+                desktop.windows_list.append(window_cls("Sans titre - Bloc-notes"))
+        return real_refresh()
+
+    monkeypatch.setattr(server_module.subprocess, "Popen", popen)
+    monkeypatch.setattr(server_module.shutil, "which", lambda exe: exe)
+    monkeypatch.setattr(index, "refresh", refresh)
+    plan = server_module.interpret_command("ouvre notepad")
+    results = asyncio.run(server_module.run_plan(plan))
+    assert [r["ok"] for r in results] == [True, True, True]
+    assert results[1]["polls"] == 3 and results[1]["new"] is True
+    assert desktop.windows_list[2].focused and not old.focused
+
+    # single-instance app: no new window before the timeout, the open one is used
+    desktop.set_windows(["Sans titre - Bloc-notes"])
+    launched.clear()
+    plan[1]["timeout"] = 0
+    results = asyncio.run(server_module.run_plan(plan))
+    assert results[1]["new"] is False and results[2]["ok"] is True
+
+
+def test_open_app_plan_continues_when_no_window_matches(server_module, monkeypatch):
+    server_module.Desktop.set_windows(["Chrome"])
+    server_module.WINDOW_INDEX.invalidate()
+    monkeypatch.setattr(server_module.subprocess, "Popen", lambda cmd: None)
+    monkeypatch.setattr(server_module.shutil, "which", lambda exe: exe)
+    monkeypatch.setattr(server_module, "WAIT_WINDOW_TIMEOUT", 0)
+    results = asyncio.run(server_module.run_plan(server_module.interpret_command("ouvre notepad et tape bonjour")))
+    assert len(results) == 4
+    assert results[1]["ok"] is False and results[1]["timed_out"] and "504" in results[1]["error"]
+    assert results[2]["window"] == "Chrome"   # focus_best fell back to DEFAULT_FOCUS
+    assert sys.modules["pyautogui"].typed == ["bonjour"]
+
+
+def test_wait_window_times_out(server_module):
+    client = TestClient(server_module.app)
+    response = client.get(
+        "/window/wait",
+        params={"token": server_module.TOKEN, "title": "Excel", "timeout": 0},
+    )
+    assert response.status_code == 504
+
+
+def test_llm_wait_window_tool(server_module):
+    server_module.Desktop.set_windows(["Notepad"])
+    planner = server_module.LLMPlanner()
+    result = asyncio.run(planner.tool_dispatch("wait_window", {"title": "notepad", "timeout": 1}))
+    assert result["status"] == "ok" and result["window"] == "Notepad"
+
+
+def test_plan_typing_runs_off_the_event_loop(server_module, monkeypatch):
+    release = threading.Event()
+    typed = []
+
+    def slow_type(text):
+        release.wait(2)
+        typed.append(text)
+
+    monkeypatch.setattr(server_module.pyautogui, "typewrite", slow_type)
+
+    async def scenario():
+        task = asyncio.create_task(server_module.run_plan([{"type": "type", "text": "long text"}]))
+        turns = 0
+        while not task.done() and turns < 5:
+            await asyncio.wait({task}, timeout=0.01)
+            turns += 1
+        depth = server_module.UI_EXECUTOR.stats()["queue_depth"]
+        busy = server_module.UI_EXECUTOR.stats()["busy_devices"]
+        release.set()
+        return await task, turns, depth, busy
+
+    results, turns, depth, busy = asyncio.run(scenario())
+    assert results[0]["ok"] is True and results[0]["strategy"] == "direct"
+    assert turns == 5  # the loop kept running while the worker was typing
+    assert depth == 1 and busy == ["keyboard"]
+    assert typed == ["long text"]
+
+
+def test_status_reports_ui_executor(server_module):
+    client = TestClient(server_module.app)
+    client.get("/os/keyboard/type", params={"token": server_module.TOKEN, "text": "a"})
+    data = client.get("/status", params={"token": server_module.TOKEN}).json()
+    assert data["ui_executor"]["completed"] >= 1
+    assert data["ui_executor"]["queue_depth"] == 0
+
+
+def test_input_scheduler_is_fifo_per_device(server_module):
+    sched = server_module.InputScheduler(max_queue=8)
+    order = []
+
+    async def worker(name, devices):
+        async with sched.lease(devices, owner=name):
+            order.append(name)
+            await asyncio.wait({asyncio.get_running_loop().create_future()}, timeout=0.01)
+
+    async def scenario():
+        await asyncio.gather(
+            worker("a", ["keyboard"]),
+            worker("b", ["keyboard", "window"]),
+            worker("c", ["keyboard"]),
+            worker("m", ["mouse"]),
+        )
+
+    asyncio.run(scenario())
+    assert [n for n in order if n != "m"] == ["a", "b", "c"]
+    assert order.index("m") < order.index("b")  # other devices are not blocked
+    stats = sched.stats()["devices"]["keyboard"]
+    assert stats["grants"] == 3 and stats["max_depth"] == 2
+    assert sum(stats["wait_ms_histogram"].values()) == 3
+
+
+def test_input_scheduler_rejects_when_queue_full(server_module):
+    sched = server_module.InputScheduler(max_queue=1)
+
+    async def scenario():
+        hold = asyncio.Event()
+
+        async def holder():
+            async with sched.lease(["keyboard"]):
+                await hold.wait()
+
+        async def waiter():
+            async with sched.lease(["keyboard"]):
+                pass
+
+        t1 = asyncio.create_task(holder())
+        await asyncio.wait({t1}, timeout=0.01)
+        t2 = asyncio.create_task(waiter())
+        await asyncio.wait({t2}, timeout=0.01)
+        with pytest.raises(server_module.HTTPException) as exc:
+            async with sched.lease(["keyboard", "mouse"]):
+                pass
+        hold.set()
+        await asyncio.gather(t1, t2)
+        return exc.value
+
+    err = asyncio.run(scenario())
+    assert err.status_code == 429
+    assert err.detail["device"] == "keyboard" and err.detail["queue_position"] == 2
+    assert sched.stats()["rejected"] == 1
+    assert sched.stats()["devices"]["mouse"]["busy"] is False
+
+
+def test_plan_lease_is_reentrant(server_module):
+    async def scenario():
+        async with server_module.INPUT_SCHEDULER.lease(["keyboard", "window"], owner="batch"):
+            return await server_module.run_plan([{"type": "type", "text": "x"}, {"type": "focus", "title": "Chrome"}])
+
+    results = asyncio.run(scenario())
+    assert all(r["ok"] for r in results)
+    assert server_module.INPUT_SCHEDULER.stats()["devices"]["keyboard"]["busy"] is False
+
+
+def test_screenshot_is_kept_in_memory_with_unique_ids(server_module):
+    client = TestClient(server_module.app)
+    first = client.get("/screen/screenshot").json()
+    second = client.get("/screen/screenshot", params={"format": "jpeg", "quality": 50}).json()
+    assert first["id"] != second["id"]
+    assert "path" not in first and not list(server_module.SHOTS.glob(f"{first['id']}.*"))
+
+    png = client.get(first["url"])
+    assert png.status_code == 200 and png.headers["content-type"] == "image/png"
+    assert png.content.startswith(b"\x89PNG")
+    jpg = client.get(second["url"])
+    assert jpg.headers["content-type"] == "image/jpeg" and len(jpg.content) == second["bytes"]
+
+
+def test_screenshot_region_monitor_and_scale(server_module):
+    client = TestClient(server_module.app)
+    data = client.get(
+        "/screen/screenshot",
+        params={"monitor": 2, "left": 4, "top": 2, "width": 20, "height": 10, "scale": 0.5},
+    ).json()
+    assert sys.modules["mss"].mss().impl.grabs[-1] == {"left": 52, "top": 2, "width": 20, "height": 10}
+    assert (data["width"], data["height"]) == (10, 5)
+    assert client.get("/screen/screenshot", params={"monitor": 9}).status_code == 400
+
+
+def test_screenshot_save_falls_back_to_disk(server_module):
+    client = TestClient(server_module.app)
+    data = client.get("/screen/screenshot", params={"save": True}).json()
+    assert Path(data["path"]).exists()
+    server_module.SHOT_BUFFER._items.clear()
+    assert client.get(data["url"]).status_code == 200
+    Path(data["path"]).unlink()
+    assert client.get(data["url"]).status_code == 404
+
+
+def test_shot_buffer_evicts_least_recently_used(server_module):
+    buf = server_module.ShotBuffer(max_items=2)
+    buf.put("a", b"1", "image/png")
+    buf.put("b", b"2", "image/png")
+    buf.get("a")
+    buf.put("c", b"3", "image/png")
+    assert buf.get("b") is None and buf.get("a") is not None
+    assert buf.stats() == {"items": 2, "bytes": 2, "evicted": 1}
+
+
+def test_llm_screenshot_preview(server_module):
+    planner = server_module.LLMPlanner()
+    full = asyncio.run(planner.tool_dispatch("screenshot", {}))
+    preview = asyncio.run(planner.tool_dispatch("screenshot", {"preview": True}))
+    assert preview["format"] == "jpeg"
+    assert preview["width"] < full["width"]
+
+
+def test_dirty_rects_merges_changed_tiles(server_module):
+    np = pytest.importorskip("numpy")
+    prev = np.zeros((64, 96, 3), dtype=np.uint8)
+    cur = prev.copy()
+    assert server_module.dirty_rects(prev, cur, tile=16) == []
+    cur[5, 20] = 255     # tile row 0, col 1
+    cur[20, 20] = 255    # tile row 1, col 1 -> merged vertically
+    cur[40, 70:90] = 9   # tile row 2, cols 4-5 -> one horizontal run
+    assert server_module.dirty_rects(prev, cur, tile=16) == [(16, 0, 16, 32), (64, 32, 32, 16)]
+    assert server_module.dirty_rects(None, cur, tile=16) == [(0, 0, 96, 64)]
+    edge = prev.copy()
+    edge[63, 95] = 1
+    assert server_module.dirty_rects(prev, edge, tile=40) == [(80, 40, 16, 24)]
+
+
+def test_screenshot_delta_mode_returns_changed_regions(server_module, monkeypatch):
+    np = pytest.importorskip("numpy")
+    frames = [np.zeros((48, 96, 3), dtype=np.uint8) for _ in range(3)]
+    frames[2][10:12, 60:70] = 200
+
+    class _Img:
+        def __init__(self, arr):
+            self.size = (arr.shape[1], arr.shape[0])
+            self.rgb = arr.tobytes()
+
+    monkeypatch.setattr(server_module, "_grab", lambda monitor=0, region=None: _Img(frames.pop(0)))
+    client = TestClient(server_module.app)
+    params = {"delta": True, "session": "ui", "tile": 16}
+    first = client.get("/screen/screenshot", params=params).json()
+    assert first["mode"] == "full" and len(first["rects"]) == 1
+    same = client.get("/screen/screenshot", params=params).json()
+    assert same["mode"] == "delta" and same["rects"] == [] and same["hash"] == first["hash"]
+    changed = client.get("/screen/screenshot", params=params).json()
+    assert changed["previous_hash"] == first["hash"] != changed["hash"]
+    assert [(r["x"], r["y"], r["w"], r["h"]) for r in changed["rects"]] == [(48, 0, 32, 16)]
+    assert changed["bytes"] < first["bytes"]
+    # no shared default baseline: a delta without session is refused before grabbing
+    assert client.get("/screen/screenshot", params={"delta": True}).status_code == 422
+    batch = client.post("/os/batch", params={"token": server_module.TOKEN},
+                        json={"actions": [{"action": "screenshot", "delta": True}]})
+    assert batch.status_code == 422
+
+
+def test_screen_stream_websocket_pushes_jpeg_frames(server_module):
+    client = TestClient(server_module.app)
+    url = f"/screen/stream/ws?token={server_module.TOKEN}&fps=10"
+    with client.websocket_connect(url) as ws1, client.websocket_connect(url) as ws2:
+        frames = [ws1.receive_bytes(), ws2.receive_bytes(), ws1.receive_bytes()]
+        assert all(f.startswith(b"\xff\xd8") for f in frames)
+        assert len(server_module.SCREEN_STREAMS) == 1  # one capture loop for both viewers
+    deadline = time.monotonic() + 2  # the server drops the subscriptions after the sockets close
+    while server_module.SCREEN_STREAMS and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server_module.SCREEN_STREAMS == {}  # removed with its last viewer
+
+
+def test_screen_stream_normalises_scale(server_module):
+    stream = server_module._screen_stream(0, 60, 0.4999)
+    assert stream.key == (0, 60, 0.5)
+    assert server_module._screen_stream(0, 60, 0.52) is stream
+    assert server_module._screen_stream(0, 500, 0.01).key == (0, 100, 0.25)
+
+
+def test_screen_stream_websocket_requires_token(server_module):
+    client = TestClient(server_module.app)
+    with pytest.raises(Exception):
+        with client.websocket_connect("/screen/stream/ws?token=nope") as ws:
+            ws.receive_bytes()
+
+
+def test_screen_stream_mjpeg(server_module):
+    client = TestClient(server_module.app)
+    response = client.get(
+        "/screen/stream.mjpeg",
+        params={"token": server_module.TOKEN, "frames": 2, "fps": 15},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/x-mixed-replace")
+    assert response.content.count(b"--frame\r\nContent-Type: image/jpeg") == 2
+
+
+def test_stream_subscriber_drops_stale_frames(server_module):
+    sub = server_module._StreamSubscriber(fps=10)
+    sub.push(b"1", now=1.0)
+    sub.push(b"2", now=1.05)  # faster than the viewer's fps: skipped
+    sub.push(b"3", now=1.2)   # viewer never read frame 1: replaced, not queued
+    assert sub.dropped == 1
+    assert asyncio.run(sub.next_frame()) == b"3"
+
+
+GOLDEN_INTENTS = Path(__file__).parent / "data" / "intent_golden.json"
+
+
+def test_interpret_command_matches_golden_corpus(server_module):
+    import json
+
+    corpus = json.loads(GOLDEN_INTENTS.read_text(encoding="utf-8"))
+    for case in corpus:
+        assert server_module.interpret_command(case["text"]) == case["plan"], case["text"]
+
+
+def test_plan_cache_matches_interpret_command(server_module):
+    import json
+
+    cache = server_module.PLAN_CACHE
+    texts = [case["text"] for case in json.loads(GOLDEN_INTENTS.read_text(encoding="utf-8"))]
+    texts += ['tape "merci" puis capture', 'TAPE "au revoir"  puis Capture', 'tape "ouvre chrome"',
+              'tape "a et b"', 'tape ""', 'va sur "example.com"', 'focus "Bloc-notes"', "photo d'ecran"]
+    for text in texts * 2:
+        assert cache.get_plan(text)[0] == server_module.interpret_command(text), text
+    assert cache.stats()["hits"] >= len(texts)
+
+
+def test_plan_cache_shares_templates(server_module):
+    cache = server_module.PLAN_CACHE
+    plan, hit = cache.get_plan('ouvre notepad et tape "bonjour"')
+    assert not hit and plan[-1] == {"type": "type", "text": "bonjour"}
+    plan, hit = cache.get_plan('ouvre notepad et tape "au  revoir"')
+    assert hit and plan[-1] == {"type": "type", "text": "au  revoir"}
+    # constant plans are keyed on the case-folded text
+    assert cache.get_plan("Appuie entrée")[1] is False
+    assert cache.get_plan("appuie ENTRÉE") == ([{"type": "type", "text": "\r"}], True)
+    # values copied from the text keep their case
+    plan, hit = cache.get_plan('ouvre NOTEPAD et tape "x"')
+    assert not hit and plan[1]["fallback"] == "NOTEPAD"
+
+
+def test_plan_cache_keeps_accents_and_spaces_apart(server_module):
+    cache = server_module.PLAN_CACHE
+    pairs = [("ecrit bonjour", "écrit bonjour"), ("photo d'ecran", "photo d'écran"),
+             ("capture apres capture", "capture après capture"), ("photo  d'écran", "photo d'écran")]
+    for first, second in pairs:
+        cache.get_plan(first)
+        assert cache.get_plan(second)[0] == server_module.interpret_command(second), second
+    assert cache.get_plan("écrit bonjour")[0] == [{"type": "type", "text": "bonjour"}]
+    assert [s["type"] for s in cache.get_plan("capture après capture")[0]] == ["screenshot", "sleep", "screenshot"]
+
+
+def test_plan_cache_invalidates_when_aliases_change(server_module, monkeypatch):
+    cache = server_module.PLAN_CACHE
+    monkeypatch.setattr(cache, "recheck_sec", 0)   # in-place edits are otherwise seen within a second
+    assert cache.get_plan("ouvre bloc notes")[0][0] == {"type": "run_app", "name": "notepad"}
+    monkeypatch.setitem(server_module.APP_ALIASES, "bloc notes", "wordpad")
+    plan, hit = cache.get_plan("ouvre bloc notes")
+    assert not hit and plan[0] == {"type": "run_app", "name": "wordpad"}
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_agent_command_uses_plan_cache(server_module):
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+    for _ in range(2):
+        assert client.post("/agent/command", json={"text": "capture"}, params=params).json()["ok"]
+    stats = client.get("/status", params=params).json()["plan_cache"]
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_optimize_plan_merges_and_drops_redundant_steps(server_module):
+    plan = server_module.interpret_command('focus Bloc-notes et focus Bloc-notes et tape "a" et tape "b" et capture et tape "c"')
+    optimized, changes = server_module.optimize_plan(plan)
+    assert optimized == [
+        {"type": "focus", "title": "Bloc-notes"},
+        {"type": "sleep", "sec": 0.4},
+        {"type": "type", "text": "ab"},
+        {"type": "sleep", "sec": 0.4},
+        {"type": "screenshot"},
+        {"type": "type", "text": "c"},
+    ]
+    assert {c["rule"] for c in changes} == {"drop_focus", "collapse_sleep", "drop_sleep", "merge_type"}
+    # enter / tab change the UI: the pause after them is kept
+    plan = server_module.interpret_command('appuie entrée puis tape "x"')
+    assert server_module.optimize_plan(plan) == (plan, [])
+
+
+def test_optimize_plan_drops_focus_before_open_and_hoists_launches(server_module):
+    plan = server_module.interpret_command("tape x et va sur example.com")
+    optimized, changes = server_module.optimize_plan(plan)
+    assert optimized == [{"type": "type", "text": "x"}, {"type": "open", "url": "example.com"}]
+    explain = server_module.explain_plan(plan, optimized, changes)
+    assert explain["steps_before"] == 4 and explain["steps_after"] == 2
+    assert explain["estimated_sec_saved"] == pytest.approx(0.45)
+
+    # the hoisted launch leaves its pause right before wait_window, which already waits
+    plan = server_module.interpret_command("tape x et ouvre notepad")
+    optimized, changes = server_module.optimize_plan(plan)
+    assert [s["type"] for s in optimized] == ["type", "run_app", "wait_window", "focus_best"]
+    assert [c["rule"] for c in changes] == ["hoist", "drop_sleep"]
+    assert server_module.explain_plan(plan, optimized, changes)["estimated_sec_saved"] == pytest.approx(0.4)
+
+
+def test_agent_command_explain(server_module):
+    client = TestClient(server_module.app)
+    response = client.post(
+        "/agent/command",
+        params={"token": server_module.TOKEN, "explain": 1},
+        json={"text": 'tape "a" et tape "b"'},
+    )
+    data = response.json()
+    assert data["plan"] == [{"type": "type", "text": "ab"}]
+    assert sys.modules["pyautogui"].typed == ["ab"]
+    assert data["explain"]["steps_before"] == 3 and data["explain"]["steps_after"] == 1
+    assert len(data["explain"]["interpreted"]) == 3
+    assert server_module._test_sleep_calls == []
+
+
+def test_agent_commands_runs_batch_in_order(server_module):
+    client = TestClient(server_module.app)
+    response = client.post(
+        "/agent/commands",
+        params={"token": server_module.TOKEN},
+        json={"commands": ['tape "un"', "rien à voir", 'tape "deux"']},
+    )
+    data = response.json()
+    assert response.status_code == 200
+    assert sys.modules["pyautogui"].typed == ["un", "deux"]
+    assert [it["ok"] for it in data["items"]] == [True, False, True]
+    assert data["items"][1]["reason"] == "no_intent_detected"
+    assert set(data["items"][0]["timings"]) == {"interpret_ms", "run_ms"}
+    assert set(data["timings"]) == {"interpret_ms", "run_ms", "total_ms"}
+    assert server_module.INPUT_SCHEDULER.stats()["devices"]["keyboard"]["grants"] == 1
+
+
+def test_agent_commands_overlaps_parallel_groups(server_module, monkeypatch):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def screenshot(step):
+        barrier.wait()   # only returns if both captures run at the same time
+        return {"ok": True}
+
+    monkeypatch.setattr(server_module, "_screenshot_json", screenshot)
+    client = TestClient(server_module.app)
+    response = client.post(
+        "/agent/commands",
+        params={"token": server_module.TOKEN},
+        json={"commands": ["capture", 'tape "x"', "capture"], "parallel_groups": [[0, 2]]},
+    )
+    data = response.json()
+    assert data["ok"] is True
+    assert sys.modules["pyautogui"].typed == ["x"]
+
+
+def test_agent_commands_validates_groups(server_module):
+    client = TestClient(server_module.app)
+    for groups in ([[0, 5]], [[0, 1], [1]]):
+        response = client.post(
+            "/agent/commands",
+            params={"token": server_module.TOKEN},
+            json={"commands": ["capture", "capture"], "parallel_groups": groups},
+        )
+        assert response.status_code == 422
+
+
+def _sse_events(body: str) -> list:
+    import json
+
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def test_agent_command_stream_emits_one_event_per_step(server_module):
+    client = TestClient(server_module.app)
+    response = client.post(
+        "/agent/command/stream",
+        params={"token": server_module.TOKEN},
+        json={"text": 'tape "Bonjour" et capture'},
+    )
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _sse_events(response.text)
+    assert [name for name, _ in events] == ["plan", "step", "step", "step", "done"]
+    steps = [data for name, data in events if name == "step"]
+    assert [s["type"] for s in steps] == ["type", "sleep", "screenshot"]
+    assert all(s["ok"] and s["duration_ms"] >= 0 and s["ts"] > 0 for s in steps)
+    assert steps[0]["elapsed_ms"] <= steps[-1]["elapsed_ms"]
+    assert events[-1][1]["ok"] is True and len(events[-1][1]["results"]) == 3
+
+
+def test_agent_command_stream_reports_no_intent(server_module):
+    client = TestClient(server_module.app)
+    response = client.post("/agent/command/stream", params={"token": server_module.TOKEN}, json={"text": "bof"})
+    [(name, data)] = _sse_events(response.text)
+    assert name == "done" and data["ok"] is False and data["reason"] == "no_intent_detected"
+
+
+def test_agent_llm_stream_emits_turns_and_tool_calls(server_module, monkeypatch, stub_http_server):
+    monkeypatch.setattr(server_module, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(server_module, "OPENAI_BASE", stub_http_server.url)
+    tool_call = {"id": "c1", "type": "function", "function": {"name": "hotkey", "arguments": '{"keys": "ctrl+s"}'}}
+    stub_http_server.post_replies = [
+        {"choices": [{"message": {"role": "assistant", "tool_calls": [tool_call]}}]},
+        {"choices": [{"message": {"role": "assistant", "content": "fini"}}]},
+    ]
+    client = TestClient(server_module.app)
+    response = client.post("/agent/llm/stream", params={"token": server_module.TOKEN}, json={"text": "enregistre"})
+    events = _sse_events(response.text)
+    assert [name for name, _ in events] == ["llm_turn", "tool_call", "llm_turn", "done"]
+    assert events[0][1]["tool_calls"] == ["hotkey"]
+    assert events[1][1]["name"] == "hotkey" and events[1][1]["result"]["status"] == "ok"
+    assert events[2][1]["content"] == "fini"
+    assert events[-1][1]["final"] == "fini"
+
+
+def _wait_job(client, job_id, states=("done", "failed", "cancelled", "panic"), timeout=5.0):
+    deadline = time.monotonic() + timeout
+    token = sys.modules["server"].TOKEN
+    while True:
+        job = client.get(f"/jobs/{job_id}", params={"token": token}).json()
+        if job["status"] in states or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_jobs_run_commands_and_plans_in_background(server_module):
+    with TestClient(server_module.app) as client:
+        params = {"token": server_module.TOKEN}
+        submitted = client.post("/jobs", params=params, json={"text": 'tape "Bonjour"'})
+        assert submitted.status_code == 202
+        job = _wait_job(client, submitted.json()["id"])
+        assert job["status"] == "done" and job["result"]["ok"] is True
+        assert [e["event"] for e in job["events"]] == ["plan", "step"]
+        assert sys.modules["pyautogui"].typed == ["Bonjour"]
+
+        plan_job = client.post("/jobs", params=params, json={"kind": "plan", "steps": [{"type": "hotkey", "keys": "ctrl+s"}]})
+        assert _wait_job(client, plan_job.json()["id"])["result"]["ok"] is True
+
+        llm_job = client.post("/jobs", params=params, json={"kind": "llm", "text": "salut"})
+        assert _wait_job(client, llm_job.json()["id"])["result"] == {"ok": False, "error": "OPENAI_API_KEY missing"}
+        assert client.post("/jobs", params=params, json={"kind": "plan"}).status_code == 422
+        assert client.get("/status", params=params).json()["jobs"]["done"] == 3
+
+
+def test_jobs_respect_concurrency_limit_and_cancel(server_module, monkeypatch):
+    release = threading.Event()
+
+    def screenshot(step):
+        release.wait(5)
+        return {"ok": True}
+
+    monkeypatch.setattr(server_module, "_screenshot_json", screenshot)
+    monkeypatch.setattr(server_module.JOBS, "max_concurrent", 1)
+    with TestClient(server_module.app) as client:
+        params = {"token": server_module.TOKEN}
+        first = client.post("/jobs", params=params, json={"text": "capture"}).json()["id"]
+        second = client.post("/jobs", params=params, json={"text": "capture"}).json()["id"]
+        assert _wait_job(client, first, states=("running",))["status"] == "running"
+        assert _wait_job(client, second, states=("running",), timeout=0.1)["status"] == "queued"
+
+        assert client.delete(f"/jobs/{second}", params=params).status_code == 200
+        assert _wait_job(client, second)["status"] == "cancelled"
+        release.set()
+        assert _wait_job(client, first)["status"] == "done"
+
+
+def test_plan_job_stops_with_panic_status_between_steps(server_module, monkeypatch):
+    def screenshot(step):
+        server_module.DEFAULT_PROFILE.disabled = True  # /panic pendant le plan
+        return {"ok": True}
+
+    monkeypatch.setattr(server_module, "_screenshot_json", screenshot)
+    with TestClient(server_module.app) as client:
+        params = {"token": server_module.TOKEN}
+        steps = [{"type": "screenshot"}, {"type": "hotkey", "keys": "ctrl+s"}, {"type": "type", "text": "x"}]
+        job_id = client.post("/jobs", params=params, json={"kind": "plan", "steps": steps}).json()["id"]
+        job = _wait_job(client, job_id)
+        assert job["status"] == "panic" and job["error"]["status"] == 423
+        assert [e["result"]["ok"] for e in job["events"]] == [True, False]
+        assert client.get("/status", params=params).json()["jobs"]["panic"] == 1
+    assert sys.modules["pyautogui"].hotkeys == [] and sys.modules["pyautogui"].typed == []
+
+
+def test_jobs_results_expire_after_ttl(server_module):
+    with TestClient(server_module.app) as client:
+        params = {"token": server_module.TOKEN}
+        job_id = client.post("/jobs", params=params, json={"text": "capture"}).json()["id"]
+        job = _wait_job(client, job_id)
+        server_module.JOBS.evict(now=job["finished"] + server_module.JOBS.ttl + 1)
+        assert client.get(f"/jobs/{job_id}", params=params).status_code == 404
+        assert server_module.JOBS.stats()["evicted"] == 1
+
+
+def test_plan_jobs_are_validated_before_they_run(server_module, monkeypatch):
+    feat = dict(server_module.SETTINGS.feat, keyboard=False)
+    monkeypatch.setattr(server_module, "SETTINGS", server_module.SETTINGS._replace(feat=feat))
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+
+    def submit(*steps):
+        return client.post("/jobs", params=params, json={"kind": "plan", "steps": list(steps)})
+
+    assert submit({"type": "hotkey", "keys": "win+r"}, {"type": "type", "text": "cmd"}).status_code == 403
+    assert submit({"text": "cmd"}).status_code == 422
+    assert submit({"type": "format_disk"}).status_code == 422
+    assert submit({"type": "open", "url": 42}).status_code == 422
+    assert submit({"type": "run_app"}).status_code == 422
+    assert server_module.JOBS.stats()["submitted"] == 0
+    assert sys.modules["pyautogui"].hotkeys == [] and sys.modules["pyautogui"].typed == []
+
+    steps = server_module.validate_plan([{"type": "sleep", "sec": 3600}, {"type": "wait_window", "title": "x", "timeout": 999}])
+    assert steps[0]["sec"] == server_module.PLAN_SLEEP_MAX and steps[1]["timeout"] == server_module.PLAN_WAIT_MAX
+    # run_plan itself fails a step without type, or on a disabled feature, instead of crashing or typing
+    assert asyncio.run(server_module.run_plan([{"text": "x"}]))[0]["ok"] is False
+    assert asyncio.run(server_module.run_plan([{"type": "type", "text": "x"}]))[0]["error"] == "403: keyboard disabled"
+    assert sys.modules["pyautogui"].typed == []
+
+
+def test_text_injector_picks_strategy(server_module):
+    inj = server_module.TEXT_INJECTOR
+    assert inj.choose("hello") == "direct"
+    assert inj.choose("\r") == "direct"
+    assert inj.choose("a" * 100) == "chunked"
+    assert inj.choose("a" * 400) == "clipboard"
+    assert inj.choose("café") == "clipboard"
+    assert inj.choose("ligne1\nligne2") == "clipboard"
+    assert inj.devices("hello") == ("keyboard",)
+    assert inj.devices("café") == ("clipboard", "keyboard")
+
+
+def test_text_injector_types_in_chunks_and_restores_clipboard(server_module, monkeypatch):
+    inj = server_module.TEXT_INJECTOR
+    monkeypatch.setattr(inj, "restore_delay", 0)
+    pyautogui_stub, pyperclip_stub = sys.modules["pyautogui"], sys.modules["pyperclip"]
+
+    res = inj.inject("x" * 90)
+    assert res["strategy"] == "chunked" and res["chars"] == 90
+    assert pyautogui_stub.typed == ["x" * 50, "x" * 40]
+
+    pyperclip_stub.copy("ancien contenu")
+    assert inj.inject("déjà vu")["strategy"] == "clipboard"
+    assert pyperclip_stub.copied[-2:] == ["déjà vu", "ancien contenu"]
+    assert pyautogui_stub.hotkeys == [("ctrl", "v")]
+    stats = inj.stats()
+    assert stats["chunked"]["chars"] == 90 and stats["clipboard"]["calls"] == 1
+
+
+def test_text_injector_stops_chunks_on_panic(server_module, monkeypatch):
+    typed = []
+
+    def typewrite(text, interval=0.0, _pause=True):
+        typed.append(text)
+        server_module.DISABLED = True
+
+    monkeypatch.setattr(server_module.pyautogui, "typewrite", typewrite)
+    with pytest.raises(server_module.HTTPException) as exc:
+        server_module.TEXT_INJECTOR.inject("y" * 100)
+    assert exc.value.status_code == 423
+    assert typed == ["y" * 50]
+
+
+def test_keyboard_type_endpoint_accepts_strategy(server_module, monkeypatch):
+    monkeypatch.setattr(server_module.TEXT_INJECTOR, "restore_delay", 0)
+    client = TestClient(server_module.app)
+    response = client.get(
+        "/os/keyboard/type",
+        params={"token": server_module.TOKEN, "text": "hello", "strategy": "clipboard"},
+    )
+    assert response.json()["strategy"] == "clipboard"
+    assert sys.modules["pyperclip"].copied[0] == "hello"
+    assert sys.modules["pyautogui"].typed == []
+
+
+def test_text_body_endpoints_accept_raw_json_and_streamed_bodies(server_module, monkeypatch):
+    monkeypatch.setattr(server_module.TEXT_INJECTOR, "restore_delay", 0)
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+    pyautogui_stub, pyperclip_stub = sys.modules["pyautogui"], sys.modules["pyperclip"]
+
+    raw = client.post("/os/keyboard/type", params=params, content="hello".encode(),
+                      headers={"Content-Type": "text/plain; charset=utf-8"})
+    assert raw.json()["strategy"] == "direct" and pyautogui_stub.typed == ["hello"]
+
+    as_json = client.post("/os/keyboard/type", params=params, json={"text": "abc", "strategy": "clipboard"})
+    assert as_json.json()["strategy"] == "clipboard" and "abc" in pyperclip_stub.copied
+
+    document = "ligne é\n" * 2000
+    streamed = client.post("/os/keyboard/type", params=params,
+                           content=(document[i:i + 1000].encode() for i in range(0, len(document), 1000)))
+    assert streamed.json()["chars"] == len(document)
+    assert document in pyperclip_stub.copied
+
+    clip = client.post("/os/clipboard/set", params=params, content="presse-papier".encode())
+    assert clip.json()["len"] == len("presse-papier") and pyperclip_stub.copied[-1] == "presse-papier"
+    assert client.post("/os/keyboard/type", params=params, json={"txt": "x"}).status_code == 422
+
+
+def test_keyboard_type_body_reports_chunked_paste_progress(server_module, monkeypatch):
+    monkeypatch.setattr(server_module.TEXT_INJECTOR, "restore_delay", 0)
+    monkeypatch.setattr(server_module.TEXT_INJECTOR, "paste_chunk", 10)
+    client = TestClient(server_module.app)
+    response = client.post("/os/keyboard/type", params={"token": server_module.TOKEN, "progress": 1},
+                           content=("é" * 35).encode())
+    events = _sse_events(response.text)
+    assert [name for name, _ in events] == ["progress"] * 4 + ["done"]
+    assert [data["chars_done"] for _, data in events[:4]] == [10, 20, 30, 35]
+    assert events[-1][1]["strategy"] == "clipboard"
+    assert sys.modules["pyautogui"].hotkeys == [("ctrl", "v")] * 4
+
+
+def test_text_body_is_capped(server_module, monkeypatch):
+    monkeypatch.setattr(server_module, "TEXT_MAX_BODY", 100)
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+    assert client.post("/os/clipboard/set", params=params, content=b"x" * 101).status_code == 413
+    streamed = client.post("/os/clipboard/set", params=params, content=(b"x" * 60 for _ in range(2)))
+    assert streamed.status_code == 413
+    assert sys.modules["pyperclip"].copied == []
+
+
+def test_remote_llm_planner_sends_text_in_body(server_module, stub_http_server):
+    async def scenario():
+        try:
+            planner = server_module.LLMPlanner(base_url=stub_http_server.url, token="t")
+            return await planner.tool_dispatch("type_text", {"text": "long texte é"})
+        finally:
+            await server_module.HTTP_POOL.aclose()
+
+    assert asyncio.run(scenario()) == {"status": "ok"}
+    method, path, body = stub_http_server.requests[0]
+    assert (method, path, body.decode()) == ("POST", "/os/keyboard/type?token=t", "long texte é")
+
+
+def test_os_batch_runs_actions_in_one_request(server_module, monkeypatch):
+    monkeypatch.setattr(server_module.TEXT_INJECTOR, "restore_delay", 0)
+    client = TestClient(server_module.app)
+    actions = [
+        {"action": "move", "x": 10, "y": 20},
+        {"action": "click", "clicks": 2},
+        {"action": "type", "text": "nom"},
+        {"action": "hotkey", "keys": "tab"},
+        {"action": "paste", "text": "adresse é"},
+        {"action": "wait_ms", "ms": 1},
+        {"action": "screenshot", "scale": 0.5},
+    ]
+    response = client.post("/os/batch", params={"token": server_module.TOKEN}, json={"actions": actions})
+    data = response.json()
+    assert data["ok"] is True
+    assert [r["action"] for r in data["results"]] == [a["action"] for a in actions]
+    assert all(r["duration_ms"] >= 0 for r in data["results"])
+    assert data["results"][-1]["result"]["url"].startswith("/shots/")
+    pyautogui_stub = sys.modules["pyautogui"]
+    assert pyautogui_stub.moves == [(10, 20, 0.1)]
+    assert pyautogui_stub.typed == ["nom"]
+    assert pyautogui_stub.hotkeys == [("tab",), ("ctrl", "v")]
+    assert "adresse é" in sys.modules["pyperclip"].copied
+
+
+def test_os_batch_validates_before_running(load_server, tmp_path):
+    module = load_server(tmp_path, extra_env={"COPILOTPC_FEATURE_MOUSE": "0"})
+    client = TestClient(module.app)
+    params = {"token": module.TOKEN}
+    denied = client.post("/os/batch", params=params,
+                         json={"actions": [{"action": "type", "text": "x"}, {"action": "click"}]})
+    assert denied.status_code == 403 and "action 1" in denied.json()["detail"]
+    bad = client.post("/os/batch", params=params, json={"actions": [{"action": "hotkey"}]})
+    assert bad.status_code == 422
+    for action in ({"action": "type", "text": 123}, {"action": "move", "x": "a", "y": 1},
+                   {"action": "hotkey", "keys": ["ctrl", "s"]}, {"action": "wait_ms", "ms": True},
+                   {"action": "screenshot", "save": "yes"}):
+        res = client.post("/os/batch", params=params, json={"actions": [action]})
+        assert res.status_code == 422 and "invalid" in res.json()["detail"], action
+    too_long = client.post("/os/batch", params=params, json={"actions": [{"action": "wait_ms", "ms": 60000}]})
+    assert too_long.status_code == 422 and "ms must be between" in too_long.json()["detail"]
+    over_budget = client.post("/os/batch", params=params,
+                              json={"actions": [{"action": "wait_ms", "ms": 5000}] * 3 + [{"action": "type", "text": "x"}]})
+    assert over_budget.status_code == 422 and "action 2: total wait" in over_budget.json()["detail"]
+    assert sys.modules["pyautogui"].typed == []
+
+
+def test_os_batch_stops_on_error(server_module):
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+    actions = [{"action": "type", "text": "a", "strategy": "morse"}, {"action": "type", "text": "b"}]
+    stopped = client.post("/os/batch", params=params, json={"actions": actions}).json()
+    assert stopped["ok"] is False and len(stopped["results"]) == 1
+    assert "unknown strategy" in stopped["results"][0]["error"]
+    kept = client.post("/os/batch", params=params, json={"actions": actions, "stop_on_error": False}).json()
+    assert [r["ok"] for r in kept["results"]] == [False, True]
+    assert sys.modules["pyautogui"].typed == ["b"]
+
+
+def test_control_ws_rejects_non_numeric_fields(server_module, monkeypatch):
+    client = TestClient(server_module.app)
+    with client.websocket_connect(f"/ws/control?token={server_module.TOKEN}") as ws:
+        ws.send_json([{"seq": 1, "op": "move", "x": 5, "y": 5},
+                      {"seq": 2, "op": "move_rel", "dx": "a", "dy": 1},
+                      {"seq": 3, "op": "move", "x": True, "y": 1},
+                      {"seq": 4, "op": "scroll", "dy": [1]}])
+        acks = {a["ack"]: a for a in (ws.receive_json() for _ in range(4))}
+    assert acks[1]["ok"] is True
+    assert [acks[i]["error"] for i in (2, 3, 4)] == ["dx must be a number", "x must be a number", "dy must be a number"]
+
+    def broken(events):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server_module, "_coalesce_moves", broken)
+    with client.websocket_connect(f"/ws/control?token={server_module.TOKEN}") as ws:
+        ws.send_json({"seq": 1, "op": "move", "x": 1, "y": 1})
+        with pytest.raises(WebSocketDisconnect) as exc:
+            ws.receive_json()
+    assert exc.value.code == 1011
+
+
+def test_control_ws_acks_and_coalesces_moves(server_module):
+    client = TestClient(server_module.app)
+    pyautogui_stub = sys.modules["pyautogui"]
+    with client.websocket_connect(f"/ws/control?token={server_module.TOKEN}") as ws:
+        ws.send_json([{"seq": 1, "op": "move", "x": 5, "y": 5},
+                      {"seq": 2, "op": "move", "x": 50, "y": 60},
+                      {"seq": 3, "op": "move_rel", "dx": 1, "dy": -1},
+                      {"seq": 4, "op": "down"},
+                      {"seq": 5, "op": "key_down", "key": "shift"},
+                      {"seq": 6, "op": "jump"}])
+        acks = {a["ack"]: a for a in (ws.receive_json() for _ in range(6))}
+        ws.send_json({"seq": 7, "op": "scroll", "dy": -3})
+        assert ws.receive_json()["ack"] == 7
+    deadline = time.monotonic() + 2
+    while len(pyautogui_stub.events) < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert acks[1]["coalesced"] and acks[2]["coalesced"]
+    assert acks[3]["ok"] and acks[4]["ok"] and "ms" in acks[3]
+    assert acks[6]["ok"] is False and "unknown op" in acks[6]["error"]
+    assert pyautogui_stub.moves == [(51, 59, 0)]
+    names = [name for name, _, _ in pyautogui_stub.events]
+    # key and button still held at disconnect are released
+    assert names[:3] == ["mouseDown", "keyDown", "scroll"]
+    assert sorted(names[3:]) == ["keyUp", "mouseUp"]
+    assert server_module.CONTROL_STATS["coalesced"] == 2
+
+
+def test_control_ws_rejects_bad_token_and_panic(server_module):
+    client = TestClient(server_module.app)
+    with pytest.raises(Exception):
+        with client.websocket_connect("/ws/control?token=nope") as ws:
+            ws.receive_json()
+    with client.websocket_connect(f"/ws/control?token={server_module.TOKEN}&coalesce=false") as ws:
+        client.get("/panic")
+        ws.send_json([{"seq": 1, "op": "move", "x": 1, "y": 1}, {"seq": 2, "op": "ping"}])
+        first, second = ws.receive_json(), ws.receive_json()
+    assert first["ok"] is False and "panic" in first["error"]
+    assert second == {"ack": 2, "ok": True, "ms": second["ms"]}
+    assert sys.modules["pyautogui"].moves == []
+
+
+def test_mouse_move_duration_is_configurable(load_server, tmp_path):
+    module = load_server(tmp_path, config_text='[server]\nhost = "127.0.0.1"\nport = 9999\n[input]\nmove_duration = 0.0\n')
+    client = TestClient(module.app)
+    client.get("/os/mouse/move", params={"token": module.TOKEN, "x": 1, "y": 2})
+    client.get("/os/mouse/move", params={"token": module.TOKEN, "x": 3, "y": 4, "duration": 0.3})
+    assert sys.modules["pyautogui"].moves == [(1, 2, 0.0), (3, 4, 0.3)]
+
+
+class _FakePage:
+    def __init__(self, n):
+        self.n, self.closed, self.crashed, self.visited = n, False, False, []
+        self.keyboard = types.SimpleNamespace(type=self._noop, press=self._noop)
+
+    async def _noop(self, *args, **kwargs):
+        return None
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+    async def goto(self, url):
+        await asyncio.sleep(0)
+        self.visited.append(url)
+
+    async def evaluate(self, expr):
+        if self.crashed:
+            raise RuntimeError("Target crashed")
+        return f"page-{self.n}:{self.visited[-1] if self.visited else ''}"
+
+
+class _FakePages:
+    def __init__(self):
+        self.pages = []
+
+    async def new_page(self):
+        self.pages.append(_FakePage(len(self.pages) + 1))
+        return self.pages[-1]
+
+    async def close_page(self, page):
+        await page.close()
+
+    async def stop(self):
+        pass
+
+
+def _tick():
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    loop.call_soon(fut.set_result, None)
+    return fut
+
+
+def test_browser_pool_leases_sessions_and_waits(server_module):
+    pool = server_module.BrowserPool(_FakePages(), size=2, prewarm=0, lease_timeout=0.2)
+
+    async def scenario():
+        async with pool.lease("alice") as a:
+            async with pool.lease() as anon:
+                assert a["page"] is not anon["page"]
+                with pytest.raises(server_module.HTTPException) as busy:
+                    async with pool.lease("bob"):
+                        pass
+                assert busy.value.status_code == 503
+        async with pool.lease("alice") as again:
+            assert again["page"] is a["page"]  # same tab for the same session
+        order, gate = [], asyncio.Event()
+
+        async def hold(name):
+            async with pool.lease("alice") as slot:
+                order.append((name, slot["id"]))
+                await gate.wait()
+
+        tasks = [asyncio.create_task(hold("x")), asyncio.create_task(hold("y"))]
+        while pool.waited < 2:
+            await _tick()
+        gate.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(scenario())
+    assert [name for name, _ in order] == ["x", "y"] and order[0][1] == order[1][1]
+    stats = pool.stats()
+    assert stats["open"] == 2 and stats["sessions"] == 1 and stats["timeouts"] == 1
+    assert stats["leases"] == 5 and stats["max_in_use"] == 2 and stats["in_use"] == 0
+
+
+def test_browser_pool_recreates_crashed_pages_and_evicts_idle(server_module):
+    factory = _FakePages()
+    pool = server_module.BrowserPool(factory, size=3, prewarm=1, idle_ttl=10)
+
+    async def scenario():
+        await pool.prewarm()
+        async with pool.lease("s") as slot:
+            first = slot["page"]
+        assert factory.pages == [first]  # the session got the prewarmed page
+        first.closed = True
+        async with pool.lease("s") as slot:
+            assert slot["page"] is not first
+        await pool.maintain()   # tops the anonymous pages back up to prewarm
+        warm = next(s for s in pool.slots if s["session"] is None)
+        crashed = warm["page"]
+        crashed.crashed = True
+        await pool.maintain()   # probe: the crashed page is replaced
+        assert warm["page"] is not crashed
+        await pool.maintain(now=time.monotonic() + 60)
+
+    asyncio.run(scenario())
+    stats = pool.stats()
+    assert stats["open"] == 1 and stats["sessions"] == 0  # prewarmed page kept, idle session evicted
+    assert stats["recreated"] == 2 and stats["evicted"] == 1
+
+
+def test_browser_script_uses_pool(server_module, monkeypatch):
+    monkeypatch.setattr(server_module, "SETTINGS", server_module.SETTINGS._replace(pw_enabled=True))
+    factory = _FakePages()
+    monkeypatch.setattr(server_module.BROWSER_POOL, "factory", factory)
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+    body = {"session": "s1", "steps": [{"type": "goto", "url": "https://example.org"}, {"type": "eval"}]}
+    first = client.post("/browser/script", params=params, json=body).json()
+    second = client.post("/browser/script", params=params, json=body).json()
+    assert first["results"][1]["result"] == "page-1:https://example.org" and first["page"] == second["page"]
+    assert factory.pages[0].visited == ["https://example.org"] * 2
+    pool = client.get("/status", params=params).json()["browser_pool"]
+    assert pool["leases"] == 2 and pool["sessions"] == 1
+
+
+class _BarrierPage(_FakePage):
+    """goto() returns only once `expected` pages are navigating at the same time."""
+    arrived, expected, ready = 0, 3, None
+
+    async def goto(self, url):
+        cls = _BarrierPage
+        cls.arrived += 1
+        if cls.arrived == cls.expected:
+            cls.ready.set()
+        await asyncio.wait_for(cls.ready.wait(), 2)
+        self.visited.append(url)
+
+
+class _BarrierPages(_FakePages):
+    async def new_page(self):
+        self.pages.append(_BarrierPage(len(self.pages) + 1))
+        return self.pages[-1]
+
+
+def test_browser_script_parallel_branches_run_on_separate_tabs(server_module, monkeypatch):
+    monkeypatch.setattr(server_module, "SETTINGS", server_module.SETTINGS._replace(pw_enabled=True))
+    monkeypatch.setattr(server_module.BROWSER_POOL, "factory", _BarrierPages())
+    _BarrierPage.arrived, _BarrierPage.ready = 0, None
+
+    async def scenario():
+        _BarrierPage.ready = asyncio.Event()
+        urls = [f"https://example.org/{n}" for n in range(3)]
+        steps = [{"type": "eval", "expression": "1"},
+                 {"type": "parallel", "branches": [[{"type": "goto", "url": u}, {"type": "eval"}] for u in urls]}]
+        return await server_module.run_browser_steps(steps)
+
+    out = asyncio.run(scenario())
+    block = out["results"][1]
+    assert block["ok"] and block["type"] == "parallel"
+    assert [b["results"][1]["result"].split(":", 1)[1] for b in block["branches"]] == [
+        f"https://example.org/{n}" for n in range(3)]
+    assert len({b["page"] for b in block["branches"]} | {out["page"]}) == 4
+    assert all("duration_ms" in r for b in block["branches"] for r in b["results"])
+
+
+def test_browser_steps_compile_once_for_script_and_plan(server_module, monkeypatch):
+    monkeypatch.setattr(server_module, "SETTINGS", server_module.SETTINGS._replace(pw_enabled=True))
+    monkeypatch.setattr(server_module.BROWSER_POOL, "factory", _FakePages())
+    client = TestClient(server_module.app)
+    params = {"token": server_module.TOKEN}
+    bad = client.post("/browser/script", params=params,
+                      json={"steps": [{"type": "eval"}, {"type": "parallel", "branches": [[{"type": "click"}]]}]})
+    assert bad.status_code == 400 and "step 1 branch 0 step 0: selector required" in bad.json()["detail"]
+    wide = [[{"type": "eval"}]] * server_module.BROWSER_POOL.size
+    too_wide = client.post("/browser/script", params=params, json={"steps": [{"type": "parallel", "branches": wide}]})
+    assert too_wide.status_code == 400 and "pool_size" in too_wide.json()["detail"]
+    assert server_module.BROWSER_POOL.stats()["leases"] == 0  # rejected before taking a page
+    # the plan path now knows eval and type, like /browser/script
+    plan = [{"type": "playwright_script", "steps": [{"type": "type", "text": "x"}, {"type": "eval", "expression": "2"}]}]
+    out = asyncio.run(server_module.run_plan(plan))
+    assert out[0]["ok"] and [r["type"] for r in out[0]["playwright_results"]] == ["type", "eval"]
+
+
+def test_heavy_modules_load_on_first_use(server_module):
+    assert isinstance(vars(server_module)["pyautogui"], server_module._LazyImport)
+    assert server_module.LAZY_IMPORTS["pyautogui"] is None
+    client = TestClient(server_module.app)
+    client.get("/os/mouse/move", params={"token": server_module.TOKEN, "x": 1, "y": 1})
+    assert vars(server_module)["pyautogui"] is sys.modules["pyautogui"]  # proxy swapped for the module
+    assert server_module.LAZY_IMPORTS["pyautogui"] is not None
+    status = client.get("/status", params={"token": server_module.TOKEN}).json()
+    assert status["lazy_imports"]["mss"] is None and status["lazy_imports"]["pyautogui"] > 0
+    assert server_module.warm_import_names() == ["pyautogui", "pyperclip", "Desktop", "mss", "Image", "np"]
+
+
+def test_playwright_launches_on_first_script(load_server, tmp_path):
+    module = load_server(tmp_path, extra_env={"COPILOTPC_FEATURE_BROWSER_PLAYWRIGHT": "1"})
+    assert module.PW_ENABLED and "playwright.async_api" not in sys.modules
+    client = TestClient(module.app)
+    res = client.post("/browser/script", params={"token": module.TOKEN}, json={"steps": [{"type": "eval"}]})
+    # playwright is not installed here: the first lease is what tries to start it
+    assert res.status_code == 503 and "playwright" in res.json()["detail"]
+
+
+def test_create_app_isolates_profiles(server_module, tmp_path):
+    alice = server_module.create_app({"security": {"token": "a"}, "run": {"allowlist": {"solo": "/usr/bin/solo"}}},
+                                     name="alice")
+    config = tmp_path / "bob.toml"
+    config.write_text('[security]\ntoken = "b"\n[features]\nmouse = false\n', encoding="utf-8")
+    bob = server_module.create_app(config, name="bob")
+    a, b = TestClient(alice), TestClient(bob)
+
+    status = a.get("/status", params={"token": "a"}).json()
+    assert status["profile"] == "alice" and status["allowlist"] == ["solo"]
+    assert a.get("/status", params={"token": "b"}).status_code == 401
+    assert b.get("/status", params={"token": "b"}).json()["config_path"] == str(config)
+
+    a.get("/panic")
+    assert a.get("/os/mouse/move", params={"token": "a", "x": 1, "y": 1}).status_code == 423
+    assert b.get("/os/mouse/move", params={"token": "b", "x": 1, "y": 1}).status_code == 403  # mouse off for bob
+    default = TestClient(server_module.app).get("/os/mouse/move", params={"token": server_module.TOKEN, "x": 2, "y": 2})
+    assert default.status_code == 200 and server_module.DISABLED is False
+
+    with b.websocket_connect("/ws/control?token=b") as ws:
+        ws.send_json({"seq": 1, "op": "key_down", "key": "a"})
+        assert ws.receive_json()["ok"] is True
+    assert alice.state.profile.jobs is not bob.state.profile.jobs is not server_module.JOBS
+    assert server_module.create_app().state.profile is server_module.DEFAULT_PROFILE
+
+
+def test_profile_shutdown_keeps_shared_resources_for_other_apps(server_module):
+    alice = server_module.create_app({"security": {"token": "a"}}, name="alice")
+    bob = server_module.create_app({"security": {"token": "b"}}, name="bob")
+    with TestClient(alice):
+        with TestClient(bob) as b:
+            assert b.get("/os/mouse/move", params={"token": "b", "x": 1, "y": 1}).status_code == 200
+        assert server_module.RUNNING_APPS == 1
+        assert server_module.UI_EXECUTOR._pool is not None and server_module.WINDOW_INDEX._threads
+    assert server_module.RUNNING_APPS == 0
+    assert server_module.UI_EXECUTOR._pool is None and not server_module.WINDOW_INDEX._threads
+
+
+def test_admin_reload_swaps_settings_for_new_requests(server_module, tmp_path):
+    config = tmp_path / "hot.toml"
+    config.write_text('[security]\ntoken = "t"\n[run.allowlist]\nsolo = "/usr/bin/solo"\n', encoding="utf-8")
+    app = server_module.create_app(config, name="hot")
+    client = TestClient(app)
+    params = {"token": "t"}
+    profile = app.state.profile
+    profile.plan_cache.get_plan("ouvre solo")
+
+    with client.websocket_connect("/ws/control?token=t") as ws:
+        config.write_text('[security]\ntoken = "u"\n[features]\nmouse = false\n[run.allowlist]\nduo = "duo"\n'
+                          '[window]\ncache_ttl = 5\n', encoding="utf-8")
+        res = client.post("/admin/reload", params=params).json()
+        assert res["version"] == 2 and res["changed"] == ["token", "feat", "allow"]
+        assert res["restart_required"] == ["window"]
+        # la connexion ouverte avant le rechargement garde l'ancien snapshot
+        ws.send_json({"seq": 1, "op": "move", "x": 3, "y": 3})
+        assert ws.receive_json()["ok"] is True
+
+    assert client.get("/status", params=params).status_code == 401
+    status = client.get("/status", params={"token": "u"}).json()
+    assert status["allowlist"] == ["duo"] and status["config_version"] == 2
+    assert client.get("/os/mouse/move", params={"token": "u", "x": 1, "y": 1}).status_code == 403
+    assert profile.plan_cache.stats()["invalidations"] >= 1
+    assert isinstance(profile.settings.allow, server_module.MappingProxyType)
+
+    config.write_text("[security\n", encoding="utf-8")
+    assert client.post("/admin/reload", params={"token": "u"}).status_code == 400
+    assert profile.settings.version == 2
+    dict_app = server_module.create_app({"security": {"token": "d"}})
+    assert TestClient(dict_app).post("/admin/reload", params={"token": "d"}).status_code == 409
+
+
+def test_admin_reload_default_profile_updates_module(server_module):
+    config = server_module.CONFIG_PATH
+    config.write_text(config.read_text(encoding="utf-8").replace('chrome = ["chrome.exe"]', 'solo = "solo"'),
+                      encoding="utf-8")
+    server_module._EXE_PATHS["notepad.exe"] = "C:/Windows/notepad.exe"
+    server_module.DISABLED = True   # panic mode survives a reload
+    res = TestClient(server_module.app).post("/admin/reload", params={"token": server_module.TOKEN}).json()
+    assert res["profile"] == "default" and res["changed"] == ["allow"] and server_module.SETTINGS.version == 2
+    assert server_module.ALLOW == {"notepad": ["notepad.exe"], "solo": ["solo"]} and not server_module._EXE_PATHS
+    assert server_module.DISABLED is True
+
+
+def test_config_watcher_reloads_on_change(server_module, tmp_path):
+    config = tmp_path / "watched.toml"
+    config.write_text('[features]\nmouse = true\n', encoding="utf-8")
+    profile = server_module.Profile({}, config_path=config, name="watched")
+
+    class _Loop:
+        def call_soon_threadsafe(self, fn):
+            fn()
+
+    watcher = server_module.ConfigWatcher(profile, interval=0.1)
+    watcher.start(_Loop())
+    try:
+        config.write_text('[features]\nmouse = false\n', encoding="utf-8")
+        deadline = time.monotonic() + 5
+        while watcher.reloads == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        watcher.stop()
+    assert watcher.reloads == 1 and profile.settings.feat["mouse"] is False